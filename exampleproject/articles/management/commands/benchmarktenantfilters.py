@@ -0,0 +1,62 @@
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from shared_schema_tenants.models import Tenant
+from exampleproject.articles.models import Tag
+
+STRATEGIES = ['join', 'exists', 'denormalized']
+
+
+class Command(BaseCommand):
+    help = 'Compares the tenants filter strategies of MultipleTenantModelManager on the Tag model'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000)
+        parser.add_argument('--tenants', type=int, default=10)
+        parser.add_argument('--tenants-per-row', type=int, default=2)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--strategies', nargs='+', default=STRATEGIES, choices=STRATEGIES)
+        parser.add_argument('--keep', action='store_true', help="Don't roll back the generated rows")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            tenants = self.create_rows(options)
+
+            self.stdout.write('%-14s %12s %12s %12s' % ('strategy', 'count (ms)', 'page (ms)', 'deep (ms)'))
+            for strategy in options['strategies']:
+                queryset = Tag.objects.filter_by_tenant(Tag.original_manager.all(), tenants[0].pk, strategy)
+                self.stdout.write('%-14s %12.2f %12.2f %12.2f' % (
+                    strategy,
+                    self.measure(lambda: queryset.count(), options['repeat']),
+                    self.measure(lambda: list(queryset.order_by('pk')[:50]), options['repeat']),
+                    self.measure(lambda: list(queryset.order_by('pk')[options['rows'] // 4:][:50]),
+                                 options['repeat']),
+                ))
+
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+    def measure(self, query, repeat):
+        return min(timeit.repeat(query, number=1, repeat=repeat)) * 1000
+
+    def create_rows(self, options):
+        tenants = Tenant.objects.bulk_create([
+            Tenant(slug='benchmark-%d' % i, name='Benchmark %d' % i) for i in range(options['tenants'])])
+        through = Tag._meta.get_field('tenants').remote_field.through
+        first_id = (Tag.original_manager.order_by('-pk').values_list('pk', flat=True).first() or 0) + 1
+
+        for batch_start in range(0, options['rows'], options['batch_size']):
+            tags = []
+            tag_tenants = []
+            for i in range(batch_start, min(batch_start + options['batch_size'], options['rows'])):
+                slugs = [tenants[(i + j) % len(tenants)].pk for j in range(options['tenants_per_row'])]
+                tags.append(Tag(id=first_id + i, text='tag %d' % i, tenant_slugs=Tag.get_tenant_slugs_value(slugs)))
+                tag_tenants.extend(through(tag_id=first_id + i, tenant_id=slug) for slug in slugs)
+
+            Tag.original_manager.bulk_create(tags)
+            through.objects.bulk_create(tag_tenants)
+            self.stdout.write('Created %d of %d rows' % (batch_start + len(tags), options['rows']))
+
+        return tenants
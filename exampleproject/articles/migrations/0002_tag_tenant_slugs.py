@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+if 'postgresql' in settings.DATABASES['default']['ENGINE']:
+    import django.contrib.postgres.fields
+    tenant_slugs_field = django.contrib.postgres.fields.ArrayField(
+        base_field=models.CharField(max_length=255), blank=True, default=list, editable=False, size=None)
+else:
+    tenant_slugs_field = models.TextField(blank=True, default='', editable=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('articles', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='tenant_slugs',
+            field=tenant_slugs_field,
+        ),
+    ]
@@ -1,7 +1,7 @@
 from django.db import models
 from django.conf import settings
 from shared_schema_tenants.mixins import (
-    SingleTenantModelMixin, MultipleTenantsModelMixin)
+    SingleTenantModelMixin, DenormalizedTenantsModelMixin)
 
 
 class Article(SingleTenantModelMixin):
@@ -14,7 +14,7 @@ class Article(SingleTenantModelMixin):
         return '%s - %s' % (self.title, str(self.author))
 
 
-class Tag(MultipleTenantsModelMixin):
+class Tag(DenormalizedTenantsModelMixin):
     text = models.CharField(max_length=100)
 
     def __str__(self):
@@ -58,6 +58,9 @@ setup(
     ],
     include_package_data=True,
     install_requires=["django-model-utils>=2.0"],
+    extras_require={
+        'async': ['asgiref>=3.2'],
+    },
     license="MIT",
     zip_safe=False,
     keywords='django-shared-schema-tenants',
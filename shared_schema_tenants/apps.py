@@ -4,3 +4,6 @@ from django.apps import AppConfig
 
 class SharedSchemaTenantsConfig(AppConfig):
     name = 'shared_schema_tenants'
+
+    def ready(self):
+        from shared_schema_tenants import checks  # noqa
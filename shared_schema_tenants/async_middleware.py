@@ -0,0 +1,93 @@
+"""
+Asynchronous path of TenantMiddleware, used when it wraps an async
+``get_response`` under ASGI. Requires Python 3.5 or newer.
+"""
+import asyncio
+
+from shared_schema_tenants.settings import get_settings
+from shared_schema_tenants.context import current_tenant
+from shared_schema_tenants.tenant_retrievers import persist_tenant
+from shared_schema_tenants.async_tenant_retrievers import sync_to_async
+
+
+async def acall_retriever_stage(retriever_stage, request):
+    if retriever_stage.precondition is not None and not retriever_stage.precondition(request):
+        retriever_stage.skipped += 1
+        return None
+
+    retriever_stage.calls += 1
+    async_retriever = retriever_stage.get_async_retriever()
+    if async_retriever is not None:
+        tenant = await async_retriever(request)
+    else:
+        tenant = await sync_to_async(retriever_stage.retriever)(request)
+
+    if tenant is not None:
+        retriever_stage.hits += 1
+    return tenant
+
+
+async def apersist_tenant(request, tenant):
+    if get_settings().TENANT_PERSISTENCE == 'cookie':
+        return persist_tenant(request, tenant)
+
+    if not hasattr(request, 'session'):
+        return
+
+    # reading the session may load it from its backend
+    await sync_to_async(persist_tenant)(request, tenant)
+
+
+async def aget_tenant(request, retriever_pipeline):
+    if not hasattr(request, '_cached_tenant'):
+        for retriever_stage in retriever_pipeline:
+            tenant = await acall_retriever_stage(retriever_stage, request)
+            if tenant is not None:
+                request._cached_tenant = tenant
+                break
+
+        if not hasattr(request, '_cached_tenant'):
+            lazy_tenant = current_tenant.get()
+            if lazy_tenant is None or not await sync_to_async(bool)(lazy_tenant):
+                return None
+
+            request._cached_tenant = getattr(lazy_tenant, '_wrapped', lazy_tenant)
+
+        elif get_settings().ADD_TENANT_TO_SESSION:
+            await apersist_tenant(request, request._cached_tenant)
+
+    return request._cached_tenant
+
+
+class AsyncMiddlewareMixin(object):
+    is_async = False
+
+    def init_async_mode(self):
+        self.is_async = asyncio.iscoroutinefunction(self.get_response)
+        if self.is_async:
+            try:
+                from asgiref.sync import markcoroutinefunction
+            except ImportError:
+                self._is_coroutine = asyncio.coroutines._is_coroutine
+            else:
+                markcoroutinefunction(self)
+
+    async def __acall__(self, request):
+        request.tenant = await aget_tenant(request, self.retriever_pipeline)
+        request._tenant_context_token = current_tenant.set(request.tenant)
+        if get_settings().ROW_LEVEL_SECURITY:
+            await sync_to_async(self.set_database_tenant)(request)
+
+        try:
+            response = await self.get_response(request)
+        except Exception:
+            await self.areset_database_tenant(request)
+            self.reset_tenant(request)
+            raise
+
+        await self.areset_database_tenant(request)
+        return self.process_response(request, response)
+
+    async def areset_database_tenant(self, request):
+        if '_database_tenant_set' in request.__dict__:
+            await sync_to_async(self.reset_database_tenant)(request)
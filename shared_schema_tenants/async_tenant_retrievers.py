@@ -0,0 +1,108 @@
+"""
+Asynchronous variants of the tenant retrievers, used by TenantMiddleware when
+it runs under ASGI. They answer from the tenant caches without leaving the
+event loop, using Django's async cache API when available, and run the
+database lookups of the synchronous retrievers through
+``asgiref.sync.sync_to_async``. Requires Python 3.5 or newer and asgiref.
+"""
+import uuid
+
+from shared_schema_tenants.models import Tenant
+from shared_schema_tenants.exceptions import TenantNotFoundError
+from shared_schema_tenants.cache import (
+    get_domain_cache, get_domain_index, get_tenant_cache, normalize_host, copy_tenant)
+from shared_schema_tenants.tenant_retrievers import (
+    load_tenant_by_slug, get_tenant_by_domain, get_http_header_slug, get_session_slug, get_tenant_cookie,
+    retrieve_by_signed_token)
+
+
+def sync_to_async(func, thread_sensitive=True):
+    from asgiref.sync import sync_to_async as asgiref_sync_to_async
+    return asgiref_sync_to_async(func, thread_sensitive=thread_sensitive)
+
+
+async def call_cache(cache, method_name, *args):
+    async_method = getattr(cache, 'a' + method_name, None)
+    if async_method is not None:
+        return await async_method(*args)
+    return await sync_to_async(getattr(cache, method_name), thread_sensitive=False)(*args)
+
+
+async def aget_generation(tenant_cache, slug):
+    generation_key = tenant_cache.get_generation_key(slug)
+    generation = await call_cache(tenant_cache.cache, 'get', generation_key)
+    if generation is None:
+        await call_cache(tenant_cache.cache, 'add', generation_key, uuid.uuid4().hex, None)
+        generation = await call_cache(tenant_cache.cache, 'get', generation_key)
+    return generation
+
+
+async def aget_tenant_generation(slug):
+    tenant_cache = get_tenant_cache()
+    if tenant_cache.alias is None:
+        return None
+    return await aget_generation(tenant_cache, slug)
+
+
+async def aget_cached_tenant(lookup, value):
+    tenant_cache = get_tenant_cache()
+    if tenant_cache.alias is None:
+        return None
+
+    entry = await call_cache(tenant_cache.cache, 'get', tenant_cache.make_key(lookup, value))
+    if entry is None:
+        return None
+
+    return tenant_cache.load_entry(entry, await aget_generation(tenant_cache, entry[0]))
+
+
+async def aget_tenant_by_slug(slug, retriever='slug'):
+    tenant = await aget_cached_tenant('slug', slug)
+    if tenant is None:
+        tenant = await sync_to_async(load_tenant_by_slug)(slug, retriever=retriever)
+    return tenant
+
+
+async def afind_tenant_by_slug(slug, retriever, required=True):
+    """
+    Async variant of ``find_tenant_by_slug``.
+    """
+    if slug is None:
+        return None
+
+    try:
+        return await aget_tenant_by_slug(slug, retriever=retriever)
+    except Tenant.DoesNotExist:
+        if required:
+            raise TenantNotFoundError()
+        return None
+
+
+async def aretrieve_by_domain(request):
+    host = normalize_host(request.get_host())
+    generation, tenant = get_domain_cache().get(host, (None, None))
+    if tenant is not None and generation == await aget_tenant_generation(tenant.pk):
+        return copy_tenant(tenant)
+    return await sync_to_async(get_tenant_by_domain)(request, host)
+
+
+async def aretrieve_by_domain_index(request):
+    domain_index = await sync_to_async(get_domain_index)()
+    return await afind_tenant_by_slug(domain_index.lookup(request.get_host()), 'domain_index')
+
+
+async def aretrieve_by_http_header(request):
+    return await afind_tenant_by_slug(get_http_header_slug(request), 'http_header')
+
+
+async def aretrieve_by_signed_token(request):
+    return retrieve_by_signed_token(request)
+
+
+async def aretrieve_by_session(request):
+    slug = await sync_to_async(get_session_slug)(request)
+    return await afind_tenant_by_slug(slug, 'session', required=False)
+
+
+async def aretrieve_by_cookie(request):
+    return await afind_tenant_by_slug(get_tenant_cookie(request), 'cookie', required=False)
@@ -0,0 +1,613 @@
+import copy
+import functools
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.core.exceptions import EmptyResultSet
+from django.utils.encoding import force_bytes, force_text
+
+from shared_schema_tenants.settings import get_setting
+
+
+class LRUCache(object):
+    """
+    Bounded, thread safe, least recently used mapping whose entries expire
+    ``timeout`` seconds after being set. A ``timeout`` of ``None`` never
+    expires entries and a ``max_size`` of ``0`` disables the cache.
+    """
+
+    def __init__(self, max_size=1024, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires_at, value = self._data.pop(key)
+            except KeyError:
+                return default
+
+            if expires_at is not None and expires_at <= time.time():
+                return default
+
+            self._data[key] = (expires_at, value)
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        expires_at = None
+        if self.timeout is not None:
+            expires_at = time.time() + self.timeout
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires_at, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class GenerationCache(object):
+    """
+    Base of the caches built on Django's cache framework whose entries are
+    tagged with a generation, shared by every worker using the same cache
+    alias. Bumping a generation invalidates all the entries tagged with it
+    at once. An alias of ``None`` disables the cache.
+    """
+    key_prefix = 'shared_schema_tenants'
+
+    def __init__(self, alias='default', timeout=300):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def make_key(self, *parts):
+        digest = hashlib.md5(force_bytes(':'.join(parts))).hexdigest()
+        return '%s:%s:%s' % (self.key_prefix, parts[0], digest)
+
+    def get_generation_key(self, *parts):
+        return self.make_key('generation', *parts)
+
+    def get_pending_generation(self, generation_key, using=None):
+        """
+        Returns the generation the writes of the current transaction of the
+        ``using`` database gave to the entries, while they aren't committed
+        yet, or ``None``.
+        """
+        connection = transaction.get_connection(using)
+        if not connection.in_atomic_block:
+            return None
+
+        for sids, func in reversed(connection.run_on_commit):
+            if getattr(func, 'generation_key', None) == generation_key:
+                return func.generation
+        return None
+
+    def get_generation(self, *parts, **kwargs):
+        generation_key = self.get_generation_key(*parts)
+        generation = self.cache.get(generation_key)
+        if generation is None:
+            self.cache.add(generation_key, uuid.uuid4().hex, None)
+            generation = self.cache.get(generation_key)
+
+        pending_generation = self.get_pending_generation(generation_key, kwargs.get('using'))
+        if pending_generation is not None:
+            generation = '%s:%s' % (generation, pending_generation)
+        return generation
+
+    def bump_generation(self, *parts):
+        if self.alias is None:
+            return
+        self.cache.set(self.get_generation_key(*parts), uuid.uuid4().hex, None)
+
+    def invalidate(self, *parts, **kwargs):
+        """
+        Bumps the generation when the transaction of the ``using`` database
+        commits, or right away outside transactions. Until then, the
+        transaction reads and caches the entries under a pending generation
+        of its own, which other workers never see and which is dropped along
+        with the writes if the transaction rolls back.
+        """
+        if self.alias is None:
+            return
+
+        using = kwargs.get('using')
+        if not transaction.get_connection(using).in_atomic_block:
+            self.bump_generation(*parts)
+            return
+
+        bump_generation = functools.partial(self.bump_generation, *parts)
+        bump_generation.generation_key = self.get_generation_key(*parts)
+        bump_generation.generation = uuid.uuid4().hex
+        transaction.on_commit(bump_generation, using=using)
+
+
+class TenantCache(GenerationCache):
+    """
+    Tenant lookup layer on top of Django's cache framework. Each entry maps a
+    lookup (a domain or a slug) to the tenant slug, the tenant generation
+    when the entry was stored and the tenant row. Bumping the generation of
+    a tenant invalidates all of its entries at once.
+    """
+
+    def build_entry(self, tenant, generation):
+        row = [(field.attname, getattr(tenant, field.attname))
+               for field in tenant._meta.concrete_fields]
+        return (tenant.pk, generation, tenant._state.db, row)
+
+    def load_entry(self, entry, generation):
+        from shared_schema_tenants.models import Tenant
+
+        slug, entry_generation, db, row = entry
+        if entry_generation != generation:
+            return None
+
+        field_names, values = zip(*row)
+        return Tenant.from_db(db, list(field_names), list(values))
+
+    def get(self, lookup, value):
+        if self.alias is None:
+            return None
+
+        entry = self.cache.get(self.make_key(lookup, value))
+        if entry is None:
+            return None
+
+        return self.load_entry(entry, self.get_generation(entry[0], using=entry[2]))
+
+    def set(self, lookup, value, tenant):
+        if self.alias is None:
+            return
+
+        entry = self.build_entry(tenant, self.get_generation(tenant.pk, using=tenant._state.db))
+        self.cache.set(self.make_key(lookup, value), entry, self.timeout)
+
+
+class MissCache(object):
+    """
+    Remembers failed tenant lookups for a short time so repeated requests for
+    unknown domains or slugs don't reach the database, and counts them per
+    retriever. When a retriever misses ``flood_max_misses`` times within
+    ``flood_window`` seconds, lookups that aren't cached yet are treated as
+    misses too until the window is over.
+    """
+
+    def __init__(self, max_size=1024, timeout=10, flood_max_misses=None, flood_window=1):
+        self.misses = LRUCache(max_size=max_size, timeout=timeout)
+        self.flood_max_misses = flood_max_misses
+        self.flood_window = flood_window
+        self._counters = {}
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def _count(self, retriever, counter):
+        counters = self._counters.setdefault(
+            retriever, {'misses': 0, 'cached_misses': 0, 'short_circuits': 0})
+        counters[counter] += 1
+
+    def _is_flooded(self, retriever):
+        if self.flood_max_misses is None:
+            return False
+
+        window_start, window_misses = self._windows.get(retriever, (0, 0))
+        if window_start + self.flood_window <= time.time():
+            return False
+
+        return window_misses >= self.flood_max_misses
+
+    def is_miss(self, retriever, key):
+        if self.misses.get((retriever, key)):
+            with self._lock:
+                self._count(retriever, 'cached_misses')
+            return True
+
+        with self._lock:
+            if self._is_flooded(retriever):
+                self._count(retriever, 'short_circuits')
+                return True
+
+        return False
+
+    def add_miss(self, retriever, key):
+        self.misses.set((retriever, key), True)
+
+        with self._lock:
+            self._count(retriever, 'misses')
+
+            now = time.time()
+            window_start, window_misses = self._windows.get(retriever, (now, 0))
+            if window_start + self.flood_window <= now:
+                window_start, window_misses = now, 0
+            self._windows[retriever] = (window_start, window_misses + 1)
+
+    def get_stats(self):
+        with self._lock:
+            return {retriever: dict(counters) for retriever, counters in self._counters.items()}
+
+    def clear(self):
+        self.misses.clear()
+        with self._lock:
+            self._windows.clear()
+
+
+class PrimaryPins(object):
+    """
+    Remembers for ``timeout`` seconds the tenants that wrote to their primary
+    database, so their reads skip the replicas, which may not have the
+    writes yet. Pins are shared through Django's cache framework, or kept in
+    each process when ``alias`` is ``None``.
+    """
+    key_prefix = 'shared_schema_tenants:pin'
+
+    def __init__(self, alias='default', timeout=5):
+        self.alias = alias
+        self.timeout = timeout
+        self.local_pins = LRUCache(timeout=timeout)
+
+    def make_key(self, tenant_pk):
+        return '%s:%s' % (self.key_prefix, hashlib.md5(force_bytes(tenant_pk)).hexdigest())
+
+    def pin(self, tenant_pk):
+        if self.alias is None:
+            self.local_pins.set(tenant_pk, True)
+        else:
+            caches[self.alias].set(self.make_key(tenant_pk), True, self.timeout)
+
+    def is_pinned(self, tenant_pk):
+        if self.alias is None:
+            return self.local_pins.get(tenant_pk, False)
+        return caches[self.alias].get(self.make_key(tenant_pk), False)
+
+
+class QueryCache(GenerationCache):
+    """
+    Stores the results of tenant querysets in Django's cache framework. Keys
+    combine the SQL of the query, its database and a generation of the model
+    for the tenant, which is bumped whenever the tenant writes to the model,
+    so cached results are reused until then. Rows of models with multiple
+    tenants may be shared, so their generation isn't per tenant.
+    """
+    key_prefix = 'shared_schema_tenants:query'
+    shared_tenant = '*'
+
+    def __init__(self, alias='default', timeout=60):
+        super(QueryCache, self).__init__(alias, timeout)
+
+    def get_generation_key(self, model, tenant_pk):
+        from shared_schema_tenants.mixins import SingleTenantModelMixin
+        if not issubclass(model, SingleTenantModelMixin):
+            tenant_pk = self.shared_tenant
+        return self.make_key('generation', model._meta.concrete_model._meta.label, force_text(tenant_pk))
+
+    def get_results_key(self, queryset, tenant_pk):
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            return None
+
+        return self.make_key(
+            'results', force_text(tenant_pk), self.get_generation(queryset.model, tenant_pk, using=queryset.db),
+            queryset.db,
+            queryset._iterable_class.__name__, sql, repr(params))
+
+    def get_results(self, queryset, tenant_pk, timeout=None):
+        """
+        Returns the rows of the queryset from the cache, or evaluates it and
+        caches its rows for ``timeout`` seconds. Returns ``None`` when the
+        queryset can't be cached.
+        """
+        key = None
+        if self.alias is not None and tenant_pk is not None:
+            key = self.get_results_key(queryset, tenant_pk)
+        if key is None:
+            return None
+
+        results = self.cache.get(key)
+        if results is None:
+            results = queryset.fetch_results()
+            self.cache.set(key, results, self.timeout if timeout is None else timeout)
+        return results
+
+
+class DomainIndexNode(object):
+    __slots__ = ('children', 'exact', 'wildcard')
+
+    def __init__(self):
+        self.children = {}
+        self.exact = {}
+        self.wildcard = {}
+
+
+class DomainIndex(object):
+    """
+    Trie of domain labels, from the top level domain down, mapping the
+    domains of every ``TenantSite`` to its tenant slug. Besides exact hosts,
+    domains can be ``*.example.com`` patterns, matching any subdomain of
+    ``example.com``. Domains without a port match the host on any port.
+    Exact domains take precedence over patterns, and longer patterns over
+    shorter ones.
+    """
+
+    def __init__(self, domains=(), timeout=None):
+        self._root = DomainIndexNode()
+        for domain, slug in domains:
+            self.add(domain, slug)
+
+        self.expires_at = None
+        if timeout is not None:
+            self.expires_at = time.time() + timeout
+
+    @staticmethod
+    def split_host(host):
+        host = normalize_host(host)
+        port = None
+        if ':' in host and not host.endswith(']'):
+            host, port = host.rsplit(':', 1)
+        return host.rstrip('.'), port
+
+    @staticmethod
+    def get_for_port(entries, port):
+        return entries.get(port, entries.get(None))
+
+    def is_expired(self):
+        return self.expires_at is not None and self.expires_at <= time.time()
+
+    def add(self, domain, slug):
+        hostname, port = self.split_host(domain)
+        labels = hostname.split('.')
+        is_pattern = labels[0] == '*'
+        if is_pattern:
+            labels = labels[1:]
+
+        node = self._root
+        for label in reversed(labels):
+            node = node.children.setdefault(label, DomainIndexNode())
+
+        if is_pattern:
+            node.wildcard[port] = slug
+        else:
+            node.exact[port] = slug
+
+    def lookup(self, host):
+        hostname, port = self.split_host(host)
+        slug = None
+
+        node = self._root
+        for label in reversed(hostname.split('.')):
+            slug = self.get_for_port(node.wildcard, port) or slug
+            node = node.children.get(label)
+            if node is None:
+                return slug
+
+        return self.get_for_port(node.exact, port) or slug
+
+
+_domain_cache = None
+_domain_index = None
+_tenant_cache = None
+_miss_cache = None
+_primary_pins = None
+_default_tenant_cache = None
+_query_cache = None
+
+
+def get_domain_cache():
+    global _domain_cache
+    if _domain_cache is None:
+        _domain_cache = LRUCache(max_size=get_setting('DOMAIN_CACHE_MAX_SIZE'),
+                                 timeout=get_setting('DOMAIN_CACHE_TIMEOUT'))
+    return _domain_cache
+
+
+def get_tenant_generation(slug):
+    """
+    Returns the generation of the tenant in the shared tenant cache, which
+    validates the entries of the per-process domain cache, or ``None`` when
+    the shared cache is disabled.
+    """
+    tenant_cache = get_tenant_cache()
+    if tenant_cache.alias is None:
+        return None
+    return tenant_cache.get_generation(slug)
+
+
+def clear_domain_cache(*args, **kwargs):
+    get_domain_cache().clear()
+
+
+def get_domain_index():
+    global _domain_index
+    if _domain_index is None or _domain_index.is_expired():
+        from shared_schema_tenants.models import TenantSite
+        _domain_index = DomainIndex(
+            TenantSite.original_manager.values_list('site__domain', 'tenant_id'),
+            timeout=get_setting('DOMAIN_INDEX_TIMEOUT'))
+    return _domain_index
+
+
+def clear_domain_index(*args, **kwargs):
+    global _domain_index
+    _domain_index = None
+
+
+def get_miss_cache():
+    global _miss_cache
+    if _miss_cache is None:
+        _miss_cache = MissCache(max_size=get_setting('MISS_CACHE_MAX_SIZE'),
+                                timeout=get_setting('MISS_CACHE_TIMEOUT'),
+                                flood_max_misses=get_setting('MISS_FLOOD_MAX_MISSES'),
+                                flood_window=get_setting('MISS_FLOOD_WINDOW'))
+    return _miss_cache
+
+
+def clear_miss_cache(*args, **kwargs):
+    get_miss_cache().clear()
+
+
+def get_tenant_cache():
+    global _tenant_cache
+    if _tenant_cache is None:
+        _tenant_cache = TenantCache(alias=get_setting('TENANT_CACHE_ALIAS'),
+                                    timeout=get_setting('TENANT_CACHE_TIMEOUT'))
+    return _tenant_cache
+
+
+def get_default_tenant_pk():
+    """
+    Returns the primary key of the ``DEFAULT_TENANT_SLUG`` tenant, or
+    ``None`` if it doesn't exist, querying it at most once every
+    ``TENANT_CACHE_TIMEOUT`` seconds or after tenants change.
+    """
+    global _default_tenant_cache
+    if _default_tenant_cache is None:
+        _default_tenant_cache = LRUCache(max_size=1, timeout=get_setting('TENANT_CACHE_TIMEOUT'))
+
+    slug = get_setting('DEFAULT_TENANT_SLUG')
+    entry = _default_tenant_cache.get(slug)
+    if entry is None:
+        from shared_schema_tenants.models import Tenant
+        entry = (Tenant.objects.filter(slug=slug).values_list('pk', flat=True).first(),)
+        _default_tenant_cache.set(slug, entry)
+    return entry[0]
+
+
+def clear_default_tenant_cache(*args, **kwargs):
+    if _default_tenant_cache is not None:
+        _default_tenant_cache.clear()
+
+
+def get_primary_pins():
+    global _primary_pins
+    if _primary_pins is None:
+        _primary_pins = PrimaryPins(alias=get_setting('TENANT_CACHE_ALIAS'),
+                                    timeout=get_setting('TENANT_PRIMARY_PIN_TIMEOUT'))
+    return _primary_pins
+
+
+def get_query_cache():
+    global _query_cache
+    if _query_cache is None:
+        _query_cache = QueryCache(alias=get_setting('TENANT_CACHE_ALIAS') if get_setting('QUERY_CACHE') else None,
+                                  timeout=get_setting('QUERY_CACHE_TIMEOUT'))
+    return _query_cache
+
+
+def pin_tenant_to_primary(tenant_pk, using=None):
+    """
+    Pins the tenant to its primary database once the transaction of the
+    ``using`` database commits, or right away outside transactions, so the
+    pin lasts ``TENANT_PRIMARY_PIN_TIMEOUT`` seconds after the write is
+    visible.
+    """
+    if tenant_pk is None or not get_setting('TENANT_READ_REPLICAS'):
+        return
+    transaction.on_commit(lambda: get_primary_pins().pin(tenant_pk), using=using)
+
+
+def pin_written_tenant(sender, instance, *args, **kwargs):
+    from shared_schema_tenants.mixins import SingleTenantModelMixin
+    if isinstance(instance, SingleTenantModelMixin):
+        pin_tenant_to_primary(instance.tenant_id, using=kwargs.get('using'))
+
+
+def invalidate_query_cache(sender, instance, *args, **kwargs):
+    from shared_schema_tenants.mixins import SingleTenantModelMixin, MultipleTenantsModelMixin
+    if isinstance(instance, SingleTenantModelMixin):
+        get_query_cache().invalidate(sender, instance.tenant_id, using=kwargs.get('using'))
+    elif isinstance(instance, MultipleTenantsModelMixin):
+        get_query_cache().invalidate(sender, None, using=kwargs.get('using'))
+
+
+def invalidate_m2m_query_cache(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    Bumps the generations of both models of a many to many relation. The
+    tenant of the rows on the other side isn't loaded, so it's assumed to be
+    the current tenant.
+    """
+    from shared_schema_tenants.helpers.tenants import get_current_tenant, get_tenant_pk
+    from shared_schema_tenants.mixins import SingleTenantModelMixin, MultipleTenantsModelMixin
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    invalidate_query_cache(instance.__class__, instance, **kwargs)
+    if issubclass(model, (SingleTenantModelMixin, MultipleTenantsModelMixin)):
+        get_query_cache().invalidate(model, get_tenant_pk(get_current_tenant()), using=kwargs.get('using'))
+
+
+def remember_site_tenant(sender, instance, *args, **kwargs):
+    """
+    Records the tenant a ``TenantSite`` belonged to before it's saved, so
+    moving the site to another tenant also invalidates the entries of the
+    previous tenant.
+    """
+    from shared_schema_tenants.models import TenantSite
+
+    instance._previous_tenant_id = None
+    if instance.pk is not None:
+        instance._previous_tenant_id = TenantSite.original_manager.using(kwargs.get('using')).filter(
+            pk=instance.pk).values_list('tenant_id', flat=True).first()
+
+
+def invalidate_tenant_cache(sender, instance, *args, **kwargs):
+    from shared_schema_tenants.models import Tenant, TenantSite
+
+    if isinstance(instance, Tenant):
+        slugs = [instance.pk]
+    elif isinstance(instance, TenantSite):
+        slugs = [instance.tenant_id]
+        previous_tenant_id = getattr(instance, '_previous_tenant_id', None)
+        if previous_tenant_id not in (None, instance.tenant_id):
+            slugs.append(previous_tenant_id)
+    else:
+        slugs = TenantSite.original_manager.filter(site=instance).values_list('tenant_id', flat=True)
+
+    for slug in slugs:
+        get_tenant_cache().invalidate(slug, using=kwargs.get('using'))
+
+
+def reset_caches(setting, *args, **kwargs):
+    global _domain_cache, _domain_index, _tenant_cache, _miss_cache, _primary_pins, _default_tenant_cache
+    global _query_cache
+    if setting == 'SHARED_SCHEMA_TENANTS':
+        _domain_cache = _domain_index = _tenant_cache = _miss_cache = _primary_pins = None
+        _default_tenant_cache = _query_cache = None
+
+
+setting_changed.connect(reset_caches)
+
+
+def normalize_host(host):
+    return host.lower().rstrip('.')
+
+
+def copy_tenant(tenant):
+    """
+    Returns a shallow copy of a cached tenant so changes made while handling
+    a request don't leak into the instances shared by the cache.
+    """
+    tenant_copy = copy.copy(tenant)
+    tenant_copy._state = copy.copy(tenant._state)
+    return tenant_copy
@@ -0,0 +1,100 @@
+from django.apps import apps
+from django.core import checks
+from django.core.exceptions import FieldDoesNotExist
+from django.utils import six
+
+
+def get_lookup_fields(model):
+    """
+    Returns the fields tenant scoped queries of the model commonly filter or
+    sort by: the first ``Meta.ordering`` field, ``Meta.get_latest_by`` and
+    the fields with ``db_index=True``.
+    """
+    opts = model._meta
+    names = []
+    if opts.ordering and isinstance(opts.ordering[0], six.string_types) and opts.ordering[0] != '?':
+        names.append(opts.ordering[0].lstrip('-'))
+    if isinstance(opts.get_latest_by, six.string_types):
+        names.append(opts.get_latest_by.lstrip('-'))
+    names.extend(field.name for field in opts.local_fields if field.db_index and not field.is_relation)
+
+    lookup_fields = []
+    for name in names:
+        if '__' in name or name == 'pk':
+            continue
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if not field.primary_key and field.name != 'tenant' and field.name not in lookup_fields:
+            lookup_fields.append(field.name)
+    return lookup_fields
+
+
+def get_tenant_prefixed_fields(model):
+    opts = model._meta
+    fields_lists = [index.fields for index in opts.indexes]
+    fields_lists.extend(opts.index_together)
+    fields_lists.extend(opts.unique_together)
+
+    prefixed_fields = set()
+    for fields in fields_lists:
+        fields = [opts.get_field(name.lstrip('-')).name for name in fields]
+        if len(fields) > 1 and fields[0] == 'tenant':
+            prefixed_fields.add(fields[1])
+    return prefixed_fields
+
+
+def check_model_tenant_indexes(model):
+    errors = []
+    prefixed_fields = get_tenant_prefixed_fields(model)
+    for field_name in get_lookup_fields(model):
+        if field_name not in prefixed_fields:
+            errors.append(checks.Warning(
+                "%s is tenant scoped and commonly queried by '%s', "
+                "but has no index starting with ('tenant', '%s')." % (
+                    model._meta.label, field_name, field_name),
+                hint="Add ('%s',) to %s.tenant_indexes." % (field_name, model.__name__),
+                obj=model,
+                id='shared_schema_tenants.W001',
+            ))
+    return errors
+
+
+@checks.register(checks.Tags.models)
+def check_tenant_indexes(app_configs=None, **kwargs):
+    from shared_schema_tenants.mixins import SingleTenantModelMixin
+
+    if app_configs is None:
+        models = apps.get_models()
+    else:
+        models = [model for app_config in app_configs for model in app_config.get_models()]
+
+    errors = []
+    for model in models:
+        if issubclass(model, SingleTenantModelMixin) and not model._meta.proxy:
+            errors.extend(check_model_tenant_indexes(model))
+    return errors
+
+
+@checks.register()
+def check_tenant_databases(app_configs=None, **kwargs):
+    from django.conf import settings
+    from shared_schema_tenants.settings import get_settings
+
+    errors = []
+    default_engine = settings.DATABASES['default']['ENGINE']
+    for tenant_slug, alias in sorted(get_settings().TENANT_DATABASES.items()):
+        if alias not in settings.DATABASES:
+            errors.append(checks.Error(
+                "TENANT_DATABASES sends tenant '%s' to the unknown database '%s'." % (tenant_slug, alias),
+                id='shared_schema_tenants.E001',
+            ))
+        elif settings.DATABASES[alias]['ENGINE'] != default_engine:
+            errors.append(checks.Error(
+                "Database '%s' of tenant '%s' doesn't use the engine of the default database." % (
+                    alias, tenant_slug),
+                hint='The tenant tables are created with column types chosen for the default database.',
+                id='shared_schema_tenants.E002',
+            ))
+    return errors
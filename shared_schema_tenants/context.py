@@ -0,0 +1,44 @@
+import threading
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+
+class ThreadLocalToken(object):
+
+    def __init__(self, var, old_value):
+        self.var = var
+        self.old_value = old_value
+
+
+class ThreadLocalVar(object):
+    """
+    Replacement for ``contextvars.ContextVar`` on Python versions that don't
+    have it. The value is isolated per thread instead of per context.
+    """
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self.default)
+
+    def set(self, value):
+        token = ThreadLocalToken(self, self.get())
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        if token.var is not self:
+            raise ValueError('%r was created by a different variable' % token)
+        self._local.value = token.old_value
+
+
+if ContextVar is not None:
+    current_tenant = ContextVar('shared_schema_tenants_current_tenant', default=None)
+else:
+    current_tenant = ThreadLocalVar('shared_schema_tenants_current_tenant', default=None)
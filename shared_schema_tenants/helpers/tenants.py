@@ -1,27 +1,164 @@
+import copy
+
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import Group, Permission
-from django.db import transaction
+from django.core import signing
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils.functional import LazyObject, SimpleLazyObject, empty
 
 from shared_schema_tenants.settings import get_setting
+from shared_schema_tenants.context import current_tenant
+
+
+class LazyTenant(SimpleLazyObject):
+    """
+    Tenant handle that knows its slug before the tenant is loaded. Reading
+    ``slug`` or ``pk`` doesn't hit the database. Any other attribute loads the
+    tenant without its JSON columns, which are fetched on first access.
+    """
+
+    def __init__(self, slug, tenant=None, settings_version=None):
+        self.__dict__['_tenant_slug'] = slug
+        self.__dict__['_settings_version'] = settings_version
+        super(LazyTenant, self).__init__(self._load_tenant)
+        if tenant is not None:
+            self._wrapped = tenant
+
+    def _load_tenant(self):
+        from shared_schema_tenants.models import Tenant
+        from shared_schema_tenants.exceptions import TenantNotFoundError
+        tenant = Tenant.objects.defer(*Tenant.JSON_FIELDS).filter(slug=self._tenant_slug).first()
+        if (tenant is not None and self._settings_version is not None and
+                get_tenant_settings_version(tenant) != self._settings_version):
+            # the token was created before the tenant changed
+            raise TenantNotFoundError('The tenant token is outdated')
+        return tenant
+
+    @property
+    def is_loaded(self):
+        return self._wrapped is not empty
+
+    @property
+    def slug(self):
+        if self._wrapped is empty:
+            return self._tenant_slug
+        return self._wrapped.slug
+
+    @property
+    def pk(self):
+        if self._wrapped is empty:
+            return self._tenant_slug
+        return getattr(self._wrapped, 'pk', None)
+
+    @property
+    def settings_version(self):
+        if self._settings_version is not None:
+            return self._settings_version
+        return get_tenant_settings_version(self)
+
+    def __copy__(self):
+        if self._wrapped is empty:
+            return type(self)(self._tenant_slug, settings_version=self._settings_version)
+        return copy.copy(self._wrapped)
+
+    def __deepcopy__(self, memo):
+        if self._wrapped is empty:
+            result = type(self)(self._tenant_slug, settings_version=self._settings_version)
+            memo[id(self)] = result
+            return result
+        return copy.deepcopy(self._wrapped, memo)
+
+
+TENANT_TOKEN_SALT = 'shared_schema_tenants.tenant_token'
+
+
+def get_tenant_settings_version(tenant):
+    return tenant.modified.isoformat()
+
+
+def create_tenant_token(tenant):
+    """
+    Returns a signed token carrying the tenant slug and the version of its
+    settings, used by ``retrieve_by_signed_token`` to set the tenant without
+    querying the database.
+    """
+    return signing.dumps({'slug': tenant.slug, 'version': get_tenant_settings_version(tenant)},
+                         salt=TENANT_TOKEN_SALT, compress=True)
+
+
+def load_tenant_token(token, max_age=None):
+    """
+    Returns a ``LazyTenant`` for the tenant in the token. Raises
+    ``django.core.signing.BadSignature`` if the token is invalid or expired.
+    The ``LazyTenant`` raises ``TenantNotFoundError`` when it's loaded if the
+    tenant changed after the token was created.
+    """
+    payload = signing.loads(token, salt=TENANT_TOKEN_SALT, max_age=max_age)
+    return LazyTenant(payload['slug'], settings_version=payload['version'])
+
+
+def get_tenant_pk(tenant):
+    """
+    Returns the primary key of the tenant, or ``None`` if there's no tenant.
+    Doesn't load the row of a ``LazyTenant``; other lazy objects, like
+    ``request.tenant``, are resolved.
+    """
+    while isinstance(tenant, LazyObject) and not isinstance(tenant, LazyTenant):
+        if tenant._wrapped is empty:
+            tenant._setup()
+        tenant = tenant._wrapped
+
+    if tenant is None:
+        return None
+    return getattr(tenant, 'pk', tenant)
 
 
 def get_current_tenant():
-    from shared_schema_tenants.middleware import TenantMiddleware
-    return TenantMiddleware.get_current_tenant()
+    return current_tenant.get()
 
 
 def set_current_tenant(tenant_slug):
-    from shared_schema_tenants.middleware import TenantMiddleware
-    return TenantMiddleware.set_tenant(tenant_slug)
-
-
-def clear_current_tenant():
-    from shared_schema_tenants.middleware import TenantMiddleware
-    return TenantMiddleware.clear_tenant()
+    """
+    Sets the tenant of the current context and returns a token that can be
+    passed to ``clear_current_tenant`` to restore the previous one. Accepts a
+    tenant slug or a ``Tenant`` instance.
+    """
+    from shared_schema_tenants.models import Tenant
+    if isinstance(tenant_slug, Tenant):
+        return current_tenant.set(LazyTenant(tenant_slug.pk, tenant=tenant_slug))
+    return current_tenant.set(LazyTenant(tenant_slug))
+
+
+def clear_current_tenant(token=None):
+    if token is not None:
+        current_tenant.reset(token)
+    else:
+        current_tenant.set(None)
+
+
+def set_database_tenant(tenant_pk, using=DEFAULT_DB_ALIAS):
+    """
+    Sets the ``app.current_tenant`` setting used by the row level security
+    policies of ``EnableTenantRowLevelSecurity`` on the database connection,
+    for the rest of its session. ``None`` resets it, so the connection isn't
+    restricted, like connections that never set it. Does nothing on
+    databases other than PostgreSQL.
+    """
+    from shared_schema_tenants.operations import CURRENT_TENANT_DB_SETTING
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+
+    with connection.cursor() as cursor:
+        if tenant_pk is None:
+            cursor.execute('RESET %s' % CURRENT_TENANT_DB_SETTING)
+        else:
+            cursor.execute('SELECT set_config(%s, %s, false)', [CURRENT_TENANT_DB_SETTING, tenant_pk])
 
 
 def create_tenant(name, slug, extra_data, domains=[], user=None):
     from shared_schema_tenants.models import Tenant
+    from shared_schema_tenants.partitioning import create_tenant_partitions
     with transaction.atomic():
         tenant = Tenant.objects.create(
             name=name, slug=slug, extra_data=extra_data)
@@ -35,6 +172,8 @@ def create_tenant(name, slug, extra_data, domains=[], user=None):
             rel = tenant.relationships.create(user=user)
             rel.groups.add(create_default_tenant_groups()[0])
 
+        create_tenant_partitions([tenant.pk])
+
         return tenant
 
 
@@ -0,0 +1,62 @@
+import os
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.migrations import Migration
+from django.db.migrations.autodetector import MigrationAutodetector
+from django.db.migrations.loader import MigrationLoader
+from django.db.migrations.writer import MigrationWriter
+from shared_schema_tenants.mixins import SingleTenantModelMixin
+
+
+class TenantMigrationCommand(BaseCommand):
+    """
+    Base of the commands that write a migration with an operation for each
+    tenant aware model of an app, after the latest migration of the app.
+    """
+    migration_name = None
+
+    def add_arguments(self, parser):
+        parser.add_argument('app_label')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                            help='Print the migration instead of writing it')
+
+    def get_operation(self, model):
+        raise NotImplementedError('subclasses of TenantMigrationCommand must provide a get_operation() method')
+
+    def handle(self, *args, **options):
+        app_label = options['app_label']
+        try:
+            app_config = apps.get_app_config(app_label)
+        except LookupError as e:
+            raise CommandError(str(e))
+
+        operations = [
+            self.get_operation(model) for model in app_config.get_models()
+            if issubclass(model, SingleTenantModelMixin) and not model._meta.proxy
+        ]
+        operations = [operation for operation in operations if operation is not None]
+        if not operations:
+            raise CommandError('%s has no models to migrate' % app_label)
+
+        loader = MigrationLoader(connections[DEFAULT_DB_ALIAS], ignore_no_migrations=True)
+        leaf_nodes = loader.graph.leaf_nodes(app_label)
+        number = 1
+        if leaf_nodes:
+            number = (MigrationAutodetector.parse_number(leaf_nodes[0][1]) or 0) + 1
+
+        migration = Migration('%04i_%s' % (number, self.migration_name), app_label)
+        migration.dependencies = leaf_nodes
+        migration.operations = operations
+        writer = MigrationWriter(migration)
+
+        if options['dry_run']:
+            self.stdout.write(writer.as_string())
+            return
+
+        with open(writer.path, 'w') as migration_file:
+            migration_file.write(writer.as_string())
+
+        self.stdout.write(self.style.SUCCESS(
+            'Successfully created migration %s' % os.path.relpath(writer.path)))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+from shared_schema_tenants.settings import get_setting
+from shared_schema_tenants.routing_table import build_routing_table
+
+
+class Command(BaseCommand):
+    help = 'Builds the memory mapped tenant routing table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='Where to write the routing table (ROUTING_TABLE_PATH by default)')
+
+    def handle(self, *args, **options):
+        path = options.get('path') or get_setting('ROUTING_TABLE_PATH')
+        if not path:
+            raise CommandError('Set ROUTING_TABLE_PATH or pass --path')
+
+        size = build_routing_table(path)
+
+        self.stdout.write(self.style.SUCCESS('Successfully built routing table %s with %d domains' % (path, size)))
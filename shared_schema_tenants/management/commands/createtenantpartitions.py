@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from shared_schema_tenants.partitioning import create_tenant_partitions
+
+
+class Command(BaseCommand):
+    help = 'Creates the missing tenant partitions of the tables partitioned by tenant list'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tenant', action='append', dest='tenants',
+                            help='Slug of the tenant (every tenant by default)')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        created = create_tenant_partitions(options['tenants'], using=options['database'])
+
+        self.stdout.write(self.style.SUCCESS('Successfully created %d partitions' % created))
@@ -0,0 +1,13 @@
+from shared_schema_tenants.management.base import TenantMigrationCommand
+from shared_schema_tenants.operations import PartitionByTenant
+
+
+class Command(TenantMigrationCommand):
+    help = 'Creates a migration partitioning by tenant the tables of the models of an app with tenant_partitioning'
+    migration_name = 'tenant_partitioning'
+
+    def get_operation(self, model):
+        if not model.tenant_partitioning:
+            return None
+        return PartitionByTenant(model._meta.model_name, model.tenant_partitioning,
+                                 model.tenant_hash_partitions if model.tenant_partitioning == 'hash' else None)
@@ -0,0 +1,10 @@
+from shared_schema_tenants.management.base import TenantMigrationCommand
+from shared_schema_tenants.operations import EnableTenantRowLevelSecurity
+
+
+class Command(TenantMigrationCommand):
+    help = 'Creates a migration enabling PostgreSQL row level security on the tenant aware models of an app'
+    migration_name = 'tenant_row_level_security'
+
+    def get_operation(self, model):
+        return EnableTenantRowLevelSecurity(model._meta.model_name)
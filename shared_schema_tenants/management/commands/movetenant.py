@@ -0,0 +1,156 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from shared_schema_tenants.models import Tenant
+from shared_schema_tenants.mixins import SingleTenantModelMixin, MultipleTenantsModelMixin
+from shared_schema_tenants.routers import get_tenant_database
+
+
+def get_tenant_models():
+    """
+    Returns the tenant aware models, each after the tenant aware models its
+    foreign keys and many to many fields point to.
+    """
+    models = [
+        model for model in apps.get_models()
+        if issubclass(model, (SingleTenantModelMixin, MultipleTenantsModelMixin)) and not model._meta.proxy
+    ]
+    dependencies = dict(
+        (model, set(
+            field.remote_field.model for field in list(model._meta.concrete_fields) + model._meta.local_many_to_many
+            if field.is_relation and field.remote_field.model in models and field.remote_field.model is not model))
+        for model in models)
+
+    sorted_models = []
+    while dependencies:
+        ready = [model for model, model_dependencies in dependencies.items()
+                 if not model_dependencies - set(sorted_models)]
+        if not ready:
+            # circular foreign keys, copied in any order
+            ready = list(dependencies)
+        for model in sorted(ready, key=lambda model: model._meta.label):
+            sorted_models.append(model)
+            del dependencies[model]
+    return sorted_models
+
+
+def is_shared(model):
+    return issubclass(model, MultipleTenantsModelMixin)
+
+
+class Command(BaseCommand):
+    help = 'Copies the rows of a tenant to another database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tenant', help='Slug of the tenant')
+        parser.add_argument('target', help='Alias of the database the tenant is copied to')
+        parser.add_argument(
+            '--source', help='Alias of the database the tenant is in (from TENANT_DATABASES by default)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--delete', action='store_true', help='Delete the rows from the source database')
+
+    def handle(self, *args, **options):
+        source = options['source'] or get_tenant_database(options['tenant']) or 'default'
+        target = options['target']
+        for alias in (source, target):
+            if alias not in connections:
+                raise CommandError('Unknown database %s' % alias)
+        if source == target:
+            raise CommandError('The tenant is already in %s' % target)
+
+        tenant = Tenant.objects.using(source).filter(slug=options['tenant']).first()
+        if tenant is None:
+            tenant = Tenant.objects.filter(slug=options['tenant']).first()
+        if tenant is None:
+            raise CommandError('Tenant %s not found' % options['tenant'])
+
+        models = get_tenant_models()
+        with transaction.atomic(using=target):
+            if not Tenant.objects.using(target).filter(pk=tenant.pk).exists():
+                tenant.save(using=target, force_insert=True)
+
+            for model in models:
+                copied = self.copy_rows(model, tenant, source, target, options['batch_size'])
+                self.stdout.write('Copied %d %s rows' % (copied, model._meta.label))
+
+            with connections[target].cursor() as cursor:
+                for sql in connections[target].ops.sequence_reset_sql(no_style(), models):
+                    cursor.execute(sql)
+
+        if options['delete']:
+            # rows of models with multiple tenants are still read from the
+            # source database, so they're kept there
+            with transaction.atomic(using=source):
+                for model in reversed(models):
+                    if not is_shared(model):
+                        model.original_manager.using(source).filter(tenant=tenant).delete()
+
+        self.stdout.write(self.style.SUCCESS(
+            'Successfully copied tenant %s from %s to %s. Add it to TENANT_DATABASES to route it there.' % (
+                tenant.slug, source, target)))
+
+    def copy_rows(self, model, tenant, source, target, batch_size):
+        """
+        Copies the rows of the tenant and their many to many links. Rows of
+        models with multiple tenants are copied with their link to this
+        tenant only, unless another tenant already copied them.
+        """
+        if is_shared(model):
+            queryset = model.original_manager.using(source).filter(tenants=tenant)
+        else:
+            queryset = model.original_manager.using(source).filter(tenant=tenant)
+        queryset = queryset.order_by('pk')
+
+        through_models = []
+        for field in model._meta.local_many_to_many:
+            if not field.remote_field.through._meta.auto_created:
+                continue
+            links_filter = {}
+            if is_shared(model) and field.name == 'tenants':
+                links_filter[field.m2m_reverse_field_name()] = tenant.pk
+            through_models.append((field.remote_field.through, field.m2m_field_name(),
+                                   field.m2m_reverse_field_name(), links_filter))
+
+        copied = 0
+        last_pk = None
+        while True:
+            batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            rows = list(batch[:batch_size])
+            if not rows:
+                return copied
+
+            pks = [row.pk for row in rows]
+            if is_shared(model):
+                existing = set(model.original_manager.using(target).filter(pk__in=pks).values_list('pk', flat=True))
+                rows = [row for row in rows if row.pk not in existing]
+            model.original_manager.using(target).bulk_create(rows)
+
+            for through, field_name, reverse_field_name, links_filter in through_models:
+                self.copy_links(through, field_name, reverse_field_name, links_filter, pks, source, target)
+
+            copied += len(rows)
+            last_pk = pks[-1]
+
+    def copy_links(self, through, field_name, reverse_field_name, links_filter, pks, source, target):
+        field_attname = through._meta.get_field(field_name).attname
+        reverse_field = through._meta.get_field(reverse_field_name)
+        links = list(through.objects.using(source).filter(**links_filter).filter(**{'%s__in' % field_name: pks}))
+
+        existing_links = set(through.objects.using(target).filter(**{
+            '%s__in' % field_name: pks}).values_list(field_attname, reverse_field.attname))
+        links = [link for link in links
+                 if (getattr(link, field_attname), getattr(link, reverse_field.attname)) not in existing_links]
+
+        remote_model = reverse_field.remote_field.model
+        if issubclass(remote_model, (SingleTenantModelMixin, MultipleTenantsModelMixin)):
+            # links to rows of other tenants, which weren't copied
+            copied_pks = set(remote_model.original_manager.using(target).filter(
+                pk__in=set(getattr(link, reverse_field.attname) for link in links)).values_list('pk', flat=True))
+            skipped = [link for link in links if getattr(link, reverse_field.attname) not in copied_pks]
+            if skipped:
+                self.stderr.write('Skipped %d %s links to rows of other tenants' % (
+                    len(skipped), through._meta.label))
+            links = [link for link in links if getattr(link, reverse_field.attname) in copied_pks]
+
+        through.objects.using(target).bulk_create(links)
@@ -1,34 +1,430 @@
-from django.db.models import Manager
-from shared_schema_tenants.helpers.tenants import get_current_tenant
+import itertools
+
+import django
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router, transaction
+from django.db.models import Case, F, Manager, Q, QuerySet, Value, When
+from django.db.models.query import ModelIterable
+from django.db.models.signals import m2m_changed
+from django.utils import six
+from django.utils.functional import LazyObject, empty
+from shared_schema_tenants.settings import get_setting
+from shared_schema_tenants.helpers.tenants import LazyTenant, get_current_tenant, get_tenant_pk
+from shared_schema_tenants.exceptions import TenantNotFoundError
+
+
+class TenantQuerySet(QuerySet):
+    """
+    Queryset over the rows of a tenant, returned by the tenant aware
+    managers, whose results can be cached with ``cached()``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TenantQuerySet, self).__init__(*args, **kwargs)
+        self.tenant_pk = None
+        self._cached = False
+        self._cache_timeout = None
+
+    def _clone(self, *args, **kwargs):
+        clone = super(TenantQuerySet, self)._clone(*args, **kwargs)
+        clone.tenant_pk = self.tenant_pk
+        clone._cached = self._cached
+        clone._cache_timeout = self._cache_timeout
+        return clone
+
+    def cached(self, timeout=None):
+        """
+        Returns a copy of the queryset whose results are read from the
+        ``TENANT_CACHE_ALIAS`` cache when it's evaluated, or stored there for
+        ``timeout`` seconds, ``QUERY_CACHE_TIMEOUT`` by default. Saving or
+        deleting a row of the model, or changing its many to many relations,
+        invalidates the cached results of its tenant.
+        """
+        clone = self._clone()
+        clone._cached = True
+        clone._cache_timeout = timeout
+        return clone
+
+    def fetch_results(self):
+        super(TenantQuerySet, self)._fetch_all()
+        return self._result_cache
+
+    def _fetch_all(self):
+        if self._cached and self._result_cache is None:
+            from shared_schema_tenants.cache import get_query_cache
+            results = get_query_cache().get_results(self, self.tenant_pk, self._cache_timeout)
+            if results is not None:
+                self._result_cache = results
+                self._prefetch_done = True
+                return
+        super(TenantQuerySet, self)._fetch_all()
+
+
+class TenantsQuerySet(QuerySet):
+    """
+    Queryset over the rows of several tenants, returned by ``for_tenants``.
+    Each row is annotated with the primary key of the tenant it was selected
+    for, so a row of a model with multiple tenants appears once per tenant.
+    """
+    tenant_annotation = '_for_tenant'
+
+    def __init__(self, *args, **kwargs):
+        super(TenantsQuerySet, self).__init__(*args, **kwargs)
+        self._tenants = {}
+
+    def _clone(self, *args, **kwargs):
+        clone = super(TenantsQuerySet, self)._clone(*args, **kwargs)
+        clone._tenants = self._tenants
+        return clone
+
+    def load_tenants(self):
+        from shared_schema_tenants.models import Tenant
+        missing = [pk for pk, tenant in self._tenants.items() if tenant is None]
+        if missing:
+            self._tenants.update(Tenant.objects.in_bulk(missing))
+        return self._tenants
+
+    def by_tenant(self, chunk_size=2000):
+        """
+        Yields ``(tenant, rows)`` for each tenant with rows, from a single
+        query streamed with ``iterator()``, which uses a server side cursor
+        on PostgreSQL. ``rows`` is an iterator that must be consumed before
+        moving to the next tenant. The tenants are loaded in one query.
+        """
+        tenants = self.load_tenants()
+        ordering = self.query.order_by or self.model._meta.ordering
+        queryset = self.order_by(self.tenant_annotation, *ordering)
+        if hasattr(self.model, 'tenant'):
+            tenant_field = self.model._meta.get_field('tenant')
+            known_related_objects = dict(queryset._known_related_objects)
+            known_related_objects[tenant_field] = dict(
+                (pk, tenant) for pk, tenant in tenants.items() if tenant is not None)
+            queryset._known_related_objects = known_related_objects
+
+        rows = queryset.iterator(chunk_size) if django.VERSION >= (2, 0) else queryset.iterator()
+        for tenant_pk, tenant_rows in itertools.groupby(rows, lambda row: getattr(row, self.tenant_annotation)):
+            yield tenants.get(tenant_pk), tenant_rows
+
+
+def get_tenants_by_pk(tenants):
+    tenants_by_pk = {}
+    for tenant in tenants:
+        tenant_pk = get_tenant_pk(tenant)
+        if tenant_pk is None:
+            continue
+        if isinstance(tenant, LazyObject):
+            tenant = tenant._wrapped if tenant._wrapped is not empty else None
+        tenants_by_pk[tenant_pk] = None if isinstance(tenant, six.string_types) else tenant
+    return tenants_by_pk
 
 
 class SingleTenantModelManager(Manager):
+    _queryset_class = TenantQuerySet
 
     def get_original_queryset(self, *args, **kwargs):
         return super(SingleTenantModelManager, self).get_queryset(*args, **kwargs)
 
     def get_queryset(self, tenant=None, *args, **kwargs):
-        if not tenant:
+        if tenant is None:
             tenant = get_current_tenant()
-            if tenant:
-                return super(SingleTenantModelManager, self).get_queryset(*args, **kwargs).filter(tenant=tenant)
-            else:
-                return super(SingleTenantModelManager, self).get_queryset(*args, **kwargs).none()
+
+        tenant_pk = get_tenant_pk(tenant)
+        if tenant_pk is not None:
+            queryset = self.attach_tenant(
+                super(SingleTenantModelManager, self).get_queryset(*args, **kwargs).filter(tenant_id=tenant_pk),
+                tenant)
+            queryset.tenant_pk = tenant_pk
+            return queryset
         else:
-            return super(SingleTenantModelManager, self).get_queryset(*args, **kwargs).filter(tenant=tenant)
+            return super(SingleTenantModelManager, self).get_queryset(*args, **kwargs).none()
+
+    def cached(self, timeout=None):
+        return self.get_queryset().cached(timeout)
+
+    def attach_tenant(self, queryset, tenant):
+        """
+        Sets the tenant instance on every row loaded by the queryset, like
+        Django does for querysets of related managers, so ``obj.tenant``
+        doesn't query the tenant again. A ``LazyTenant`` that wasn't loaded
+        yet is loaded once, when the first row is.
+        """
+        while isinstance(tenant, LazyObject) and tenant._wrapped is not empty:
+            tenant = tenant._wrapped
+
+        tenant_field = self.model._meta.get_field('tenant')
+        if isinstance(tenant, LazyTenant) or isinstance(tenant, tenant_field.remote_field.model):
+            known_related_objects = dict(queryset._known_related_objects)
+            known_related_objects[tenant_field] = {tenant.pk: tenant}
+            queryset._known_related_objects = known_related_objects
+        return queryset
+
+    def stamp_tenant(self, objs, tenant=None):
+        """
+        Sets the tenant, the current one by default, on the objects without
+        one, or with the one set by the ``tenant`` default, and returns its
+        primary key. Raises ``TenantNotFoundError`` if there's no tenant and
+        ``ValueError`` if an object was given another tenant.
+        """
+        if tenant is None:
+            tenant = get_current_tenant()
+        tenant_pk = get_tenant_pk(tenant)
+        if tenant_pk is None:
+            raise TenantNotFoundError()
+
+        attname = self.model._meta.get_field('tenant').attname
+        for obj in objs:
+            obj_tenant_pk = getattr(obj, attname)
+            if obj_tenant_pk is None or (obj_tenant_pk != tenant_pk and obj.has_default_tenant()):
+                setattr(obj, attname, tenant_pk)
+            elif obj_tenant_pk != tenant_pk:
+                raise ValueError('%r belongs to tenant %s, not %s' % (obj, obj_tenant_pk, tenant_pk))
+        return tenant_pk
+
+    def bulk_create(self, objs, batch_size=None, tenant=None, **kwargs):
+        """
+        Inserts the objects in batches, like ``QuerySet.bulk_create``, after
+        stamping them with the tenant.
+        """
+        from shared_schema_tenants.cache import get_query_cache, pin_tenant_to_primary
+        objs = list(objs)
+        tenant_pk = self.stamp_tenant(objs, tenant)
+        queryset = self.get_original_queryset()
+        objs = queryset.bulk_create(objs, batch_size=batch_size, **kwargs)
+        get_query_cache().invalidate(self.model, tenant_pk, using=queryset.db)
+        pin_tenant_to_primary(tenant_pk, using=queryset.db)
+        return objs
+
+    def bulk_update(self, objs, fields, batch_size=None, tenant=None):
+        """
+        Saves the ``fields`` of the objects of the tenant with one ``UPDATE``
+        per batch, restricted to the rows of the tenant. Returns the number of
+        updated rows.
+        """
+        from shared_schema_tenants.cache import get_query_cache, pin_tenant_to_primary
+        objs = list(objs)
+        if not objs:
+            return 0
+        tenant_pk = self.stamp_tenant(objs, tenant)
+        db = self._db or router.db_for_write(self.model)
+        queryset = self.get_original_queryset().using(db).filter(tenant_id=tenant_pk)
+        if django.VERSION >= (2, 2):
+            updated = queryset.bulk_update(objs, fields, batch_size=batch_size)
+            get_query_cache().invalidate(self.model, tenant_pk, using=db)
+            pin_tenant_to_primary(tenant_pk, using=db)
+            return updated
+
+        fields = [self.model._meta.get_field(name) for name in fields]
+        batch_size = batch_size or connections[db].ops.bulk_batch_size(['pk', 'pk'] + fields, objs) or len(objs)
+
+        updated = 0
+        with transaction.atomic(using=db, savepoint=False):
+            for start in range(0, len(objs), batch_size):
+                batch = objs[start:start + batch_size]
+                updated += queryset.filter(pk__in=[obj.pk for obj in batch]).update(**dict(
+                    (field.attname, Case(*[
+                        When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field))
+                        for obj in batch
+                    ], output_field=field))
+                    for field in fields))
+        get_query_cache().invalidate(self.model, tenant_pk, using=db)
+        pin_tenant_to_primary(tenant_pk, using=db)
+        return updated
+
+    def update_or_create_many(self, objs, lookup_fields, update_fields=None, batch_size=None, tenant=None):
+        """
+        Updates the rows of the tenant matching the ``lookup_fields`` of the
+        objects and creates the others, with one query to find the existing
+        rows and batched updates and inserts. By default every field but the
+        primary key, the tenant and the lookup fields is updated. Returns the
+        created and the updated objects.
+        """
+        objs = list(objs)
+        tenant_pk = self.stamp_tenant(objs, tenant)
+        opts = self.model._meta
+        lookup_attnames = [opts.get_field(name).attname for name in lookup_fields]
+        if update_fields is None:
+            update_fields = [
+                field.name for field in opts.concrete_fields
+                if not field.primary_key and field.name != 'tenant' and field.attname not in lookup_attnames]
+
+        existing = {}
+        if objs:
+            if len(lookup_attnames) == 1:
+                condition = Q(**{'%s__in' % lookup_attnames[0]: set(getattr(obj, lookup_attnames[0]) for obj in objs)})
+            else:
+                condition = Q()
+                for obj in objs:
+                    condition |= Q(**dict((attname, getattr(obj, attname)) for attname in lookup_attnames))
+            for row in self.get_original_queryset().filter(condition, tenant_id=tenant_pk).values_list(
+                    'pk', *lookup_attnames):
+                existing[tuple(row[1:])] = row[0]
+
+        created, updated = [], []
+        for obj in objs:
+            pk = existing.get(tuple(getattr(obj, attname) for attname in lookup_attnames))
+            if pk is None:
+                created.append(obj)
+            else:
+                obj.pk = pk
+                updated.append(obj)
+
+        with transaction.atomic(using=self._db or router.db_for_write(self.model), savepoint=False):
+            if updated and update_fields:
+                self.bulk_update(updated, update_fields, batch_size=batch_size, tenant=tenant_pk)
+            if created:
+                self.bulk_create(created, batch_size=batch_size, tenant=tenant_pk)
+        return created, updated
+
+    def for_tenants(self, tenants):
+        """
+        Returns a ``TenantsQuerySet`` with the rows of all the given tenants
+        (slugs or ``Tenant`` instances), to run a query once for many tenants
+        instead of once per tenant. Use ``by_tenant()`` to iterate the rows
+        grouped by tenant.
+        """
+        tenants_by_pk = get_tenants_by_pk(tenants)
+        queryset = TenantsQuerySet(self.model, using=self._db, hints=self._hints)
+        queryset = queryset.filter(tenant_id__in=list(tenants_by_pk)).annotate(
+            **{TenantsQuerySet.tenant_annotation: F('tenant')})
+        queryset._tenants = tenants_by_pk
+        return queryset
+
+
+class LinkedTenantModelIterable(ModelIterable):
+    """
+    Records on each row the tenant the queryset was filtered by, so saving
+    the row doesn't link it to the tenant again.
+    """
+
+    def __iter__(self):
+        tenant_pk = self.queryset.tenant_pk
+        for obj in super(LinkedTenantModelIterable, self).__iter__():
+            obj._linked_tenant_pks = set([tenant_pk])
+            yield obj
 
 
 class MultipleTenantModelManager(Manager):
+    _queryset_class = TenantQuerySet
 
     def get_original_queryset(self, *args, **kwargs):
         return super(MultipleTenantModelManager, self).get_queryset(*args, **kwargs)
 
     def get_queryset(self, tenant=None, *args, **kwargs):
-        if not tenant:
+        if tenant is None:
             tenant = get_current_tenant()
-            if tenant:
-                return super(MultipleTenantModelManager, self).get_queryset(*args, **kwargs).filter(tenants=tenant)
-            else:
-                return super(MultipleTenantModelManager, self).get_queryset(*args, **kwargs).none()
+
+        tenant_pk = get_tenant_pk(tenant)
+        if tenant_pk is not None:
+            queryset = self.filter_by_tenant(
+                super(MultipleTenantModelManager, self).get_queryset(*args, **kwargs), tenant_pk)
+            queryset.tenant_pk = tenant_pk
+            queryset._iterable_class = LinkedTenantModelIterable
+            return queryset
         else:
-            return super(MultipleTenantModelManager, self).get_queryset(*args, **kwargs).filter(tenants=tenant)
+            return super(MultipleTenantModelManager, self).get_queryset(*args, **kwargs).none()
+
+    def cached(self, timeout=None):
+        return self.get_queryset().cached(timeout)
+
+    def for_tenants(self, tenants):
+        """
+        Returns a ``TenantsQuerySet`` with the rows of any of the given
+        tenants (slugs or ``Tenant`` instances), joining the ``tenants``
+        table once. Use ``by_tenant()`` to iterate the rows grouped by tenant;
+        rows shared by several of the tenants are yielded for each of them.
+        """
+        tenants_by_pk = get_tenants_by_pk(tenants)
+        queryset = TenantsQuerySet(self.model, using=self._db, hints=self._hints)
+        queryset = queryset.filter(tenants__in=list(tenants_by_pk)).annotate(
+            **{TenantsQuerySet.tenant_annotation: F('tenants')})
+        queryset._tenants = tenants_by_pk
+        return queryset
+
+    def filter_by_tenant(self, queryset, tenant_pk, strategy=None):
+        """
+        Filters the queryset by tenant using one of the strategies:
+
+        - ``'join'``: joins the ``tenants`` table;
+        - ``'exists'``: correlated ``EXISTS`` subquery on the ``tenants``
+          table, which doesn't duplicate rows when combined with other joins.
+          Django versions before 3.0 can't filter by ``EXISTS``, so the
+          subquery is written as ``pk IN (...)``, which databases also plan
+          as a semi join;
+        - ``'denormalized'``: filters the ``tenant_slugs`` column of
+          ``DenormalizedTenantsModelMixin`` models.
+
+        Uses the model ``tenants_filter_strategy`` attribute or the
+        ``MULTIPLE_TENANTS_FILTER_STRATEGY`` setting by default.
+        """
+        if strategy is None:
+            strategy = (getattr(self.model, 'tenants_filter_strategy', None) or
+                        get_setting('MULTIPLE_TENANTS_FILTER_STRATEGY'))
+
+        if strategy == 'join':
+            return queryset.filter(tenants=tenant_pk)
+        elif strategy == 'exists':
+            tenants_field = self.model._meta.get_field('tenants')
+            tenant_rows = tenants_field.remote_field.through._default_manager.filter(**{
+                tenants_field.m2m_reverse_field_name(): tenant_pk})
+
+            if django.VERSION < (3, 0):
+                return queryset.filter(pk__in=tenant_rows.values(tenants_field.m2m_field_name()))
+
+            from django.db.models import Exists, OuterRef
+            return queryset.filter(Exists(tenant_rows.filter(**{tenants_field.m2m_field_name(): OuterRef('pk')})))
+        elif strategy == 'denormalized':
+            return queryset.filter(**self.model.get_tenant_slugs_lookup(tenant_pk, using=queryset.db))
+
+        raise ImproperlyConfigured('Unknown tenants filter strategy %r' % strategy)
+
+    def link_tenants(self, objs, tenants=None, batch_size=None):
+        """
+        Links the saved objects to the tenants (slugs or ``Tenant``
+        instances), the current one by default, with one query for the
+        existing links and batched inserts into the ``tenants`` through table
+        for the missing ones. Sends ``m2m_changed`` for the objects that got
+        new tenants. Returns the number of links created.
+        """
+        if tenants is None:
+            tenants = [get_current_tenant()]
+        tenant_pks = set(get_tenant_pk(tenant) for tenant in tenants) - set([None])
+        if not tenant_pks:
+            raise TenantNotFoundError()
+
+        objs = list(objs)
+        tenants_field = self.model._meta.get_field('tenants')
+        through = tenants_field.remote_field.through
+        source_name, target_name = tenants_field.m2m_field_name(), tenants_field.m2m_reverse_field_name()
+        source_attname = through._meta.get_field(source_name).attname
+        target_attname = through._meta.get_field(target_name).attname
+        db = self._db or router.db_for_write(through)
+
+        with transaction.atomic(using=db, savepoint=False):
+            existing = set(through._default_manager.using(db).filter(**{
+                '%s__in' % source_name: [obj.pk for obj in objs],
+                '%s__in' % target_name: tenant_pks,
+            }).values_list(source_attname, target_attname))
+
+            added = {}
+            links = []
+            for obj in objs:
+                for tenant_pk in sorted(tenant_pks):
+                    if (obj.pk, tenant_pk) not in existing:
+                        added.setdefault(obj, set()).add(tenant_pk)
+                        existing.add((obj.pk, tenant_pk))
+                        links.append(through(**{source_attname: obj.pk, target_attname: tenant_pk}))
+
+            for obj, pk_set in added.items():
+                m2m_changed.send(sender=through, action='pre_add', instance=obj, reverse=False,
+                                 model=tenants_field.remote_field.model, pk_set=pk_set, using=db)
+
+            kwargs = {'ignore_conflicts': True} if django.VERSION >= (2, 2) else {}
+            through._default_manager.using(db).bulk_create(links, batch_size=batch_size, **kwargs)
+
+            for obj, pk_set in added.items():
+                m2m_changed.send(sender=through, action='post_add', instance=obj, reverse=False,
+                                 model=tenants_field.remote_field.model, pk_set=pk_set, using=db)
+
+        for obj in objs:
+            obj._linked_tenant_pks = getattr(obj, '_linked_tenant_pks', set()) | tenant_pks
+        return len(links)
@@ -1,90 +1,196 @@
-import platform
+import sys
+from django.conf import settings
+from django.core.signals import setting_changed
 from django.utils.functional import SimpleLazyObject
-from shared_schema_tenants.settings import get_setting
-from shared_schema_tenants.models import Tenant
+from shared_schema_tenants.settings import get_settings
+from shared_schema_tenants.context import current_tenant
+from shared_schema_tenants.tenant_retrievers import TENANT_COOKIE_SALT, persist_tenant
 from shared_schema_tenants.utils import import_from_string
 
-
-if platform.python_version_tuple()[0] == '2':
-    import thread as threading
+if sys.version_info >= (3, 5):
+    from shared_schema_tenants.async_middleware import AsyncMiddlewareMixin
 else:
-    import threading
+    class AsyncMiddlewareMixin(object):
+        is_async = False
+
+        def init_async_mode(self):
+            pass
+
+
+class RetrieverStage(object):
+    """
+    Tenant retriever of the pipeline, imported once. Retrievers can declare a
+    cheap ``precondition(request)`` and are skipped when it returns ``False``.
+    Counts how many times the stage was skipped, called and found the tenant.
+    Counters aren't locked, so they can lose a few updates under concurrency.
+    """
+
+    def __init__(self, retriever_path):
+        self.retriever_path = retriever_path
+        self.retriever = import_from_string(retriever_path)
+        self.precondition = getattr(self.retriever, 'precondition', None)
+        self.async_retriever_path = getattr(self.retriever, 'async_variant', None)
+        self._async_retriever = None
+        self.skipped = 0
+        self.calls = 0
+        self.hits = 0
+
+    def __call__(self, request):
+        if self.precondition is not None and not self.precondition(request):
+            self.skipped += 1
+            return None
+
+        self.calls += 1
+        tenant = self.retriever(request)
+        if tenant is not None:
+            self.hits += 1
+        return tenant
+
+    def get_async_retriever(self):
+        if self._async_retriever is None and self.async_retriever_path:
+            self._async_retriever = import_from_string(self.async_retriever_path)
+        return self._async_retriever
+
+    def get_stats(self):
+        return {
+            'retriever': self.retriever_path,
+            'skipped': self.skipped,
+            'calls': self.calls,
+            'hits': self.hits,
+            'hit_rate': float(self.hits) / self.calls if self.calls else 0.0,
+        }
+
+
+_retriever_pipeline = None
+
+
+def get_retriever_pipeline():
+    global _retriever_pipeline
+    if _retriever_pipeline is None:
+        _retriever_pipeline = tuple(
+            RetrieverStage(retriever_path)
+            for retriever_path in get_settings().TENANT_RETRIEVERS)
+    return _retriever_pipeline
+
 
+def get_retriever_stats():
+    return [stage.get_stats() for stage in get_retriever_pipeline()]
 
-def get_tenant(request):
+
+def reset_retriever_pipeline(setting, *args, **kwargs):
+    global _retriever_pipeline
+    if setting == 'SHARED_SCHEMA_TENANTS':
+        _retriever_pipeline = None
+
+
+setting_changed.connect(reset_retriever_pipeline)
+
+
+def get_tenant(request, retriever_pipeline=None):
     if not hasattr(request, '_cached_tenant'):
-        tenant_retrievers = get_setting('TENANT_RETRIEVERS')
+        if retriever_pipeline is None:
+            retriever_pipeline = get_retriever_pipeline()
 
-        for tenant_retriever in tenant_retrievers:
-            tenant = import_from_string(tenant_retriever)(request)
-            if tenant:
+        for retriever_stage in retriever_pipeline:
+            tenant = retriever_stage(request)
+            if tenant is not None:
                 request._cached_tenant = tenant
                 break
 
-        if not getattr(request, '_cached_tenant', False):
-            lazy_tenant = TenantMiddleware.get_current_tenant()
-            if not lazy_tenant:
+        if not hasattr(request, '_cached_tenant'):
+            lazy_tenant = current_tenant.get()
+            if lazy_tenant is getattr(request, 'tenant', None) or not lazy_tenant:
                 return None
 
-            lazy_tenant._setup()
-            request._cached_tenant = lazy_tenant._wrapped
+            request._cached_tenant = getattr(lazy_tenant, '_wrapped', lazy_tenant)
 
-        elif get_setting('ADD_TENANT_TO_SESSION'):
-            try:
-                request.session['tenant_slug'] = request._cached_tenant.slug
-            except AttributeError:
-                pass
+        elif get_settings().ADD_TENANT_TO_SESSION:
+            persist_tenant(request, request._cached_tenant)
 
     return request._cached_tenant
 
 
-class TenantMiddleware(object):
-    _threadmap = {}
+def set_tenant_cookie(request, response):
+    slug = request.__dict__.pop('_tenant_cookie_slug', None)
+    if slug is not None:
+        response.set_signed_cookie(
+            get_settings().TENANT_COOKIE_NAME, slug, salt=TENANT_COOKIE_SALT,
+            max_age=get_settings().TENANT_COOKIE_MAX_AGE, domain=settings.SESSION_COOKIE_DOMAIN,
+            secure=settings.SESSION_COOKIE_SECURE or None, httponly=True)
+
+
+class TenantMiddleware(AsyncMiddlewareMixin):
+    sync_capable = True
+    async_capable = True
 
     def __init__(self, get_response):
         self.get_response = get_response
-        # One-time configuration and initialization.
+        self.retriever_pipeline = get_retriever_pipeline()
+        self.init_async_mode()
 
     @classmethod
     def get_current_tenant(cls):
-        try:
-            return cls._threadmap[threading.get_ident()]
-        except KeyError:
-            return None
+        from shared_schema_tenants.helpers.tenants import get_current_tenant
+        return get_current_tenant()
 
     @classmethod
     def set_tenant(cls, tenant_slug):
-        cls._threadmap[threading.get_ident()] = SimpleLazyObject(
-            lambda: Tenant.objects.filter(slug=tenant_slug).first())
+        from shared_schema_tenants.helpers.tenants import set_current_tenant
+        return set_current_tenant(tenant_slug)
 
     @classmethod
-    def clear_tenant(cls):
-        del cls._threadmap[threading.get_ident()]
+    def clear_tenant(cls, token=None):
+        from shared_schema_tenants.helpers.tenants import clear_current_tenant
+        return clear_current_tenant(token)
 
     def process_request(self, request):
-        request.tenant = SimpleLazyObject(lambda: get_tenant(request))
-        self._threadmap[threading.get_ident()] = request.tenant
+        request.tenant = SimpleLazyObject(lambda: get_tenant(request, self.retriever_pipeline))
+        request._tenant_context_token = current_tenant.set(request.tenant)
+        self.set_database_tenant(request)
 
         return request
 
+    def set_database_tenant(self, request):
+        if get_settings().ROW_LEVEL_SECURITY:
+            from shared_schema_tenants.helpers.tenants import set_database_tenant, get_tenant_pk
+            from shared_schema_tenants.routers import get_tenant_database_aliases
+            tenant_pk = get_tenant_pk(request.tenant)
+            aliases = get_tenant_database_aliases(tenant_pk)
+            for alias in aliases:
+                set_database_tenant(tenant_pk, using=alias)
+            request._database_tenant_set = aliases
+
+    def reset_database_tenant(self, request):
+        aliases = request.__dict__.pop('_database_tenant_set', None)
+        if aliases:
+            from shared_schema_tenants.helpers.tenants import set_database_tenant
+            for alias in aliases:
+                set_database_tenant(None, using=alias)
+
+    def reset_tenant(self, request):
+        self.reset_database_tenant(request)
+        token = request.__dict__.pop('_tenant_context_token', None)
+        if token is not None:
+            current_tenant.reset(token)
+
     def process_exception(self, request, exception):
-        try:
-            del self._threadmap[threading.get_ident()]
-        except KeyError:
-            pass
+        self.reset_tenant(request)
 
     def process_response(self, request, response):
-        try:
-            del self._threadmap[threading.get_ident()]
-        except KeyError:
-            pass
+        set_tenant_cookie(request, response)
+        self.reset_tenant(request)
         return response
 
     def __call__(self, request):
-        # Code to be executed for each request before
-        # the view (and later middleware) are called.
+        if self.is_async:
+            return self.__acall__(request)
+
         request = self.process_request(request)
-        response = self.get_response(request)
+        try:
+            response = self.get_response(request)
+        except Exception:
+            self.reset_tenant(request)
+            raise
         return self.process_response(request, response)
 
 
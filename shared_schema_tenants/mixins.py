@@ -1,19 +1,34 @@
-from django.db import models
-from shared_schema_tenants.settings import get_setting
+import re
+
+from django.conf import settings as django_settings
+from django.db import DEFAULT_DB_ALIAS, connections, models
+from django.db.models.signals import class_prepared, m2m_changed
 from shared_schema_tenants.managers import SingleTenantModelManager, MultipleTenantModelManager
-from shared_schema_tenants.helpers.tenants import get_current_tenant
+from shared_schema_tenants.helpers.tenants import get_current_tenant, get_tenant_pk
 from shared_schema_tenants.exceptions import TenantNotFoundError
 
 
 def get_default_tenant():
-    from shared_schema_tenants.models import Tenant
-    return Tenant.objects.filter(slug=get_setting('DEFAULT_TENANT_SLUG')).first()
+    """
+    Default of the ``tenant`` foreign key: the primary key of the current
+    tenant, without querying it, or else of the ``DEFAULT_TENANT_SLUG``
+    tenant, which is cached.
+    """
+    from shared_schema_tenants.cache import get_default_tenant_pk
+    tenant_pk = get_tenant_pk(get_current_tenant())
+    if tenant_pk is not None:
+        return tenant_pk
+    return get_default_tenant_pk()
 
 
 class SingleTenantModelMixin(models.Model):
     tenant = models.ForeignKey(
         'shared_schema_tenants.Tenant', default=get_default_tenant)
 
+    tenant_indexes = ()
+    tenant_partitioning = None
+    tenant_hash_partitions = 16
+
     objects = SingleTenantModelManager()
 
     original_manager = models.Manager()
@@ -24,9 +39,26 @@ class SingleTenantModelMixin(models.Model):
         default_manager_name = 'objects'
         base_manager_name = 'objects'
 
+    def __init__(self, *args, **kwargs):
+        super(SingleTenantModelMixin, self).__init__(*args, **kwargs)
+        # remember the tenant set by the default, which bulk operations for
+        # another tenant replace
+        self._default_tenant_id = None
+        if not args and 'tenant' not in kwargs and 'tenant_id' not in kwargs:
+            self._default_tenant_id = self.tenant_id
+
+    def has_default_tenant(self):
+        return self._default_tenant_id is not None and self.tenant_id == self._default_tenant_id
+
     def save(self, *args, **kwargs):
-        if not hasattr(self, 'tenant'):
-            self.tenant = get_current_tenant()
+        tenant_field = self._meta.get_field('tenant')
+        is_cached = (tenant_field.is_cached(self) if hasattr(tenant_field, 'is_cached')
+                     else hasattr(self, tenant_field.get_cache_name()))
+        if not is_cached:
+            current_tenant = get_current_tenant()
+            # reuse the current tenant instead of querying the one set by the default
+            if self.tenant_id is None or self.tenant_id == get_tenant_pk(current_tenant):
+                self.tenant = current_tenant
 
         if getattr(self, 'tenant', False):
             return super(SingleTenantModelMixin, self).save(*args, **kwargs)
@@ -34,8 +66,34 @@ class SingleTenantModelMixin(models.Model):
             raise TenantNotFoundError()
 
 
+def add_tenant_indexes(sender, **kwargs):
+    """
+    Adds a ``Meta.indexes`` entry starting with ``tenant`` for each fields
+    tuple in the ``tenant_indexes`` attribute of tenant aware models, so
+    migrations create the composite indexes tenant scoped queries use.
+    """
+    if (not issubclass(sender, SingleTenantModelMixin) or sender._meta.abstract or
+            sender._meta.proxy or not getattr(sender, 'tenant_indexes', None)):
+        return
+
+    indexes = list(sender._meta.indexes)
+    existing_fields = [index.fields for index in indexes]
+    for fields in sender.tenant_indexes:
+        index_fields = ['tenant'] + list(fields)
+        if index_fields not in existing_fields:
+            index = models.Index(fields=index_fields)
+            index.set_name_with_model(sender)
+            indexes.append(index)
+            existing_fields.append(index_fields)
+    sender._meta.indexes = indexes
+
+
+class_prepared.connect(add_tenant_indexes)
+
+
 class MultipleTenantsModelMixin(models.Model):
     tenants = models.ManyToManyField('shared_schema_tenants.Tenant')
+    tenants_filter_strategy = None
 
     objects = MultipleTenantModelManager()
 
@@ -47,12 +105,107 @@ class MultipleTenantsModelMixin(models.Model):
         default_manager_name = 'objects'
         base_manager_name = 'objects'
 
+    def is_linked_to_tenant(self, tenant_pk):
+        """
+        Whether the row is known to be linked to the tenant, because it was
+        loaded through the tenant, linked by ``save`` or ``link_tenants``,
+        or its tenants were prefetched. Doesn't query the database.
+        """
+        if tenant_pk in getattr(self, '_linked_tenant_pks', ()):
+            return True
+        prefetched_tenants = getattr(self, '_prefetched_objects_cache', {}).get('tenants')
+        return prefetched_tenants is not None and any(tenant.pk == tenant_pk for tenant in prefetched_tenants)
+
     def save(self, *args, **kwargs):
         tenant = get_current_tenant()
+        tenant_pk = get_tenant_pk(tenant)
+
+        if tenant_pk is not None and not self._state.adding and self.is_linked_to_tenant(tenant_pk):
+            return super(MultipleTenantsModelMixin, self).save(*args, **kwargs)
 
-        if tenant:
+        if not tenant:
+            raise TenantNotFoundError()
+
+        if self._state.adding:
             instance = super(MultipleTenantsModelMixin, self).save(*args, **kwargs)
             self.tenants.add(tenant)
-            return instance
         else:
-            raise TenantNotFoundError()
+            # link first, so the tenant scoped base manager finds the row to update
+            self.tenants.add(tenant)
+            instance = super(MultipleTenantsModelMixin, self).save(*args, **kwargs)
+        self._linked_tenant_pks = getattr(self, '_linked_tenant_pks', set()) | set([tenant_pk])
+        return instance
+
+
+class DenormalizedTenantsModelMixin(MultipleTenantsModelMixin):
+    """
+    Keeps the slugs of the tenants of each row in the ``tenant_slugs``
+    column, synced by ``m2m_changed``, so ``MultipleTenantModelManager`` can
+    filter by tenant without joining the ``tenants`` table when the
+    ``'denormalized'`` strategy is selected.
+    """
+    if 'postgresql' in django_settings.DATABASES['default']['ENGINE']:
+        from django.contrib.postgres.fields import ArrayField
+
+        tenant_slugs = ArrayField(models.CharField(max_length=255), blank=True, default=list, editable=False)
+    else:
+        tenant_slugs = models.TextField(blank=True, default='', editable=False)
+
+    class Meta(MultipleTenantsModelMixin.Meta):
+        abstract = True
+
+    @classmethod
+    def get_tenant_slugs_value(cls, slugs):
+        slugs = sorted(slugs)
+        if isinstance(cls._meta.get_field('tenant_slugs'), models.TextField):
+            return ',%s,' % ','.join(slugs) if slugs else ''
+        return slugs
+
+    @classmethod
+    def get_tenant_slugs_lookup(cls, tenant_pk, using=DEFAULT_DB_ALIAS):
+        if isinstance(cls._meta.get_field('tenant_slugs'), models.TextField):
+            if connections[using].vendor == 'sqlite':
+                # contains is a LIKE, which ignores the case of ASCII letters on SQLite
+                return {'tenant_slugs__regex': re.escape(',%s,' % tenant_pk)}
+            return {'tenant_slugs__contains': ',%s,' % tenant_pk}
+        return {'tenant_slugs__contains': [tenant_pk]}
+
+    def sync_tenant_slugs(self):
+        self.tenant_slugs = self.get_tenant_slugs_value(self.tenants.values_list('pk', flat=True))
+        type(self).original_manager.filter(pk=self.pk).update(tenant_slugs=self.tenant_slugs)
+
+
+def sync_tenant_slugs(sender, instance, action, reverse, model, pk_set, **kwargs):
+    rows_model = model if reverse else type(instance)
+    if not issubclass(rows_model, DenormalizedTenantsModelMixin):
+        return
+    if sender is not rows_model._meta.get_field('tenants').remote_field.through:
+        return
+
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            instance.sync_tenant_slugs()
+    elif action == 'pre_clear':
+        instance._cleared_tenant_rows = list(
+            rows_model.original_manager.filter(tenants=instance).values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if action == 'post_clear':
+            pk_set = instance.__dict__.pop('_cleared_tenant_rows', [])
+        for row in rows_model.original_manager.filter(pk__in=pk_set):
+            row.sync_tenant_slugs()
+
+
+m2m_changed.connect(sync_tenant_slugs)
+
+
+def forget_linked_tenants(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if reverse or not isinstance(instance, MultipleTenantsModelMixin) or '_linked_tenant_pks' not in instance.__dict__:
+        return
+
+    if action == 'post_remove':
+        instance._linked_tenant_pks -= set(pk_set)
+    elif action == 'post_clear':
+        instance._linked_tenant_pks = set()
+
+
+m2m_changed.connect(forget_linked_tenants)
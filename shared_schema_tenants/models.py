@@ -1,7 +1,8 @@
 from django.db import models
 from django.conf import settings as django_settings
 from django.contrib.sites.models import Site
-from django.db.models.signals import post_delete
+from django.core.signals import setting_changed
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 
 import json
 
@@ -10,6 +11,10 @@ from model_utils.models import TimeStampedModel
 from shared_schema_tenants.mixins import SingleTenantModelMixin
 from shared_schema_tenants.settings import get_setting
 from shared_schema_tenants.validators import validate_json
+from shared_schema_tenants.routing_table import mark_routing_table_stale
+from shared_schema_tenants.cache import (
+    clear_domain_cache, clear_domain_index, clear_miss_cache, invalidate_tenant_cache, clear_default_tenant_cache,
+    invalidate_query_cache, invalidate_m2m_query_cache, pin_written_tenant, remember_site_tenant)
 
 
 class Tenant(TimeStampedModel):
@@ -18,11 +23,15 @@ class Tenant(TimeStampedModel):
 
     if 'postgresql' in django_settings.DATABASES['default']['ENGINE']:
         from django.contrib.postgres.fields import JSONField
+        JSON_FIELDS = ('extra_data', 'settings')
+
         extra_data = JSONField(blank=True, null=True,
                                default=get_setting('DEFAULT_TENANT_EXTRA_DATA'))
         settings = JSONField(blank=True, null=True,
                              default=get_setting('DEFAULT_TENANT_SETTINGS'))
     else:
+        JSON_FIELDS = ('_extra_data', '_settings')
+
         _extra_data = models.TextField(blank=True, null=True,
                                        validators=[validate_json],
                                        default=json.dumps(get_setting('DEFAULT_TENANT_EXTRA_DATA')))
@@ -69,6 +78,48 @@ def post_delete_tenant_site(sender, instance, *args, **kwargs):
 
 post_delete.connect(post_delete_tenant_site, sender=TenantSite)
 
+post_save.connect(clear_default_tenant_cache, sender=Tenant)
+post_delete.connect(clear_default_tenant_cache, sender=Tenant)
+
+post_save.connect(pin_written_tenant)
+post_delete.connect(pin_written_tenant)
+
+
+def connect_query_cache(setting='SHARED_SCHEMA_TENANTS', *args, **kwargs):
+    """
+    Connects the receivers invalidating cached querysets only when
+    ``QUERY_CACHE`` is on, so writes don't touch the cache otherwise.
+    """
+    if setting != 'SHARED_SCHEMA_TENANTS':
+        return
+
+    signals = [(post_save, invalidate_query_cache), (post_delete, invalidate_query_cache),
+               (m2m_changed, invalidate_m2m_query_cache)]
+    for signal, receiver in signals:
+        if get_setting('QUERY_CACHE'):
+            signal.connect(receiver)
+        else:
+            signal.disconnect(receiver)
+
+
+connect_query_cache()
+setting_changed.connect(connect_query_cache)
+
+for sender in [Tenant, TenantSite, Site]:
+    post_save.connect(clear_domain_cache, sender=sender)
+    post_delete.connect(clear_domain_cache, sender=sender)
+    post_save.connect(clear_domain_index, sender=sender)
+    post_delete.connect(clear_domain_index, sender=sender)
+    post_save.connect(clear_miss_cache, sender=sender)
+    post_save.connect(invalidate_tenant_cache, sender=sender)
+    post_delete.connect(invalidate_tenant_cache, sender=sender)
+
+pre_save.connect(remember_site_tenant, sender=TenantSite)
+
+for sender in [TenantSite, Site]:
+    post_save.connect(mark_routing_table_stale, sender=sender)
+    post_delete.connect(mark_routing_table_stale, sender=sender)
+
 
 class TenantRelationship(TimeStampedModel, SingleTenantModelMixin):
     tenant = models.ForeignKey('Tenant', related_name="relationships")
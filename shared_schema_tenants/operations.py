@@ -0,0 +1,239 @@
+from django.db.backends.utils import truncate_name
+from django.db.migrations.operations.base import Operation
+
+CURRENT_TENANT_DB_SETTING = 'app.current_tenant'
+
+
+class TenantTableOperation(Operation):
+    """
+    Base of the operations that only change the PostgreSQL table of a tenant
+    aware model, leaving the migration state untouched.
+    """
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def get_model(self, app_label, schema_editor, state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return None
+
+        model = state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return None
+        return model
+
+
+class EnableTenantRowLevelSecurity(TenantTableOperation):
+    """
+    Enables PostgreSQL row level security on the table of a tenant aware
+    model, with a policy that only allows the rows of the tenant in the
+    ``app.current_tenant`` setting. Connections that never set it, or reset
+    it, aren't restricted; PostgreSQL reads reset settings as empty strings.
+    With ``force``, the policy also applies to the table owner.
+    Does nothing on other databases.
+    """
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, model_name, force=True):
+        self.model_name = model_name
+        self.force = force
+
+    def deconstruct(self):
+        kwargs = {'model_name': self.model_name}
+        if not self.force:
+            kwargs['force'] = False
+        return (self.__class__.__name__, [], kwargs)
+
+    def get_policy_name(self, model):
+        return truncate_name('%s_tenant_isolation' % model._meta.db_table, 63)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = self.get_model(app_label, schema_editor, to_state)
+        if model is None:
+            return
+
+        table = schema_editor.quote_name(model._meta.db_table)
+        condition = "coalesce(current_setting('%s', true), '') = '' OR %s = current_setting('%s', true)" % (
+            CURRENT_TENANT_DB_SETTING,
+            schema_editor.quote_name(model._meta.get_field('tenant').column),
+            CURRENT_TENANT_DB_SETTING)
+
+        schema_editor.execute('ALTER TABLE %s ENABLE ROW LEVEL SECURITY' % table)
+        if self.force:
+            schema_editor.execute('ALTER TABLE %s FORCE ROW LEVEL SECURITY' % table)
+        schema_editor.execute('CREATE POLICY %s ON %s USING (%s) WITH CHECK (%s)' % (
+            schema_editor.quote_name(self.get_policy_name(model)), table, condition, condition))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = self.get_model(app_label, schema_editor, from_state)
+        if model is None:
+            return
+
+        table = schema_editor.quote_name(model._meta.db_table)
+        schema_editor.execute('DROP POLICY IF EXISTS %s ON %s' % (
+            schema_editor.quote_name(self.get_policy_name(model)), table))
+        schema_editor.execute('ALTER TABLE %s NO FORCE ROW LEVEL SECURITY' % table)
+        schema_editor.execute('ALTER TABLE %s DISABLE ROW LEVEL SECURITY' % table)
+
+    def describe(self):
+        return 'Enable tenant row level security on %s' % self.model_name
+
+
+class PartitionByTenant(TenantTableOperation):
+    """
+    Rebuilds the table of a tenant aware model as a PostgreSQL table
+    partitioned by tenant, so tenant scoped queries only scan the partitions
+    of the tenant. ``'list'`` partitioning creates a partition for each
+    tenant, plus a default one; ``'hash'`` spreads the tenants over
+    ``partitions`` partitions. The primary key and unique constraints get the
+    tenant column, as PostgreSQL requires, and tables referenced by foreign
+    keys can't be partitioned. Does nothing on other databases.
+    """
+    reduces_to_sql = False
+    reversible = True
+
+    def __init__(self, model_name, method='list', partitions=None):
+        if method not in ('list', 'hash'):
+            raise ValueError("method must be 'list' or 'hash'")
+        if method == 'hash' and not partitions:
+            raise ValueError('hash partitioning requires the number of partitions')
+        self.model_name = model_name
+        self.method = method
+        self.partitions = partitions
+
+    def deconstruct(self):
+        kwargs = {'model_name': self.model_name}
+        if self.method != 'list':
+            kwargs['method'] = self.method
+        if self.partitions:
+            kwargs['partitions'] = self.partitions
+        return (self.__class__.__name__, [], kwargs)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = self.get_model(app_label, schema_editor, to_state)
+        if model is None:
+            return
+
+        from shared_schema_tenants.partitioning import get_partition_name, get_default_partition_name
+        table = model._meta.db_table
+        quote_name = schema_editor.quote_name
+        tenant_column = model._meta.get_field('tenant').column
+
+        if self.method == 'hash':
+            partitions = [
+                (truncate_name('%s_p%d' % (table, remainder), 63),
+                 'FOR VALUES WITH (MODULUS %d, REMAINDER %d)' % (self.partitions, remainder), [])
+                for remainder in range(self.partitions)]
+        else:
+            tenant_model = model._meta.get_field('tenant').remote_field.model
+            partitions = [
+                (get_partition_name(table, tenant_pk), 'FOR VALUES IN (%s)', [tenant_pk])
+                for tenant_pk in tenant_model._base_manager.using(
+                    schema_editor.connection.alias).values_list('pk', flat=True)]
+            partitions.append((get_default_partition_name(table), 'DEFAULT', []))
+
+        def create_table(old_table):
+            schema_editor.execute(
+                'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY %s (%s)' % (
+                    quote_name(table), quote_name(old_table), self.method.upper(), quote_name(tenant_column)))
+            for name, bound, params in partitions:
+                schema_editor.execute('CREATE TABLE %s PARTITION OF %s %s' % (
+                    quote_name(name), quote_name(table), bound), params)
+
+        self.rebuild_table(schema_editor, model, create_table, lambda columns: (
+            columns if tenant_column in columns else columns + [tenant_column]))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = self.get_model(app_label, schema_editor, from_state)
+        if model is None:
+            return
+
+        table = model._meta.db_table
+        tenant_column = model._meta.get_field('tenant').column
+        declared = self.get_unique_columns(model)
+
+        def create_table(old_table):
+            schema_editor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)' % (
+                schema_editor.quote_name(table), schema_editor.quote_name(old_table)))
+
+        def get_columns(columns):
+            # restore the unique constraints the tenant column was added to
+            if columns[-1] == tenant_column and set(columns[:-1]) in declared and set(columns) not in declared:
+                return columns[:-1]
+            return columns
+
+        self.rebuild_table(schema_editor, model, create_table, get_columns, primary_key_with_tenant=False)
+
+    def get_unique_columns(self, model):
+        unique_columns = [set([field.column]) for field in model._meta.local_fields if field.unique]
+        for fields in model._meta.unique_together:
+            unique_columns.append(set(model._meta.get_field(field).column for field in fields))
+        return unique_columns
+
+    def rebuild_table(self, schema_editor, model, create_table, get_unique_columns, primary_key_with_tenant=True):
+        """
+        Copies the table into the one created by ``create_table`` and
+        restores its primary key, unique constraints, indexes and foreign keys.
+        """
+        connection = schema_editor.connection
+        quote_name = schema_editor.quote_name
+        table = model._meta.db_table
+        old_table = truncate_name('%s_old' % table, 63)
+        pk_column = model._meta.pk.column
+        tenant_column = model._meta.get_field('tenant').column
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT conrelid::regclass::text FROM pg_constraint "
+                "WHERE confrelid = %s::regclass AND conrelid <> confrelid AND contype = 'f'", [quote_name(table)])
+            referencing = [row[0] for row in cursor.fetchall()]
+            if referencing:
+                raise ValueError("Can't rebuild %s, it's referenced by foreign keys of %s" % (
+                    table, ', '.join(referencing)))
+
+            constraints = connection.introspection.get_constraints(cursor, table)
+            cursor.execute(
+                "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = %s::regclass AND contype = 'f'", [quote_name(table)])
+            foreign_keys = cursor.fetchall()
+            cursor.execute(
+                "SELECT i.indexname, i.indexdef FROM pg_indexes i "
+                "WHERE i.tablename = %s AND i.schemaname = current_schema() "
+                "AND i.indexdef NOT LIKE 'CREATE UNIQUE INDEX%%' AND NOT EXISTS ("
+                "SELECT 1 FROM pg_constraint c WHERE c.conname = i.indexname AND c.conrelid = %s::regclass)",
+                [table, quote_name(table)])
+            indexes = cursor.fetchall()
+            cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [quote_name(table), pk_column])
+            sequence = cursor.fetchone()[0]
+
+        primary_key_name = next(
+            (name for name, constraint in constraints.items() if constraint['primary_key']),
+            truncate_name('%s_pkey' % table, 63))
+        unique_constraints = [
+            (name, get_unique_columns(list(constraint['columns'])))
+            for name, constraint in sorted(constraints.items())
+            if constraint['unique'] and not constraint['primary_key']]
+
+        schema_editor.execute('ALTER TABLE %s RENAME TO %s' % (quote_name(table), quote_name(old_table)))
+        create_table(old_table)
+        schema_editor.execute('INSERT INTO %s SELECT * FROM %s' % (quote_name(table), quote_name(old_table)))
+        if sequence:
+            schema_editor.execute('ALTER SEQUENCE %s OWNED BY %s.%s' % (
+                sequence, quote_name(table), quote_name(pk_column)))
+        schema_editor.execute('DROP TABLE %s' % quote_name(old_table))
+
+        primary_key = [pk_column, tenant_column] if primary_key_with_tenant else [pk_column]
+        schema_editor.execute('ALTER TABLE %s ADD CONSTRAINT %s PRIMARY KEY (%s)' % (
+            quote_name(table), quote_name(primary_key_name), ', '.join(quote_name(c) for c in primary_key)))
+        for name, columns in unique_constraints:
+            schema_editor.execute('ALTER TABLE %s ADD CONSTRAINT %s UNIQUE (%s)' % (
+                quote_name(table), quote_name(name), ', '.join(quote_name(c) for c in columns)))
+        for name, definition in indexes:
+            schema_editor.execute(definition)
+        for name, definition in foreign_keys:
+            schema_editor.execute('ALTER TABLE %s ADD CONSTRAINT %s %s' % (
+                quote_name(table), quote_name(name), definition))
+
+    def describe(self):
+        return 'Partition %s by tenant (%s)' % (self.model_name, self.method)
@@ -0,0 +1,102 @@
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS, connections, router
+from django.db.backends.utils import truncate_name
+
+
+def get_partition_name(table, tenant_pk):
+    """
+    Tenant partitions are named ``<table>_tenant_<tenant>``, which can't
+    clash with the ``<table>_default`` default partition, whatever the
+    tenant is called.
+    """
+    return truncate_name('%s_tenant_%s' % (table, tenant_pk), 63)
+
+
+def get_default_partition_name(table):
+    return truncate_name('%s_default' % table, 63)
+
+
+def get_list_partitioned_models():
+    """
+    Returns the tenant aware models whose ``tenant_partitioning`` is
+    ``'list'``, which need a partition for each tenant.
+    """
+    from shared_schema_tenants.mixins import SingleTenantModelMixin
+    return [
+        model for model in apps.get_models()
+        if issubclass(model, SingleTenantModelMixin) and not model._meta.proxy and
+        getattr(model, 'tenant_partitioning', None) == 'list'
+    ]
+
+
+def get_partitioning_strategy(cursor, table):
+    """
+    Returns ``'l'`` (list) or ``'h'`` (hash) for partitioned tables and
+    ``None`` for other tables.
+    """
+    cursor.execute(
+        "SELECT p.partstrat FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = %s AND pg_table_is_visible(c.oid)", [table])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def get_partition_names(cursor, table):
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s AND pg_table_is_visible(p.oid)", [table])
+    return set(row[0] for row in cursor.fetchall())
+
+
+def create_tenant_partition(schema_editor, table, tenant_column, tenant_pk):
+    """
+    Creates the partition of ``tenant_pk`` in a list partitioned table,
+    moving the rows of the tenant out of the default partition.
+    """
+    quote_name = schema_editor.quote_name
+    partition = get_partition_name(table, tenant_pk)
+    default_partition = get_default_partition_name(table)
+
+    schema_editor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)' % (
+        quote_name(partition), quote_name(table)))
+    with schema_editor.connection.cursor() as cursor:
+        if default_partition in get_partition_names(cursor, table):
+            cursor.execute(
+                'WITH moved AS (DELETE FROM %s WHERE %s = %%s RETURNING *) INSERT INTO %s SELECT * FROM moved' % (
+                    quote_name(default_partition), quote_name(tenant_column), quote_name(partition)),
+                [tenant_pk])
+    schema_editor.execute('ALTER TABLE %s ATTACH PARTITION %s FOR VALUES IN (%%s)' % (
+        quote_name(table), quote_name(partition)), [tenant_pk])
+
+
+def create_tenant_partitions(tenant_pks=None, using=DEFAULT_DB_ALIAS):
+    """
+    Creates the missing partitions of the given tenants, or of every tenant,
+    in the list partitioned tables of the models with ``tenant_partitioning =
+    'list'``. Returns how many partitions were created. Does nothing on
+    databases other than PostgreSQL.
+    """
+    from shared_schema_tenants.models import Tenant
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return 0
+
+    models = [model for model in get_list_partitioned_models() if router.allow_migrate_model(using, model)]
+    if not models:
+        return 0
+    if tenant_pks is None:
+        tenant_pks = Tenant.objects.using(using).values_list('pk', flat=True)
+
+    created = 0
+    with connection.schema_editor() as schema_editor, connection.cursor() as cursor:
+        for model in models:
+            table = model._meta.db_table
+            if get_partitioning_strategy(cursor, table) != 'l':
+                continue
+
+            existing = get_partition_names(cursor, table)
+            for tenant_pk in tenant_pks:
+                if get_partition_name(table, tenant_pk) not in existing:
+                    create_tenant_partition(schema_editor, table, model._meta.get_field('tenant').column, tenant_pk)
+                    created += 1
+    return created
@@ -0,0 +1,85 @@
+import random
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from shared_schema_tenants.settings import get_settings
+from shared_schema_tenants.helpers.tenants import get_current_tenant, get_tenant_pk
+
+
+def get_tenant_database(tenant_pk):
+    """
+    Returns the database alias of the tenant in ``TENANT_DATABASES``, or
+    ``None`` for tenants kept in the default database.
+    """
+    if tenant_pk is None:
+        return None
+    return get_settings().TENANT_DATABASES.get(tenant_pk)
+
+
+def get_tenant_database_aliases(tenant_pk):
+    """
+    Returns the aliases of the databases the queries of the tenant can reach:
+    the default database, the tenant database in ``TENANT_DATABASES`` and
+    their replicas in ``TENANT_READ_REPLICAS``.
+    """
+    aliases = [DEFAULT_DB_ALIAS]
+    database = get_tenant_database(tenant_pk)
+    if database is not None and database not in aliases:
+        aliases.append(database)
+
+    replicas = get_settings().TENANT_READ_REPLICAS
+    for alias in list(aliases):
+        aliases.extend(replica for replica in replicas.get(alias, ()) if replica not in aliases)
+    return aliases
+
+
+class TenantRouter(object):
+    """
+    Sends the queries of tenant aware models to the database of their tenant
+    in ``TENANT_DATABASES``: the tenant of the instance involved, when there's
+    one, or else the current tenant. Reads go to a replica of that database
+    in ``TENANT_READ_REPLICAS``, unless they're in a transaction or the tenant
+    committed a save or a delete in the last ``TENANT_PRIMARY_PIN_TIMEOUT``
+    seconds. Other models are left to the next routers. Tenants are allowed
+    to relate to rows in any database, since they're read from the default
+    one.
+    """
+
+    def is_routed(self, model):
+        from shared_schema_tenants.mixins import SingleTenantModelMixin
+        settings = get_settings()
+        return ((settings.TENANT_DATABASES or settings.TENANT_READ_REPLICAS) and
+                issubclass(model, SingleTenantModelMixin))
+
+    def get_tenant_pk(self, model, instance=None):
+        from shared_schema_tenants.models import Tenant
+        if isinstance(instance, Tenant):
+            return instance.pk
+        if isinstance(instance, model):
+            tenant_pk = getattr(instance, model._meta.get_field('tenant').attname, None)
+            if tenant_pk is not None:
+                return tenant_pk
+        return get_tenant_pk(get_current_tenant())
+
+    def db_for_read(self, model, **hints):
+        from shared_schema_tenants.cache import get_primary_pins
+        if not self.is_routed(model):
+            return None
+
+        tenant_pk = self.get_tenant_pk(model, hints.get('instance'))
+        database = get_tenant_database(tenant_pk)
+        replicas = get_settings().TENANT_READ_REPLICAS.get(database or DEFAULT_DB_ALIAS)
+        if (not replicas or tenant_pk is None or connections[database or DEFAULT_DB_ALIAS].in_atomic_block or
+                get_primary_pins().is_pinned(tenant_pk)):
+            return database
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if not self.is_routed(model):
+            return None
+        return get_tenant_database(self.get_tenant_pk(model, hints.get('instance')))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        from shared_schema_tenants.models import Tenant
+        if isinstance(obj1, Tenant) or isinstance(obj2, Tenant):
+            return True
+        return None
@@ -0,0 +1,225 @@
+"""
+Read-only routing file mapping tenant domains to tenant slugs, built by the
+``buildroutingtable`` management command and memory mapped by every worker,
+so they share the same pages instead of warming their own caches.
+
+The file starts with a header (magic, format version, version stamp and
+number of entries), followed by the fixed size index entries sorted by
+domain and by the domains and slugs themselves.
+"""
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.utils.encoding import force_bytes, force_text
+
+from shared_schema_tenants.settings import get_setting
+from shared_schema_tenants.cache import normalize_host
+
+MAGIC = b'SSTR'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sIQI')
+ENTRY = struct.Struct('<IHIH')
+
+CHANGED_STAMP_KEY = 'shared_schema_tenants:routing_table:changed'
+
+replace_file = getattr(os, 'replace', os.rename)
+
+
+def make_stamp():
+    return int(time.time() * 1000000)
+
+
+def write_routing_table(path, domains, stamp=None):
+    """
+    Writes the ``(domain, slug)`` pairs to ``path``. The file is written
+    next to ``path`` and renamed over it, so readers never see it partially
+    written.
+    """
+    if stamp is None:
+        stamp = make_stamp()
+
+    entries = sorted(set(
+        (force_bytes(normalize_host(domain)), force_bytes(slug)) for domain, slug in domains))
+
+    offset = HEADER.size + ENTRY.size * len(entries)
+    index = []
+    data = []
+    for key, value in entries:
+        index.append(ENTRY.pack(offset, len(key), offset + len(key), len(value)))
+        data.append(key + value)
+        offset += len(key) + len(value)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    temp_file = tempfile.NamedTemporaryFile(dir=directory, prefix='.routing-', delete=False)
+    try:
+        with temp_file:
+            temp_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, stamp, len(entries)))
+            temp_file.write(b''.join(index))
+            temp_file.write(b''.join(data))
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.chmod(temp_file.name, 0o644)
+        replace_file(temp_file.name, path)
+    except Exception:
+        os.unlink(temp_file.name)
+        raise
+
+    return len(entries)
+
+
+def build_routing_table(path):
+    from shared_schema_tenants.models import TenantSite
+    return write_routing_table(
+        path, TenantSite.original_manager.values_list('site__domain', 'tenant_id'))
+
+
+class RoutingTable(object):
+    """
+    Memory mapped routing file. Lookups binary search the sorted index in
+    place, without loading the file into the process memory.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as routing_file:
+            self._map = mmap.mmap(routing_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, format_version, self.stamp, self.size = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError('%s is not a tenant routing table' % path)
+
+    def __len__(self):
+        return self.size
+
+    def get_entry(self, position):
+        return ENTRY.unpack_from(self._map, HEADER.size + ENTRY.size * position)
+
+    def get(self, domain):
+        key = force_bytes(domain)
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, value_offset, value_length = self.get_entry(middle)
+            middle_key = self._map[key_offset:key_offset + key_length]
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                return force_text(self._map[value_offset:value_offset + value_length])
+        return None
+
+    def lookup(self, host):
+        host = normalize_host(host)
+        slug = self.get(host)
+        if slug is None and ':' in host and not host.endswith(']'):
+            slug = self.get(host.rsplit(':', 1)[0])
+        return slug
+
+
+class RoutingTableLoader(object):
+    """
+    Keeps the routing table at ``path`` loaded. At most once every
+    ``check_interval`` seconds it checks whether the file was replaced and
+    swaps the table when its version stamp changed, and asks
+    ``get_changed_stamp`` when tenant domains last changed. Tables built
+    before that are stale and aren't returned.
+    """
+
+    def __init__(self, path, check_interval=1, get_changed_stamp=None):
+        self.path = path
+        self.check_interval = check_interval
+        self.get_changed_stamp = get_changed_stamp
+        self._table = None
+        self._file_id = None
+        self._changed_stamp = 0
+        self._next_check = 0
+
+    def get(self):
+        now = time.time()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self.reload()
+            if self.get_changed_stamp is not None:
+                self.mark_stale(self.get_changed_stamp() or 0)
+
+        if self._table is None or self._table.stamp < self._changed_stamp:
+            return None
+        return self._table
+
+    def mark_stale(self, changed_stamp):
+        self._changed_stamp = max(self._changed_stamp, changed_stamp)
+
+    def reload(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self._table = self._file_id = None
+            return
+
+        file_id = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if file_id != self._file_id:
+            table = RoutingTable(self.path)
+            if self._table is None or table.stamp != self._table.stamp:
+                self._table = table
+            self._file_id = file_id
+
+
+_routing_table_loader = None
+
+
+def get_changed_stamp():
+    """
+    Returns when tenant domains last changed, as shared by the workers using
+    the ``TENANT_CACHE_ALIAS`` cache, or ``None``.
+    """
+    alias = get_setting('TENANT_CACHE_ALIAS')
+    if alias is None:
+        return None
+    return caches[alias].get(CHANGED_STAMP_KEY)
+
+
+def set_changed_stamp():
+    stamp = make_stamp()
+    alias = get_setting('TENANT_CACHE_ALIAS')
+    if alias is not None:
+        caches[alias].set(CHANGED_STAMP_KEY, stamp, None)
+    if _routing_table_loader is not None:
+        _routing_table_loader.mark_stale(stamp)
+
+
+def mark_routing_table_stale(sender, instance, *args, **kwargs):
+    """
+    Marks the routing table stale when a ``Site`` or ``TenantSite`` changes,
+    right away and again when the transaction commits, so workers stop using
+    it, including tables built before the change was committed, until it's
+    rebuilt.
+    """
+    set_changed_stamp()
+    transaction.on_commit(set_changed_stamp, using=kwargs.get('using'))
+
+
+def get_routing_table():
+    global _routing_table_loader
+    path = get_setting('ROUTING_TABLE_PATH')
+    if path is None:
+        return None
+
+    if _routing_table_loader is None:
+        _routing_table_loader = RoutingTableLoader(
+            path, check_interval=get_setting('ROUTING_TABLE_CHECK_INTERVAL'), get_changed_stamp=get_changed_stamp)
+    return _routing_table_loader.get()
+
+
+def reset_routing_table(setting, *args, **kwargs):
+    global _routing_table_loader
+    if setting == 'SHARED_SCHEMA_TENANTS':
+        _routing_table_loader = None
+
+
+setting_changed.connect(reset_routing_table)
@@ -1,7 +1,30 @@
 from django.conf import settings
+from django.core.signals import setting_changed
 
 
-def get_setting(settings_name):
+class FrozenSettings(object):
+    """
+    Read only snapshot of an app settings dictionary exposing every setting
+    as an attribute. Lists are stored as tuples.
+    """
+
+    def __init__(self, settings_dict):
+        for name, value in settings_dict.items():
+            if isinstance(value, list):
+                value = tuple(value)
+            self.__dict__[name] = value
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings can't be changed, override them in django settings instead")
+
+    def __delattr__(self, name):
+        raise AttributeError("Settings can't be changed, override them in django settings instead")
+
+    def get(self, name, default=None):
+        return self.__dict__.get(name, default)
+
+
+def build_settings():
     tenant_settings = getattr(settings, 'SHARED_SCHEMA_TENANTS', {})
     DEFAULT_TENANT_SETTINGS_FIELDS = tenant_settings.get(
         'DEFAULT_TENANT_SETTINGS_FIELDS', {})
@@ -48,7 +71,34 @@ def get_setting(settings_name):
             'shared_schema_tenants.tenant_retrievers.retrieve_by_session',
         ]),
         "ADD_TENANT_TO_SESSION": tenant_settings.get('ADD_TENANT_TO_SESSION', True),
+        "MULTIPLE_TENANTS_FILTER_STRATEGY": tenant_settings.get('MULTIPLE_TENANTS_FILTER_STRATEGY', 'join'),
+        "ROW_LEVEL_SECURITY": tenant_settings.get('ROW_LEVEL_SECURITY', False),
+        "TENANT_DATABASES": tenant_settings.get('TENANT_DATABASES', {}),
+        "TENANT_READ_REPLICAS": tenant_settings.get('TENANT_READ_REPLICAS', {}),
+        "TENANT_PRIMARY_PIN_TIMEOUT": tenant_settings.get('TENANT_PRIMARY_PIN_TIMEOUT', 5),
+        "TENANT_PERSISTENCE": tenant_settings.get('TENANT_PERSISTENCE', 'session'),
+        "TENANT_COOKIE_NAME": tenant_settings.get('TENANT_COOKIE_NAME', 'tenant'),
+        "TENANT_COOKIE_MAX_AGE": tenant_settings.get('TENANT_COOKIE_MAX_AGE', 60 * 60 * 24 * 7 * 2),
         "TENANT_HTTP_HEADER": tenant_settings.get('TENANT_HTTP_HEADER', 'Tenant-Slug'),
+        "TENANT_HTTP_HEADER_META_KEY": 'HTTP_' + tenant_settings.get(
+            'TENANT_HTTP_HEADER', 'Tenant-Slug').replace('-', '_').upper(),
+        "TENANT_TOKEN_HTTP_HEADER": tenant_settings.get('TENANT_TOKEN_HTTP_HEADER', 'Tenant-Token'),
+        "TENANT_TOKEN_HTTP_HEADER_META_KEY": 'HTTP_' + tenant_settings.get(
+            'TENANT_TOKEN_HTTP_HEADER', 'Tenant-Token').replace('-', '_').upper(),
+        "TENANT_TOKEN_MAX_AGE": tenant_settings.get('TENANT_TOKEN_MAX_AGE', 60 * 60 * 24),
+        "DOMAIN_CACHE_MAX_SIZE": tenant_settings.get('DOMAIN_CACHE_MAX_SIZE', 1024),
+        "DOMAIN_CACHE_TIMEOUT": tenant_settings.get('DOMAIN_CACHE_TIMEOUT', 300),
+        "DOMAIN_INDEX_TIMEOUT": tenant_settings.get('DOMAIN_INDEX_TIMEOUT', 300),
+        "ROUTING_TABLE_PATH": tenant_settings.get('ROUTING_TABLE_PATH', None),
+        "ROUTING_TABLE_CHECK_INTERVAL": tenant_settings.get('ROUTING_TABLE_CHECK_INTERVAL', 1),
+        "TENANT_CACHE_ALIAS": tenant_settings.get('TENANT_CACHE_ALIAS', 'default'),
+        "TENANT_CACHE_TIMEOUT": tenant_settings.get('TENANT_CACHE_TIMEOUT', 300),
+        "QUERY_CACHE": tenant_settings.get('QUERY_CACHE', False),
+        "QUERY_CACHE_TIMEOUT": tenant_settings.get('QUERY_CACHE_TIMEOUT', 60),
+        "MISS_CACHE_MAX_SIZE": tenant_settings.get('MISS_CACHE_MAX_SIZE', 1024),
+        "MISS_CACHE_TIMEOUT": tenant_settings.get('MISS_CACHE_TIMEOUT', 10),
+        "MISS_FLOOD_MAX_MISSES": tenant_settings.get('MISS_FLOOD_MAX_MISSES', None),
+        "MISS_FLOOD_WINDOW": tenant_settings.get('MISS_FLOOD_WINDOW', 1),
         "DEFAULT_TENANT_OWNER_PERMISSIONS": tenant_settings.get(
             'DEFAULT_TENANT_OWNER_PERMISSIONS', [
                 'shared_schema_tenants.add_tenant',
@@ -63,4 +113,27 @@ def get_setting(settings_name):
             ])
     }
 
-    return settings_dict.get(settings_name)
+    return FrozenSettings(settings_dict)
+
+
+_settings = None
+
+
+def get_settings():
+    global _settings
+    if _settings is None:
+        _settings = build_settings()
+    return _settings
+
+
+def get_setting(settings_name):
+    return get_settings().get(settings_name)
+
+
+def reload_settings(setting, *args, **kwargs):
+    global _settings
+    if setting == 'SHARED_SCHEMA_TENANTS':
+        _settings = None
+
+
+setting_changed.connect(reload_settings)
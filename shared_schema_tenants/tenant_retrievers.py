@@ -1,33 +1,219 @@
+from django.conf import settings
+from django.core import signing
 from django.contrib.sites.shortcuts import get_current_site
 from django.contrib.sites.models import Site
 from shared_schema_tenants.models import Tenant, TenantSite
-from shared_schema_tenants.settings import get_setting
+from shared_schema_tenants.settings import get_settings
 from shared_schema_tenants.exceptions import TenantNotFoundError
+from shared_schema_tenants.routing_table import get_routing_table
+from shared_schema_tenants.cache import (
+    get_domain_cache, get_domain_index, get_tenant_cache, get_miss_cache, get_tenant_generation, normalize_host,
+    copy_tenant)
 
 
-def retrieve_by_domain(request):
+def precondition(check):
+    """
+    Declares a cheap check the request must pass before the retriever runs.
+    """
+    def decorator(retriever):
+        retriever.precondition = check
+        return retriever
+    return decorator
+
+
+def async_variant(retriever_path):
+    """
+    Declares the retriever that replaces this one when the tenant is
+    retrieved by the asynchronous ``TenantMiddleware``.
+    """
+    def decorator(retriever):
+        retriever.async_variant = retriever_path
+        return retriever
+    return decorator
+
+
+def has_tenant_http_header(request):
+    return get_settings().TENANT_HTTP_HEADER_META_KEY in request.META
+
+
+def has_tenant_token_http_header(request):
+    return get_settings().TENANT_TOKEN_HTTP_HEADER_META_KEY in request.META
+
+
+def has_session_cookie(request):
+    return settings.SESSION_COOKIE_NAME in request.COOKIES
+
+
+def has_tenant_cookie(request):
+    return get_settings().TENANT_COOKIE_NAME in request.COOKIES
+
+
+TENANT_COOKIE_SALT = 'shared_schema_tenants.tenant_cookie'
+
+
+def get_tenant_cookie(request):
+    return request.get_signed_cookie(
+        get_settings().TENANT_COOKIE_NAME, default=None, salt=TENANT_COOKIE_SALT,
+        max_age=get_settings().TENANT_COOKIE_MAX_AGE)
+
+
+def persist_tenant(request, tenant):
+    """
+    Keeps the tenant retrieved for the request so ``retrieve_by_session`` or
+    ``retrieve_by_cookie`` can find it on the next requests. Only writes when
+    the persisted tenant changes. Cookies are set by ``TenantMiddleware``
+    when the response is returned.
+    """
+    if get_settings().TENANT_PERSISTENCE == 'cookie':
+        if get_tenant_cookie(request) != tenant.slug:
+            request._tenant_cookie_slug = tenant.slug
+        return
+
+    try:
+        session = request.session
+    except AttributeError:
+        return
+
+    if session.get('tenant_slug') != tenant.slug:
+        session['tenant_slug'] = tenant.slug
+
+
+def load_tenant_by_slug(slug, retriever='slug'):
+    """
+    Queries the tenant with the slug, remembering misses, and stores it in
+    the tenant cache. Used when the tenant cache doesn't have it.
+    """
+    miss_cache = get_miss_cache()
+    if miss_cache.is_miss(retriever, slug):
+        raise Tenant.DoesNotExist()
+
     try:
-        return get_current_site(request).tenant_site.tenant
-    except (TenantSite.DoesNotExist, Site.DoesNotExist):
+        tenant = Tenant.objects.get(slug=slug)
+    except Tenant.DoesNotExist:
+        miss_cache.add_miss(retriever, slug)
+        raise
+
+    get_tenant_cache().set('slug', slug, tenant)
+    return tenant
+
+
+def get_tenant_by_slug(slug, retriever='slug'):
+    tenant = get_tenant_cache().get('slug', slug)
+    if tenant is None:
+        tenant = load_tenant_by_slug(slug, retriever=retriever)
+    return tenant
+
+
+def find_tenant_by_slug(slug, retriever, required=True):
+    """
+    Returns the tenant with the slug found by the retriever, or ``None``
+    when it didn't find a slug. Unknown slugs raise ``TenantNotFoundError``
+    when ``required``, and return ``None`` otherwise.
+    """
+    if slug is None:
         return None
+
+    try:
+        return get_tenant_by_slug(slug, retriever=retriever)
     except Tenant.DoesNotExist:
-        raise TenantNotFoundError()
+        if required:
+            raise TenantNotFoundError()
+        return None
+
+
+def get_routing_table_slug(host):
+    routing_table = get_routing_table()
+    if routing_table is None:
+        return None
+    return routing_table.lookup(host)
+
+
+def get_http_header_slug(request):
+    return request.META.get(get_settings().TENANT_HTTP_HEADER_META_KEY)
+
+
+def get_session_slug(request):
+    try:
+        return request.session.get('tenant_slug')
+    except AttributeError:
+        return None
+
+
+def get_tenant_by_site(request):
+    site = get_current_site(request)
+    return TenantSite.original_manager.select_related('tenant').get(site=site).tenant
+
+
+def get_tenant_by_domain(request, host):
+    """
+    Looks the tenant of the host up in the routing table, the tenant cache
+    and the database, and stores it in the per-process domain cache, whose
+    entries are only used while the generation of their tenant is the same.
+    """
+    tenant_cache = get_tenant_cache()
+    miss_cache = get_miss_cache()
+
+    tenant = find_tenant_by_slug(get_routing_table_slug(host), 'routing_table', required=False)
+    if tenant is None:
+        tenant = tenant_cache.get('domain', host)
+    if tenant is None:
+        if miss_cache.is_miss('domain', host):
+            return None
+
+        try:
+            tenant = get_tenant_by_site(request)
+        except (TenantSite.DoesNotExist, Site.DoesNotExist):
+            miss_cache.add_miss('domain', host)
+            return None
+        except Tenant.DoesNotExist:
+            raise TenantNotFoundError()
 
+        tenant_cache.set('domain', host, tenant)
 
+    get_domain_cache().set(host, (get_tenant_generation(tenant.pk), copy_tenant(tenant)))
+    return tenant
+
+
+@async_variant('shared_schema_tenants.async_tenant_retrievers.aretrieve_by_domain')
+def retrieve_by_domain(request):
+    host = normalize_host(request.get_host())
+    generation, tenant = get_domain_cache().get(host, (None, None))
+    if tenant is not None and generation == get_tenant_generation(tenant.pk):
+        return copy_tenant(tenant)
+    return get_tenant_by_domain(request, host)
+
+
+@async_variant('shared_schema_tenants.async_tenant_retrievers.aretrieve_by_domain_index')
+def retrieve_by_domain_index(request):
+    return find_tenant_by_slug(get_domain_index().lookup(request.get_host()), 'domain_index')
+
+
+@precondition(has_tenant_http_header)
+@async_variant('shared_schema_tenants.async_tenant_retrievers.aretrieve_by_http_header')
 def retrieve_by_http_header(request):
+    return find_tenant_by_slug(get_http_header_slug(request), 'http_header')
+
+
+@precondition(has_tenant_token_http_header)
+@async_variant('shared_schema_tenants.async_tenant_retrievers.aretrieve_by_signed_token')
+def retrieve_by_signed_token(request):
+    from shared_schema_tenants.helpers.tenants import load_tenant_token
     try:
-        tenant_http_header = 'HTTP_' + get_setting('TENANT_HTTP_HEADER').replace('-', '_').upper()
-        return Tenant.objects.get(slug=request.META[tenant_http_header])
+        return load_tenant_token(request.META[get_settings().TENANT_TOKEN_HTTP_HEADER_META_KEY],
+                                 max_age=get_settings().TENANT_TOKEN_MAX_AGE)
     except LookupError:
         return None
-    except Tenant.DoesNotExist:
+    except signing.BadSignature:
         raise TenantNotFoundError()
 
 
+@precondition(has_session_cookie)
+@async_variant('shared_schema_tenants.async_tenant_retrievers.aretrieve_by_session')
 def retrieve_by_session(request):
-    try:
-        return Tenant.objects.get(slug=request.session['tenant_slug'])
-    except (AttributeError, LookupError, Tenant.DoesNotExist):
-        return None
-    except Tenant.DoesNotExist:
-        raise TenantNotFoundError()
+    return find_tenant_by_slug(get_session_slug(request), 'session', required=False)
+
+
+@precondition(has_tenant_cookie)
+@async_variant('shared_schema_tenants.async_tenant_retrievers.aretrieve_by_cookie')
+def retrieve_by_cookie(request):
+    return find_tenant_by_slug(get_tenant_cookie(request), 'cookie', required=False)
@@ -0,0 +1,481 @@
+import mock
+import shutil
+import tempfile
+from django.core.cache import caches
+from django.db import transaction
+from django.test import TestCase, RequestFactory, override_settings
+from django.contrib.sites.models import Site
+from model_mommy import mommy
+from exampleproject.articles.models import Article, Tag
+from shared_schema_tenants.cache import (
+    LRUCache, TenantCache, MissCache, DomainIndex, clear_domain_cache, clear_domain_index,
+    clear_miss_cache, get_tenant_cache, get_miss_cache, clear_default_tenant_cache, get_query_cache)
+from shared_schema_tenants.mixins import get_default_tenant
+from shared_schema_tenants.models import Tenant, TenantSite
+from shared_schema_tenants.helpers.tenants import create_tenant, set_current_tenant, clear_current_tenant
+from shared_schema_tenants.exceptions import TenantNotFoundError
+from shared_schema_tenants.tenant_retrievers import (
+    retrieve_by_domain, retrieve_by_domain_index, retrieve_by_http_header)
+
+
+class LRUCacheTests(TestCase):
+
+    def test_get_returns_set_value(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    @mock.patch('shared_schema_tenants.cache.time.time')
+    def test_expires_entries(self, time):
+        cache = LRUCache(max_size=2, timeout=10)
+        time.return_value = 100
+        cache.set('a', 1)
+
+        time.return_value = 109
+        self.assertEqual(cache.get('a'), 1)
+        time.return_value = 110
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_zero_max_size_disables_cache(self):
+        cache = LRUCache(max_size=0)
+        cache.set('a', 1)
+
+        self.assertEqual(cache.get('a'), None)
+
+
+class DomainCacheTests(TestCase):
+
+    def setUp(self):
+        clear_domain_cache()
+        self.tenant = create_tenant(name='test', slug='test', extra_data={}, domains=['test.localhost:8000'])
+        self.request = RequestFactory().get('/', HTTP_HOST='TEST.localhost:8000')
+
+    def test_warm_cache_resolves_without_queries(self):
+        self.assertEqual(retrieve_by_domain(self.request), self.tenant)
+
+        with self.assertNumQueries(0):
+            retrieved_tenant = retrieve_by_domain(self.request)
+            self.assertEqual(retrieved_tenant.name, 'test')
+            self.assertEqual(retrieved_tenant.extra_data, self.tenant.extra_data)
+
+    def test_changes_to_cached_tenant_dont_leak(self):
+        retrieve_by_domain(self.request).name = 'changed'
+
+        self.assertEqual(retrieve_by_domain(self.request).name, 'test')
+
+    def test_generation_bump_from_other_workers_invalidates_cache(self):
+        retrieve_by_domain(self.request)
+        Tenant.objects.filter(pk='test').update(name='changed')
+        get_tenant_cache().bump_generation('test')
+
+        self.assertEqual(retrieve_by_domain(self.request).name, 'changed')
+
+    def test_tenant_save_invalidates_cache(self):
+        retrieve_by_domain(self.request)
+        self.tenant.name = 'renamed'
+        self.tenant.save()
+
+        self.assertEqual(retrieve_by_domain(self.request).name, 'renamed')
+
+    def test_site_change_invalidates_cache(self):
+        retrieve_by_domain(self.request)
+        Site.objects.filter(domain='test.localhost:8000').get().delete()
+
+        self.assertEqual(retrieve_by_domain(self.request), None)
+
+
+class DomainIndexTests(TestCase):
+
+    def setUp(self):
+        self.index = DomainIndex([
+            ('example.com', 'main'),
+            ('*.example.com', 'wildcard'),
+            ('*.eu.example.com', 'eu'),
+            ('admin.example.com:8000', 'admin'),
+        ])
+
+    def test_exact_domain(self):
+        self.assertEqual(self.index.lookup('example.com'), 'main')
+        self.assertEqual(self.index.lookup('EXAMPLE.com.'), 'main')
+        self.assertEqual(self.index.lookup('other.com'), None)
+
+    def test_wildcard_domain(self):
+        self.assertEqual(self.index.lookup('acme.example.com'), 'wildcard')
+        self.assertEqual(self.index.lookup('shop.acme.example.com'), 'wildcard')
+        self.assertEqual(self.index.lookup('acme.eu.example.com'), 'eu')
+        self.assertEqual(self.index.lookup('eu.example.com'), 'wildcard')
+
+    def test_port_normalization(self):
+        self.assertEqual(self.index.lookup('example.com:8000'), 'main')
+        self.assertEqual(self.index.lookup('admin.example.com:8000'), 'admin')
+        self.assertEqual(self.index.lookup('admin.example.com'), 'wildcard')
+
+    @mock.patch('shared_schema_tenants.cache.time')
+    def test_expires(self, time):
+        time.time.return_value = 100
+        index = DomainIndex(timeout=10)
+
+        self.assertFalse(index.is_expired())
+        time.time.return_value = 110
+        self.assertTrue(index.is_expired())
+
+
+class DomainIndexRetrieverTests(TestCase):
+
+    def setUp(self):
+        clear_domain_index()
+        self.tenant = create_tenant(name='test', slug='test', extra_data={}, domains=['*.test.localhost'])
+        self.factory = RequestFactory()
+
+    def test_resolves_subdomains_without_site_rows(self):
+        request = self.factory.get('/', HTTP_HOST='acme.test.localhost:8000')
+
+        self.assertEqual(retrieve_by_domain_index(request), self.tenant)
+        with self.assertNumQueries(0):
+            self.assertEqual(retrieve_by_domain_index(self.factory.get('/', HTTP_HOST='other.test.localhost')),
+                             self.tenant)
+
+    def test_unknown_domain(self):
+        self.assertEqual(retrieve_by_domain_index(self.factory.get('/', HTTP_HOST='other.localhost')), None)
+
+    def test_new_domain_invalidates_index(self):
+        retrieve_by_domain_index(self.factory.get('/', HTTP_HOST='other.localhost'))
+        other_tenant = create_tenant(name='other', slug='other', extra_data={}, domains=['other.localhost'])
+
+        self.assertEqual(retrieve_by_domain_index(self.factory.get('/', HTTP_HOST='other.localhost')), other_tenant)
+
+
+class TenantCacheTests(TestCase):
+
+    def setUp(self):
+        clear_domain_cache()
+        self.tenant = create_tenant(name='test', slug='test', extra_data={}, domains=['test.localhost:8000'])
+        self.factory = RequestFactory()
+
+    def test_warm_cache_resolves_http_header_without_queries(self):
+        request = self.factory.get('/', HTTP_TENANT_SLUG='test')
+        retrieve_by_http_header(request)
+
+        with self.assertNumQueries(0):
+            retrieved_tenant = retrieve_by_http_header(request)
+            self.assertEqual(retrieved_tenant, self.tenant)
+            self.assertEqual(retrieved_tenant.name, 'test')
+
+    def test_domain_is_shared_with_cold_processes(self):
+        request = self.factory.get('/', HTTP_HOST='test.localhost:8000')
+        retrieve_by_domain(request)
+        clear_domain_cache()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(retrieve_by_domain(request), self.tenant)
+
+    def test_generation_bump_invalidates_entries_from_every_worker(self):
+        worker_cache = TenantCache(alias='default')
+        worker_cache.set('slug', 'test', self.tenant)
+        self.assertEqual(worker_cache.get('slug', 'test'), self.tenant)
+
+        get_tenant_cache().bump_generation('test')
+
+        self.assertEqual(worker_cache.get('slug', 'test'), None)
+
+    @mock.patch('shared_schema_tenants.cache.transaction.on_commit')
+    def test_tenant_save_invalidates_again_on_commit(self, on_commit):
+        request = self.factory.get('/', HTTP_TENANT_SLUG='test')
+        stale_tenant = retrieve_by_http_header(request)
+
+        self.tenant.name = 'changed'
+        self.tenant.save()
+        # another worker caches the row it read before the commit
+        get_tenant_cache().set('slug', 'test', stale_tenant)
+        for call in on_commit.call_args_list:
+            call[0][0]()
+
+        self.assertEqual(get_tenant_cache().get('slug', 'test'), None)
+        self.assertEqual(retrieve_by_http_header(request).name, 'changed')
+
+    def test_tenant_site_delete_invalidates_domain(self):
+        request = self.factory.get('/', HTTP_HOST='test.localhost:8000')
+        retrieve_by_domain(request)
+        TenantSite.original_manager.get(tenant=self.tenant).delete()
+        clear_domain_cache()
+
+        self.assertEqual(retrieve_by_domain(request), None)
+
+    def test_rolled_back_writes_are_not_cached(self):
+        request = self.factory.get('/', HTTP_TENANT_SLUG='test')
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.tenant.name = 'ghost'
+                self.tenant.save()
+                self.assertEqual(retrieve_by_http_header(request).name, 'ghost')
+                raise ValueError()
+
+        self.assertEqual(retrieve_by_http_header(request).name, 'test')
+
+    def test_tenant_site_reassignment_invalidates_domain(self):
+        self.addCleanup(caches['default'].clear)
+        other_tenant = create_tenant(name='other', slug='other', extra_data={})
+        request = self.factory.get('/', HTTP_HOST='test.localhost:8000')
+        retrieve_by_domain(request)
+
+        tenant_site = TenantSite.original_manager.get(tenant=self.tenant)
+        tenant_site.tenant = other_tenant
+        tenant_site.save()
+
+        self.assertEqual(retrieve_by_domain(request), other_tenant)
+
+    def test_disabled_cache(self):
+        tenant_cache = TenantCache(alias=None)
+        tenant_cache.set('slug', 'test', self.tenant)
+
+        self.assertEqual(tenant_cache.get('slug', 'test'), None)
+
+
+class FileBasedTenantCacheTests(TenantCacheTests):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+
+        settings_override = override_settings(CACHES={
+            'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': cache_dir,
+            }
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        super(FileBasedTenantCacheTests, self).setUp()
+
+
+class MissCacheTests(TestCase):
+
+    def setUp(self):
+        clear_miss_cache()
+        self.factory = RequestFactory()
+
+    def test_unknown_http_header_is_cached(self):
+        request = self.factory.get('/', HTTP_TENANT_SLUG='unknown')
+        misses_before = get_miss_cache().get_stats().get('http_header', {}).get('cached_misses', 0)
+        with self.assertRaises(TenantNotFoundError):
+            retrieve_by_http_header(request)
+
+        with self.assertNumQueries(0):
+            with self.assertRaises(TenantNotFoundError):
+                retrieve_by_http_header(request)
+
+        self.assertEqual(get_miss_cache().get_stats()['http_header']['cached_misses'], misses_before + 1)
+
+    def test_unknown_domain_is_cached(self):
+        clear_domain_cache()
+        request = self.factory.get('/', HTTP_HOST='unknown.localhost:8000')
+        self.assertEqual(retrieve_by_domain(request), None)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(retrieve_by_domain(request), None)
+
+    def test_creating_tenant_clears_misses(self):
+        clear_domain_cache()
+        request = self.factory.get('/', HTTP_HOST='new.localhost:8000')
+        self.assertEqual(retrieve_by_domain(request), None)
+
+        tenant = create_tenant(name='new', slug='new', extra_data={}, domains=['new.localhost:8000'])
+
+        self.assertEqual(retrieve_by_domain(request), tenant)
+
+    @mock.patch('shared_schema_tenants.cache.time.time')
+    def test_flood_short_circuits_unseen_lookups(self, time):
+        time.return_value = 100
+        miss_cache = MissCache(flood_max_misses=2, flood_window=1)
+        miss_cache.add_miss('domain', 'a.localhost')
+        self.assertFalse(miss_cache.is_miss('domain', 'b.localhost'))
+        miss_cache.add_miss('domain', 'b.localhost')
+
+        self.assertTrue(miss_cache.is_miss('domain', 'c.localhost'))
+        self.assertFalse(miss_cache.is_miss('http_header', 'c'))
+        self.assertEqual(miss_cache.get_stats()['domain'],
+                         {'misses': 2, 'cached_misses': 0, 'short_circuits': 1})
+
+        time.return_value = 101
+        self.assertFalse(miss_cache.is_miss('domain', 'c.localhost'))
+
+
+class DefaultTenantTests(TestCase):
+
+    def setUp(self):
+        clear_default_tenant_cache()
+        clear_current_tenant()
+        self.user = mommy.make('auth.User')
+
+    def test_prefers_current_tenant_without_query(self):
+        create_tenant(name='default', slug='default', extra_data={})
+        self.addCleanup(clear_current_tenant, set_current_tenant('test'))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_default_tenant(), 'test')
+            self.assertEqual(Article(title='a').tenant_id, 'test')
+
+    def test_default_tenant_is_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_default_tenant(), None)
+            self.assertEqual(get_default_tenant(), None)
+
+        create_tenant(name='default', slug='default', extra_data={})
+        with self.assertNumQueries(1):
+            self.assertEqual([Article().tenant_id for i in range(3)], ['default'] * 3)
+
+        Tenant.objects.get(pk='default').delete()
+        self.assertEqual(get_default_tenant(), None)
+
+    def test_save_reuses_current_tenant(self):
+        tenant = create_tenant(name='test', slug='test', extra_data={})
+        self.addCleanup(clear_current_tenant, set_current_tenant(tenant))
+        article = Article(title='a', text='a', author=self.user)
+
+        with self.assertNumQueries(1):
+            article.save()
+        self.assertEqual(article.tenant, tenant)
+
+
+@override_settings(SHARED_SCHEMA_TENANTS={'QUERY_CACHE': True})
+class QueryCacheTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = mommy.make('auth.User')
+        self.tenant_1 = create_tenant(name='tenant_1', slug='tenant_1', extra_data={})
+        self.tenant_2 = create_tenant(name='tenant_2', slug='tenant_2', extra_data={})
+        self.articles = mommy.make(Article, tenant=self.tenant_1, author=self.user, _quantity=2)
+        mommy.make(Article, tenant=self.tenant_2, author=self.user)
+        self.addCleanup(clear_current_tenant, set_current_tenant(self.tenant_1))
+
+    def test_cached_results_skip_the_database(self):
+        self.assertEqual(list(Article.objects.cached().order_by('pk')), self.articles)
+        Article.objects.cached().get(pk=self.articles[0].pk)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(list(Article.objects.cached().order_by('pk')), self.articles)
+            self.assertEqual(Article.objects.cached().get(pk=self.articles[0].pk), self.articles[0])
+
+        with self.assertNumQueries(2):
+            self.assertEqual(len(Article.objects.all()), 2)
+            self.assertEqual(list(Article.objects.cached().values_list('pk', flat=True).order_by('pk')),
+                             [article.pk for article in self.articles])
+
+    def test_tenants_are_cached_apart(self):
+        self.assertEqual(len(Article.objects.cached()), 2)
+
+        set_current_tenant(self.tenant_2)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Article.objects.cached()), 1)
+
+    def test_writes_invalidate_the_tenant(self):
+        len(Article.objects.cached())
+        set_current_tenant(self.tenant_2)
+        len(Article.objects.cached())
+
+        set_current_tenant(self.tenant_1)
+        mommy.make(Article, author=self.user)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Article.objects.cached()), 3)
+
+        set_current_tenant(self.tenant_2)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(Article.objects.cached()), 1)
+
+        set_current_tenant(self.tenant_1)
+        self.articles[0].delete()
+        self.assertEqual(len(Article.objects.cached()), 2)
+
+        Article.objects.bulk_create([Article(title='a', text='a', author=self.user)])
+        self.assertEqual(len(Article.objects.cached()), 3)
+
+    def test_bulk_update_invalidates_after_the_write(self):
+        query_cache = get_query_cache()
+        invalidate = query_cache.invalidate
+        titles = []
+
+        def invalidate_after_write(*parts, **kwargs):
+            titles.append(Article.original_manager.get(pk=self.articles[0].pk).title)
+            invalidate(*parts, **kwargs)
+
+        self.articles[0].title = 'changed'
+        with mock.patch.object(query_cache, 'invalidate', side_effect=invalidate_after_write):
+            Article.objects.bulk_update(self.articles, ['title'])
+
+        self.assertEqual(titles, ['changed'])
+        self.assertEqual(Article.objects.cached().get(pk=self.articles[0].pk).title, 'changed')
+
+    def test_m2m_changes_invalidate_both_models(self):
+        tag = mommy.make(Tag)
+        self.assertEqual(list(Tag.objects.cached()), [tag])
+        self.assertEqual(len(Article.objects.cached().filter(tags=tag)), 0)
+
+        self.articles[0].tags.add(tag)
+        self.assertEqual(len(Article.objects.cached().filter(tags=tag)), 1)
+
+        tag.tenants.remove(self.tenant_1)
+        self.assertEqual(list(Tag.objects.cached()), [])
+
+    def test_timeout(self):
+        with mock.patch.object(get_query_cache().cache, 'set', wraps=get_query_cache().cache.set) as cache_set:
+            len(Article.objects.cached(10))
+
+        self.assertEqual(cache_set.call_args[0][2], 10)
+
+    @mock.patch('shared_schema_tenants.cache.transaction.on_commit')
+    def test_writes_invalidate_again_on_commit(self, on_commit):
+        len(Article.objects.cached())
+
+        self.articles[0].delete()
+        # another request caches the rows it read before the commit
+        get_query_cache().get_results(Article.objects.all(), 'tenant_1')
+        for call in on_commit.call_args_list:
+            call[0][0]()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Article.objects.cached()), 1)
+
+    def test_rolled_back_writes_are_not_cached(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                mommy.make(Article, tenant=self.tenant_1, author=self.user, title='ghost')
+                self.assertIn('ghost', list(Article.objects.cached().values_list('title', flat=True)))
+                raise ValueError()
+
+        self.assertNotIn('ghost', list(Article.objects.cached().values_list('title', flat=True)))
+
+    @override_settings(SHARED_SCHEMA_TENANTS={'QUERY_CACHE': True, 'TENANT_CACHE_ALIAS': None})
+    def test_disabled_cache(self):
+        len(Article.objects.cached())
+
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Article.objects.cached()), 2)
+
+    @override_settings(SHARED_SCHEMA_TENANTS={})
+    def test_cache_is_opt_in(self):
+        len(Article.objects.cached())
+
+        with mock.patch('shared_schema_tenants.cache.QueryCache.bump_generation') as bump_generation:
+            mommy.make(Article, author=self.user).tags.add(mommy.make(Tag))
+            Article.objects.bulk_create([Article(title='a', text='a', author=self.user)])
+        self.assertFalse(bump_generation.called)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Article.objects.cached()), 4)
@@ -0,0 +1,71 @@
+from django.db import models
+from django.test import SimpleTestCase
+from django.test.utils import isolate_apps
+from shared_schema_tenants.checks import check_model_tenant_indexes, check_tenant_indexes
+from shared_schema_tenants.mixins import SingleTenantModelMixin
+
+
+@isolate_apps('shared_schema_tenants')
+class TenantIndexesTests(SimpleTestCase):
+
+    def test_tenant_indexes_are_added_to_meta(self):
+        class Post(SingleTenantModelMixin):
+            title = models.CharField(max_length=100)
+            created = models.DateTimeField()
+            tenant_indexes = [('created',), ('title', 'created')]
+
+        self.assertEqual([index.fields for index in Post._meta.indexes],
+                         [['tenant', 'created'], ['tenant', 'title', 'created']])
+        self.assertTrue(all(index.name for index in Post._meta.indexes))
+
+    def test_existing_index_isnt_duplicated(self):
+        class Post(SingleTenantModelMixin):
+            created = models.DateTimeField()
+            tenant_indexes = [('created',)]
+
+            class Meta:
+                indexes = [models.Index(fields=['tenant', 'created'], name='post_tenant_created')]
+
+        self.assertEqual([index.name for index in Post._meta.indexes], ['post_tenant_created'])
+
+    def test_check_warns_about_lookups_without_tenant_index(self):
+        class Post(SingleTenantModelMixin):
+            title = models.CharField(max_length=100, db_index=True)
+            created = models.DateTimeField()
+
+            class Meta:
+                ordering = ['-created']
+
+        warnings = check_model_tenant_indexes(Post)
+
+        self.assertEqual([warning.id for warning in warnings], ['shared_schema_tenants.W001'] * 2)
+        self.assertIn("'created'", warnings[0].msg)
+        self.assertIn("'title'", warnings[1].msg)
+
+    def test_check_accepts_tenant_indexes(self):
+        class Post(SingleTenantModelMixin):
+            title = models.CharField(max_length=100, db_index=True)
+            created = models.DateTimeField()
+            tenant_indexes = [('created',)]
+
+            class Meta:
+                ordering = ['-created']
+                unique_together = [('tenant', 'title')]
+
+        self.assertEqual(check_model_tenant_indexes(Post), [])
+
+    def test_check_accepts_descending_tenant_indexes(self):
+        class Post(SingleTenantModelMixin):
+            created = models.DateTimeField()
+            tenant_indexes = [('-created',)]
+
+            class Meta:
+                ordering = ['-created']
+
+        self.assertEqual(check_model_tenant_indexes(Post), [])
+
+
+class ProjectTenantIndexesTests(SimpleTestCase):
+
+    def test_project_models_pass_check(self):
+        self.assertEqual(check_tenant_indexes(), [])
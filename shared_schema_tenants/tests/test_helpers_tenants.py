@@ -0,0 +1,90 @@
+import copy
+from datetime import timedelta
+from django.core import signing
+from django.test import TestCase
+from shared_schema_tenants.exceptions import TenantNotFoundError
+from shared_schema_tenants.helpers.tenants import (
+    LazyTenant, create_tenant, set_current_tenant, get_current_tenant, clear_current_tenant,
+    create_tenant_token, load_tenant_token)
+from shared_schema_tenants.models import Tenant
+from shared_schema_tenants.settings import get_settings
+
+
+class LazyTenantTests(TestCase):
+
+    def setUp(self):
+        self.tenant = create_tenant(name='test', slug='test', extra_data={'number_of_employees': 3})
+
+    def test_slug_is_known_before_loading(self):
+        lazy_tenant = LazyTenant('test')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(lazy_tenant.slug, 'test')
+            self.assertEqual(lazy_tenant.pk, 'test')
+            self.assertFalse(lazy_tenant.is_loaded)
+
+    def test_json_columns_are_loaded_on_first_access(self):
+        lazy_tenant = LazyTenant('test')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(lazy_tenant.name, 'test')
+        with self.assertNumQueries(1):
+            self.assertEqual(lazy_tenant.extra_data, {'number_of_employees': 3})
+        with self.assertNumQueries(0):
+            self.assertEqual(lazy_tenant.extra_data, {'number_of_employees': 3})
+
+    def test_unexistent_tenant(self):
+        self.assertFalse(LazyTenant('unexistent'))
+
+    def test_copy_before_loading(self):
+        lazy_tenant = copy.copy(LazyTenant('test'))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(lazy_tenant.slug, 'test')
+
+    def test_set_current_tenant_with_instance_doesnt_query(self):
+        self.addCleanup(clear_current_tenant, set_current_tenant(self.tenant))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_current_tenant().name, 'test')
+
+
+class TenantTokenTests(TestCase):
+
+    def setUp(self):
+        self.tenant = create_tenant(name='test', slug='test', extra_data={})
+
+    def test_load_token_doesnt_query(self):
+        token = create_tenant_token(self.tenant)
+
+        with self.assertNumQueries(0):
+            lazy_tenant = load_tenant_token(token)
+            self.assertEqual(lazy_tenant.slug, 'test')
+            self.assertEqual(lazy_tenant.settings_version, self.tenant.modified.isoformat())
+            self.assertFalse(lazy_tenant.is_loaded)
+
+        self.assertEqual(lazy_tenant.name, 'test')
+
+    def test_tampered_token(self):
+        token = create_tenant_token(self.tenant)
+
+        with self.assertRaises(signing.BadSignature):
+            load_tenant_token(token[:-1] + ('a' if token[-1] != 'a' else 'b'))
+
+    def test_expired_token(self):
+        token = create_tenant_token(self.tenant)
+
+        with self.assertRaises(signing.SignatureExpired):
+            load_tenant_token(token, max_age=-1)
+
+    def test_outdated_token(self):
+        token = create_tenant_token(self.tenant)
+        Tenant.objects.filter(pk=self.tenant.pk).update(modified=self.tenant.modified + timedelta(seconds=1))
+
+        lazy_tenant = load_tenant_token(token)
+        self.assertEqual(lazy_tenant.slug, 'test')
+        with self.assertRaises(TenantNotFoundError):
+            lazy_tenant.name
+
+    def test_tokens_expire_by_default(self):
+        self.assertEqual(get_settings().TENANT_TOKEN_MAX_AGE, 60 * 60 * 24)
@@ -1,7 +1,11 @@
-from django.test import TestCase
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.utils.six import StringIO
+from django.test import TestCase, override_settings
 import django.utils.version
 from model_mommy import mommy
 from exampleproject.articles.models import Article, Tag
+from shared_schema_tenants_custom_data.models import TenantSpecificFieldsValidator
 from shared_schema_tenants.helpers.tenants import create_tenant, set_current_tenant, clear_current_tenant
 from shared_schema_tenants.exceptions import TenantNotFoundError
 
@@ -61,6 +65,32 @@ class SingleTenantModelManagerTests(TestCase):
         clear_current_tenant()
         self.assertEqual(self.articles_manager.all().count(), 0)
 
+    def test_rows_share_current_tenant_instance(self):
+        articles = list(self.articles_manager.all())
+
+        with self.assertNumQueries(0):
+            self.assertEqual(set(article.tenant.name for article in articles), {'tenant_1'})
+        self.assertIs(articles[0].tenant, articles[1].tenant)
+
+    def test_building_queryset_doesnt_load_tenant(self):
+        with self.assertNumQueries(0):
+            queryset = self.articles_manager.filter(title__isnull=False)
+
+        with self.assertNumQueries(2):
+            self.assertEqual(set(article.tenant.name for article in queryset), {'tenant_1'})
+
+    def test_unexistent_tenant_returns_nothing(self):
+        set_current_tenant('unexistent')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.articles_manager.count(), 0)
+
+    def test_rows_share_passed_tenant_instance(self):
+        articles = list(self.articles_manager.get_queryset(tenant=self.tenant_2).filter(title__isnull=False))
+
+        with self.assertNumQueries(0):
+            self.assertTrue(all(article.tenant is self.tenant_2 for article in articles))
+
 
 class MultipleTenantModelManagerTests(TestCase):
 
@@ -112,3 +142,260 @@ class MultipleTenantModelManagerTests(TestCase):
     def test_return_nothing_if_no_tenant_set_or_passed(self):
         clear_current_tenant()
         self.assertEqual(self.tags_manager.all().count(), 0)
+
+    def test_building_queryset_doesnt_load_tenant(self):
+        set_current_tenant(self.tenant_1.slug)
+
+        with self.assertNumQueries(0):
+            queryset = self.tags_manager.all()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(queryset.count(), len(self.tags_t1) + len(self.shared_tags))
+
+
+class MultipleTenantsFilterStrategyTests(TestCase):
+
+    def setUp(self):
+        self.tenant_1 = create_tenant(name='tenant_1', slug='tenant_1', extra_data={})
+        self.tenant_2 = create_tenant(name='tenant_2', slug='tenant_2', extra_data={})
+
+        self.addCleanup(clear_current_tenant, set_current_tenant(self.tenant_1))
+        self.tags_t1 = mommy.make(Tag, _quantity=2)
+        self.shared_tags = mommy.make(Tag, tenants=[self.tenant_1, self.tenant_2], _quantity=3)
+        set_current_tenant(self.tenant_2)
+        self.tags_t2 = mommy.make(Tag, _quantity=1)
+
+    def filter_tags(self, tenant, strategy):
+        return Tag.objects.filter_by_tenant(Tag.original_manager.all(), tenant.pk, strategy)
+
+    def test_strategies_return_same_rows(self):
+        for strategy in ['join', 'exists', 'denormalized']:
+            self.assertEqual(
+                set(self.filter_tags(self.tenant_1, strategy)), set(self.tags_t1 + self.shared_tags), strategy)
+            self.assertEqual(
+                set(self.filter_tags(self.tenant_2, strategy)), set(self.tags_t2 + self.shared_tags), strategy)
+
+    def test_exists_doesnt_duplicate_rows(self):
+        tags = self.filter_tags(self.tenant_1, 'exists')
+
+        self.assertEqual(tags.count(), len(self.tags_t1 + self.shared_tags))
+        self.assertEqual(len(tags.filter(text__isnull=False)), len(self.tags_t1 + self.shared_tags))
+        self.assertNotIn('JOIN', str(tags.query))
+
+    @override_settings(SHARED_SCHEMA_TENANTS={'MULTIPLE_TENANTS_FILTER_STRATEGY': 'exists'})
+    def test_strategy_setting(self):
+        self.assertEqual(Tag.objects.get_queryset(tenant=self.tenant_2).count(), 4)
+
+    @override_settings(SHARED_SCHEMA_TENANTS={'MULTIPLE_TENANTS_FILTER_STRATEGY': 'unknown'})
+    def test_unknown_strategy(self):
+        with self.assertRaises(ImproperlyConfigured):
+            Tag.objects.get_queryset(tenant=self.tenant_2)
+
+    def test_tenant_slugs_follow_tenants_changes(self):
+        tag = self.tags_t1[0]
+        tag.tenants.add(self.tenant_2)
+        self.assertIn(tag, self.filter_tags(self.tenant_2, 'denormalized'))
+
+        tag.tenants.remove(self.tenant_1)
+        self.assertNotIn(tag, self.filter_tags(self.tenant_1, 'denormalized'))
+
+        self.tenant_2.tag_set.remove(tag)
+        self.assertNotIn(tag, self.filter_tags(self.tenant_2, 'denormalized'))
+
+        self.tenant_2.tag_set.clear()
+        self.assertEqual(self.filter_tags(self.tenant_2, 'denormalized').count(), 0)
+        self.assertEqual(self.filter_tags(self.tenant_1, 'denormalized').count(), 4)
+
+    def test_denormalized_slugs_are_case_sensitive(self):
+        upper_tenant = create_tenant(name='TENANT_1', slug='TENANT_1', extra_data={})
+        tag = mommy.make(Tag, tenants=[upper_tenant])
+
+        self.assertEqual(list(self.filter_tags(upper_tenant, 'denormalized')), [tag])
+        self.assertNotIn(tag, self.filter_tags(self.tenant_1, 'denormalized'))
+
+    def test_benchmark_command(self):
+        stdout = StringIO()
+        call_command('benchmarktenantfilters', rows=30, batch_size=10, repeat=1, stdout=stdout)
+
+        for strategy in ['join', 'exists', 'denormalized']:
+            self.assertIn(strategy, stdout.getvalue())
+        self.assertEqual(Tag.original_manager.count(), 6)
+
+
+class ForTenantsTests(TestCase):
+
+    def setUp(self):
+        self.tenant_1 = create_tenant(name='tenant_1', slug='tenant_1', extra_data={})
+        self.tenant_2 = create_tenant(name='tenant_2', slug='tenant_2', extra_data={})
+        self.tenant_3 = create_tenant(name='tenant_3', slug='tenant_3', extra_data={})
+
+        self.articles_t1 = mommy.make(Article, tenant=self.tenant_1, _quantity=2)
+        self.articles_t2 = mommy.make(Article, tenant=self.tenant_2, _quantity=3)
+        mommy.make(Article, tenant=self.tenant_3, _quantity=1)
+
+        self.addCleanup(clear_current_tenant, set_current_tenant(self.tenant_1))
+        self.tags_t1 = mommy.make(Tag, _quantity=2)
+        self.shared_tags = mommy.make(Tag, tenants=[self.tenant_1, self.tenant_2], _quantity=2)
+        set_current_tenant(self.tenant_3)
+        mommy.make(Tag, _quantity=1)
+
+    def test_single_tenant_rows_by_tenant(self):
+        with self.assertNumQueries(2):
+            groups = [(tenant, list(rows)) for tenant, rows in
+                      Article.objects.for_tenants(['tenant_1', 'tenant_2']).by_tenant()]
+            self.assertEqual([tenant.name for tenant, rows in groups], ['tenant_1', 'tenant_2'])
+            self.assertEqual([rows for tenant, rows in groups], [self.articles_t1, self.articles_t2])
+            self.assertTrue(all(row.tenant is groups[1][0] for row in groups[1][1]))
+
+    def test_multiple_tenants_rows_by_tenant(self):
+        groups = dict((tenant, set(rows)) for tenant, rows in
+                      Tag.objects.for_tenants([self.tenant_1, 'tenant_2']).by_tenant())
+
+        self.assertEqual(groups, {
+            self.tenant_1: set(self.tags_t1 + self.shared_tags),
+            self.tenant_2: set(self.shared_tags),
+        })
+
+    def test_chained_filters_and_ordering(self):
+        queryset = Article.objects.for_tenants(['tenant_1', 'tenant_2']).filter(
+            pk__in=[self.articles_t1[0].pk, self.articles_t2[0].pk, self.articles_t2[1].pk]).order_by('-pk')
+
+        self.assertEqual([(tenant.pk, [row.pk for row in rows]) for tenant, rows in queryset.by_tenant()], [
+            ('tenant_1', [self.articles_t1[0].pk]),
+            ('tenant_2', [self.articles_t2[1].pk, self.articles_t2[0].pk]),
+        ])
+        self.assertEqual(queryset.count(), 3)
+
+    def test_no_tenants(self):
+        self.assertEqual(list(Article.objects.for_tenants([]).by_tenant()), [])
+
+
+class TenantBulkOperationsTests(TestCase):
+
+    def setUp(self):
+        self.tenant_1 = create_tenant(name='tenant_1', slug='tenant_1', extra_data={})
+        self.tenant_2 = create_tenant(name='tenant_2', slug='tenant_2', extra_data={})
+        self.user = mommy.make('auth.User')
+        self.addCleanup(clear_current_tenant, set_current_tenant(self.tenant_1.slug))
+
+    def build_articles(self, titles, **kwargs):
+        return [Article(title=title, text=title, author=self.user, **kwargs) for title in titles]
+
+    def test_bulk_create_stamps_current_tenant(self):
+        articles = self.build_articles(['a', 'b', 'c'])
+
+        with self.assertNumQueries(1):
+            Article.objects.bulk_create(articles)
+
+        self.assertEqual(Article.original_manager.filter(tenant=self.tenant_1).count(), 3)
+
+    def test_bulk_create_passing_tenant(self):
+        articles = self.build_articles(['a', 'b'])
+        self.assertEqual(articles[0].tenant_id, 'tenant_1')
+
+        Article.objects.bulk_create(articles, tenant=self.tenant_2)
+
+        self.assertEqual(Article.original_manager.filter(tenant=self.tenant_2).count(), 2)
+
+    def test_bulk_create_validation(self):
+        with self.assertRaises(ValueError):
+            Article.objects.bulk_create(self.build_articles(['a'], tenant_id='tenant_2'))
+        with self.assertRaises(ValueError):
+            Article.objects.bulk_create(self.build_articles(['a'], tenant=self.tenant_1), tenant=self.tenant_2)
+
+        articles = self.build_articles(['a'])
+        articles[0].tenant_id = 'tenant_2'
+        with self.assertRaises(ValueError):
+            Article.objects.bulk_create(articles, tenant=self.tenant_1)
+
+        clear_current_tenant()
+        with self.assertRaises(TenantNotFoundError):
+            Article.objects.bulk_create(self.build_articles(['a']))
+        self.assertEqual(Article.original_manager.count(), 0)
+
+    def test_bulk_update(self):
+        articles = Article.objects.bulk_create(self.build_articles(['a', 'b', 'c']))
+        articles = list(Article.objects.order_by('pk'))
+        other = mommy.make(Article, tenant=self.tenant_2, title='other')
+        for article in articles:
+            article.title = article.title.upper()
+
+        with self.assertNumQueries(2 if django.VERSION < (2, 2) else 1):
+            self.assertEqual(Article.objects.bulk_update(articles, ['title'], batch_size=2), 3)
+
+        self.assertEqual(list(Article.objects.order_by('pk').values_list('title', flat=True)), ['A', 'B', 'C'])
+        other.title = 'changed'
+        with self.assertRaises(ValueError):
+            Article.objects.bulk_update([other], ['title'])
+
+    def test_update_or_create_many(self):
+        Article.objects.bulk_create(self.build_articles(['a', 'b']))
+        mommy.make(Article, tenant=self.tenant_2, title='c', text='c')
+
+        articles = [
+            Article(title='a', text='new a', author=self.user),
+            Article(title='c', text='new c', author=self.user),
+        ]
+
+        with self.assertNumQueries(3):
+            created, updated = Article.objects.update_or_create_many(articles, ['title'])
+
+        self.assertEqual([article.title for article in created], ['c'])
+        self.assertEqual([article.title for article in updated], ['a'])
+        self.assertEqual(dict(Article.objects.values_list('title', 'text')), {'a': 'new a', 'b': 'b', 'c': 'new c'})
+        self.assertEqual(Article.original_manager.get(tenant=self.tenant_2).text, 'c')
+
+
+class MultipleTenantsLinkingTests(TestCase):
+
+    def setUp(self):
+        self.tenant_1 = create_tenant(name='tenant_1', slug='tenant_1', extra_data={})
+        self.tenant_2 = create_tenant(name='tenant_2', slug='tenant_2', extra_data={})
+        self.addCleanup(clear_current_tenant, set_current_tenant(self.tenant_1))
+        self.validators = mommy.make(TenantSpecificFieldsValidator, _quantity=3)
+
+    def test_save_skips_known_links(self):
+        validator = TenantSpecificFieldsValidator.objects.get(pk=self.validators[0].pk)
+        validator.module_path = 'changed'
+
+        with self.assertNumQueries(1):
+            validator.save()
+
+        with self.assertNumQueries(1):
+            self.validators[1].save()
+
+        validator = TenantSpecificFieldsValidator.original_manager.prefetch_related('tenants').get(
+            pk=self.validators[2].pk)
+        with self.assertNumQueries(1):
+            validator.save()
+
+    def test_save_links_unknown_rows(self):
+        validator = TenantSpecificFieldsValidator.original_manager.get(pk=self.validators[0].pk)
+        set_current_tenant(self.tenant_2)
+        validator.save()
+
+        self.assertEqual(set(validator.tenants.all()), set([self.tenant_1, self.tenant_2]))
+
+    def test_save_links_again_after_remove(self):
+        validator = self.validators[0]
+        validator.tenants.remove(self.tenant_1)
+        validator.save()
+
+        self.assertEqual(list(validator.tenants.all()), [self.tenant_1])
+
+    def test_link_tenants(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(TenantSpecificFieldsValidator.objects.link_tenants(
+                self.validators, ['tenant_1', self.tenant_2]), 3)
+
+        for validator in self.validators:
+            self.assertEqual(set(validator.tenants.all()), set([self.tenant_1, self.tenant_2]))
+        self.assertEqual(TenantSpecificFieldsValidator.objects.link_tenants(self.validators, [self.tenant_2]), 0)
+
+    def test_link_tenants_syncs_denormalized_tenants(self):
+        tags = mommy.make(Tag, _quantity=2)
+
+        Tag.objects.link_tenants(tags, [self.tenant_2])
+
+        self.assertEqual(set(Tag.objects.filter_by_tenant(Tag.original_manager.all(), 'tenant_2', 'denormalized')),
+                         set(tags))
@@ -1,9 +1,14 @@
 import mock
-from django.test import TestCase, RequestFactory
+import sys
+import unittest
+from django.test import TestCase, RequestFactory, override_settings
 from django.http import HttpResponse
-from shared_schema_tenants.middleware import TenantMiddleware, get_tenant
-from shared_schema_tenants.helpers.tenants import create_tenant, set_current_tenant
+from shared_schema_tenants.middleware import (
+    TenantMiddleware, RetrieverStage, get_tenant, get_retriever_pipeline)
+from shared_schema_tenants.helpers.tenants import (
+    create_tenant, set_current_tenant, get_current_tenant, clear_current_tenant, create_tenant_token)
 from shared_schema_tenants.exceptions import TenantNotFoundError
+from shared_schema_tenants.tenant_retrievers import retrieve_by_domain, retrieve_by_cookie, TENANT_COOKIE_SALT
 
 
 try:
@@ -48,6 +53,233 @@ class TenantMiddlewareTests(TestCase):
 
         self.assertEqual(response, processed_response)
 
+    def test_restores_previous_tenant_after_response(self):
+        tenant = create_tenant(name='test', slug='test', extra_data={}, domains=['test.localhost:8000'])
+        token = set_current_tenant(tenant.slug)
+        previous_tenant = get_current_tenant()
+        factory = RequestFactory()
+        request = factory.get(reverse('shared_schema_tenants:tenant_list'), HTTP_HOST='test.localhost:8000')
+
+        def get_response(request):
+            self.assertIs(get_current_tenant(), request.tenant)
+            return HttpResponse()
+
+        TenantMiddleware(get_response).__call__(request)
+
+        self.assertIs(get_current_tenant(), previous_tenant)
+        clear_current_tenant(token)
+
+    def test_restores_previous_tenant_after_exception(self):
+        clear_current_tenant()
+        factory = RequestFactory()
+        request = factory.get(reverse('shared_schema_tenants:tenant_list'))
+
+        def get_response(request):
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            TenantMiddleware(get_response).__call__(request)
+
+        self.assertEqual(get_current_tenant(), None)
+
+    def test_request_without_tenant(self):
+        clear_current_tenant()
+        factory = RequestFactory()
+        request = factory.get(reverse('shared_schema_tenants:tenant_list'))
+
+        def get_response(request):
+            self.assertEqual(request.tenant, None)
+            return HttpResponse()
+
+        TenantMiddleware(get_response).__call__(request)
+
+
+class TenantPersistenceTests(TestCase):
+
+    def setUp(self):
+        self.tenant = create_tenant(name='test', slug='test', extra_data={}, domains=['test.localhost:8000'])
+        self.factory = RequestFactory()
+
+    def test_session_is_only_written_when_tenant_changes(self):
+        from django.contrib.sessions.backends.signed_cookies import SessionStore
+        request = self.factory.get(reverse('shared_schema_tenants:tenant_list'), HTTP_HOST='test.localhost:8000')
+        request.session = SessionStore()
+        request.session['tenant_slug'] = 'test'
+        request.session.modified = False
+
+        self.assertEqual(get_tenant(request), self.tenant)
+        self.assertFalse(request.session.modified)
+
+    @override_settings(SHARED_SCHEMA_TENANTS={'TENANT_PERSISTENCE': 'cookie'})
+    def test_cookie_is_set_when_tenant_changes(self):
+        request = self.factory.get(reverse('shared_schema_tenants:tenant_list'), HTTP_HOST='test.localhost:8000')
+
+        def get_response(request):
+            self.assertEqual(request.tenant, self.tenant)
+            return HttpResponse()
+
+        response = TenantMiddleware(get_response).__call__(request)
+        self.assertIn('tenant', response.cookies)
+
+        self.factory.cookies['tenant'] = response.cookies['tenant'].value
+        request = self.factory.get(reverse('shared_schema_tenants:tenant_list'), HTTP_HOST='test.localhost:8000')
+        response = TenantMiddleware(get_response).__call__(request)
+        self.assertNotIn('tenant', response.cookies)
+
+    @override_settings(SHARED_SCHEMA_TENANTS={
+        'TENANT_PERSISTENCE': 'cookie',
+        'TENANT_RETRIEVERS': ['shared_schema_tenants.tenant_retrievers.retrieve_by_cookie'],
+    })
+    def test_retrieve_by_cookie(self):
+        request = self.factory.get(reverse('shared_schema_tenants:tenant_list'))
+        response = HttpResponse()
+        response.set_signed_cookie('tenant', 'test', salt=TENANT_COOKIE_SALT)
+        request.COOKIES['tenant'] = response.cookies['tenant'].value
+
+        self.assertEqual(get_tenant(request), self.tenant)
+
+    def test_retrieve_by_cookie_with_tampered_cookie(self):
+        request = self.factory.get(reverse('shared_schema_tenants:tenant_list'))
+        request.COOKIES['tenant'] = 'test'
+
+        self.assertEqual(retrieve_by_cookie(request), None)
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'The async middleware requires Python 3.5 or newer')
+class AsyncTenantMiddlewareTests(TestCase):
+
+    def setUp(self):
+        # asgiref compares the context variables it copies back from threads,
+        # which would load a lazy tenant left by another test
+        from shared_schema_tenants.context import current_tenant
+        self.addCleanup(clear_current_tenant, current_tenant.set(None))
+
+    def make_async_get_response(self, get_response):
+        import asyncio
+
+        def async_get_response(request):
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(get_response(request))
+            return future
+
+        async_get_response._is_coroutine = asyncio.coroutines._is_coroutine
+        return async_get_response
+
+    def run_async(self, coroutine):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_detects_async_get_response(self):
+        import asyncio
+        middleware = TenantMiddleware(self.make_async_get_response(lambda r: HttpResponse()))
+
+        self.assertTrue(middleware.is_async)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        self.assertFalse(TenantMiddleware(lambda r: HttpResponse()).is_async)
+
+    def run_async_to_sync(self, async_function, *args):
+        # runs the thread sensitive sync_to_async calls in this thread, which
+        # holds the test transaction
+        from asgiref.sync import async_to_sync
+        return async_to_sync(async_function)(*args)
+
+    def create_committed_tenant(self, **kwargs):
+        # the test transaction never commits, so the tenant generation is only
+        # bumped by running the commit callbacks; the event loop thread
+        # doesn't see the pending generation of this thread
+        with mock.patch('shared_schema_tenants.cache.transaction.on_commit') as on_commit:
+            tenant = create_tenant(**kwargs)
+        for call in on_commit.call_args_list:
+            call[0][0]()
+        return tenant
+
+    def test_resolves_tenant_from_warm_domain_cache(self):
+        tenant = self.create_committed_tenant(
+            name='test', slug='test', extra_data={}, domains=['test.localhost:8000'])
+        factory = RequestFactory()
+        retrieve_by_domain(factory.get(reverse('shared_schema_tenants:tenant_list'), HTTP_HOST='test.localhost:8000'))
+        previous_tenant = get_current_tenant()
+        request = factory.get(reverse('shared_schema_tenants:tenant_list'), HTTP_HOST='test.localhost:8000')
+        response = HttpResponse()
+
+        def get_response(request):
+            self.assertEqual(request.tenant, tenant)
+            self.assertIs(get_current_tenant(), request.tenant)
+            return response
+
+        middleware = TenantMiddleware(self.make_async_get_response(get_response))
+        with self.assertNumQueries(0):
+            self.assertIs(self.run_async(middleware(request)), response)
+
+        self.assertIs(get_current_tenant(), previous_tenant)
+
+    def test_domain_retriever(self):
+        from shared_schema_tenants.async_tenant_retrievers import aretrieve_by_domain
+        tenant = self.create_committed_tenant(
+            name='test', slug='test', extra_data={}, domains=['test.localhost:8000'])
+        request = RequestFactory().get(reverse('shared_schema_tenants:tenant_list'), HTTP_HOST='test.localhost:8000')
+
+        self.assertEqual(self.run_async_to_sync(aretrieve_by_domain, request), tenant)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.run_async_to_sync(aretrieve_by_domain, request), tenant)
+
+        request = RequestFactory().get(reverse('shared_schema_tenants:tenant_list'), HTTP_HOST='other.localhost')
+        self.assertEqual(self.run_async_to_sync(aretrieve_by_domain, request), None)
+
+    def test_session_retriever_and_persistence(self):
+        from django.contrib.sessions.backends.db import SessionStore
+        from shared_schema_tenants.async_middleware import apersist_tenant
+        from shared_schema_tenants.async_tenant_retrievers import aretrieve_by_session
+        tenant = create_tenant(name='test', slug='test', extra_data={})
+        request = RequestFactory().get(reverse('shared_schema_tenants:tenant_list'))
+        request.session = SessionStore()
+
+        self.run_async_to_sync(apersist_tenant, request, tenant)
+        request.session.save()
+        request.session = SessionStore(request.session.session_key)
+
+        self.assertEqual(self.run_async_to_sync(aretrieve_by_session, request), tenant)
+
+    def test_http_header_retriever_without_header(self):
+        from shared_schema_tenants.async_tenant_retrievers import aretrieve_by_http_header
+        request = RequestFactory().get(reverse('shared_schema_tenants:tenant_list'))
+
+        self.assertEqual(self.run_async(aretrieve_by_http_header(request)), None)
+
+
+class TenantContextTests(TestCase):
+
+    def test_clear_with_token_restores_previous_tenant(self):
+        tenant_1 = create_tenant(name='tenant_1', slug='tenant_1', extra_data={})
+        tenant_2 = create_tenant(name='tenant_2', slug='tenant_2', extra_data={})
+
+        set_current_tenant(tenant_1.slug)
+        token = set_current_tenant(tenant_2.slug)
+        self.assertEqual(get_current_tenant(), tenant_2)
+
+        clear_current_tenant(token)
+        self.assertEqual(get_current_tenant(), tenant_1)
+
+        clear_current_tenant()
+        self.assertEqual(get_current_tenant(), None)
+
+    def test_tenant_is_isolated_between_threads(self):
+        import threading
+        tenant = create_tenant(name='test', slug='test', extra_data={})
+        set_current_tenant(tenant.slug)
+        thread_tenants = []
+
+        thread = threading.Thread(target=lambda: thread_tenants.append(get_current_tenant()))
+        thread.start()
+        thread.join()
+
+        self.assertEqual(thread_tenants, [None])
+        self.assertEqual(get_current_tenant(), tenant)
+
 
 class GetTenantTests(TestCase):
 
@@ -93,3 +325,71 @@ class GetTenantTests(TestCase):
         retrieved_tenant = get_tenant(request)
 
         self.assertEqual(retrieved_tenant, None)
+
+
+class RetrieverPipelineTests(TestCase):
+
+    def test_pipeline_is_compiled_once(self):
+        self.assertIs(get_retriever_pipeline(), get_retriever_pipeline())
+        self.assertIs(TenantMiddleware(lambda r: HttpResponse()).retriever_pipeline, get_retriever_pipeline())
+
+    def test_pipeline_is_recompiled_when_settings_change(self):
+        retriever_path = 'shared_schema_tenants.tenant_retrievers.retrieve_by_http_header'
+        with override_settings(SHARED_SCHEMA_TENANTS={'TENANT_RETRIEVERS': [retriever_path]}):
+            self.assertEqual([stage.retriever_path for stage in get_retriever_pipeline()], [retriever_path])
+
+        self.assertEqual(len(get_retriever_pipeline()), 3)
+
+    def test_stage_skipped_when_precondition_fails(self):
+        stage = RetrieverStage('shared_schema_tenants.tenant_retrievers.retrieve_by_http_header')
+        request = RequestFactory().get(reverse('shared_schema_tenants:tenant_list'))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(stage(request), None)
+
+        self.assertEqual(stage.get_stats()['skipped'], 1)
+        self.assertEqual(stage.get_stats()['calls'], 0)
+
+    def test_stage_stats(self):
+        tenant = create_tenant(name='test', slug='test', extra_data={})
+        stage = RetrieverStage('shared_schema_tenants.tenant_retrievers.retrieve_by_http_header')
+        factory = RequestFactory()
+
+        stage(factory.get(reverse('shared_schema_tenants:tenant_list'), HTTP_TENANT_SLUG=tenant.slug))
+        stage(factory.get(reverse('shared_schema_tenants:tenant_list')))
+
+        self.assertEqual(stage.get_stats(), {
+            'retriever': 'shared_schema_tenants.tenant_retrievers.retrieve_by_http_header',
+            'skipped': 1,
+            'calls': 1,
+            'hits': 1,
+            'hit_rate': 1.0,
+        })
+
+    def test_get_tenant_uses_given_pipeline(self):
+        tenant = create_tenant(name='test', slug='test', extra_data={}, domains=['test.localhost:8000'])
+        request = RequestFactory().get(reverse('shared_schema_tenants:tenant_list'), HTTP_HOST='test.localhost:8000')
+        retriever_pipeline = (RetrieverStage('shared_schema_tenants.tenant_retrievers.retrieve_by_domain'),)
+
+        self.assertEqual(get_tenant(request, retriever_pipeline), tenant)
+        self.assertEqual(retriever_pipeline[0].hits, 1)
+
+    def test_signed_token_stage_doesnt_query(self):
+        tenant = create_tenant(name='test', slug='test', extra_data={})
+        request = RequestFactory().get(
+            reverse('shared_schema_tenants:tenant_list'), HTTP_TENANT_TOKEN=create_tenant_token(tenant))
+        retriever_pipeline = (RetrieverStage('shared_schema_tenants.tenant_retrievers.retrieve_by_signed_token'),)
+
+        with self.assertNumQueries(0):
+            retrieved_tenant = get_tenant(request, retriever_pipeline)
+            self.assertEqual(retrieved_tenant.slug, 'test')
+
+        self.assertEqual(retrieved_tenant.pk, tenant.pk)
+        self.assertEqual(retriever_pipeline[0].hits, 1)
+
+    def test_signed_token_stage_with_invalid_token(self):
+        request = RequestFactory().get(reverse('shared_schema_tenants:tenant_list'), HTTP_TENANT_TOKEN='invalid')
+        retriever_pipeline = (RetrieverStage('shared_schema_tenants.tenant_retrievers.retrieve_by_signed_token'),)
+
+        with self.assertRaises(TenantNotFoundError):
+            get_tenant(request, retriever_pipeline)
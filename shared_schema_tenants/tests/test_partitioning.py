@@ -0,0 +1,145 @@
+import mock
+from unittest import skipUnless
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.migrations.state import ProjectState
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
+from model_mommy import mommy
+from shared_schema_tenants.helpers.tenants import create_tenant
+from shared_schema_tenants.operations import PartitionByTenant
+from shared_schema_tenants.partitioning import (
+    create_tenant_partitions, get_default_partition_name, get_partition_name, get_partition_names,
+    get_partitioning_strategy)
+from shared_schema_tenants_custom_data.models import TenantSpecificFieldCharPivot
+
+
+class PartitionByTenantTests(TestCase):
+
+    def test_describe_and_deconstruct(self):
+        self.assertEqual(PartitionByTenant('article').describe(), 'Partition article by tenant (list)')
+        self.assertEqual(PartitionByTenant('article').deconstruct(),
+                         ('PartitionByTenant', [], {'model_name': 'article'}))
+        self.assertEqual(PartitionByTenant('article', 'hash', 8).deconstruct()[2],
+                         {'model_name': 'article', 'method': 'hash', 'partitions': 8})
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            PartitionByTenant('article', 'range')
+        with self.assertRaises(ValueError):
+            PartitionByTenant('article', 'hash')
+
+    @skipUnless(connection.vendor != 'postgresql', 'Checks other databases')
+    def test_does_nothing_on_other_databases(self):
+        operation = PartitionByTenant('tenantspecificfieldcharpivot')
+        state = ProjectState.from_apps(TenantSpecificFieldCharPivot._meta.apps)
+
+        with connection.schema_editor(collect_sql=True) as schema_editor:
+            operation.database_forwards('shared_schema_tenants_custom_data', schema_editor, state, state)
+            operation.database_backwards('shared_schema_tenants_custom_data', schema_editor, state, state)
+        self.assertEqual(schema_editor.collected_sql, [])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(create_tenant_partitions(), 0)
+        self.assertEqual(len(queries), 0)
+
+    def test_partition_names(self):
+        self.assertEqual(get_partition_name('events_event', 'acme'), 'events_event_tenant_acme')
+        self.assertEqual(get_default_partition_name('events_event'), 'events_event_default')
+        self.assertNotEqual(get_partition_name('events_event', 'default'), get_default_partition_name('events_event'))
+        self.assertEqual(len(get_partition_name('events_event', 'a' * 100)), 63)
+
+    def test_command_dry_run(self):
+        with self.assertRaises(CommandError):
+            call_command('maketenantpartitionmigration', 'shared_schema_tenants_custom_data', dry_run=True)
+
+        stdout = StringIO()
+        with mock.patch.object(TenantSpecificFieldCharPivot, 'tenant_partitioning', 'hash'):
+            call_command('maketenantpartitionmigration', 'shared_schema_tenants_custom_data',
+                         dry_run=True, stdout=stdout)
+
+        self.assertIn('PartitionByTenant(', stdout.getvalue())
+        self.assertIn("'tenantspecificfieldcharpivot'", stdout.getvalue())
+        self.assertIn('partitions=16', stdout.getvalue())
+        self.assertIn("('shared_schema_tenants_custom_data', '0001_initial')", stdout.getvalue())
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Partitioning requires PostgreSQL')
+class PostgresPartitionByTenantTests(TransactionTestCase):
+
+    def setUp(self):
+        self.tenant_1 = create_tenant(name='tenant_1', slug='tenant_1', extra_data={})
+        self.tenant_2 = create_tenant(name='tenant_2', slug='tenant_2', extra_data={})
+        mommy.make(TenantSpecificFieldCharPivot, tenant=self.tenant_1, _quantity=2)
+        mommy.make(TenantSpecificFieldCharPivot, tenant=self.tenant_2, _quantity=3)
+
+        self.table = TenantSpecificFieldCharPivot._meta.db_table
+        self.state = ProjectState.from_apps(TenantSpecificFieldCharPivot._meta.apps)
+
+    def partition(self, operation):
+        with connection.schema_editor() as schema_editor:
+            operation.database_forwards('shared_schema_tenants_custom_data', schema_editor, self.state, self.state)
+        self.addCleanup(self.unpartition, operation)
+
+    def unpartition(self, operation):
+        with connection.schema_editor() as schema_editor:
+            operation.database_backwards('shared_schema_tenants_custom_data', schema_editor, self.state, self.state)
+
+        with connection.cursor() as cursor:
+            self.assertIsNone(get_partitioning_strategy(cursor, self.table))
+
+    def count_pivots(self, tenant):
+        return TenantSpecificFieldCharPivot.objects.get_queryset(tenant=tenant).count()
+
+    def test_list_partitioning(self):
+        self.partition(PartitionByTenant('tenantspecificfieldcharpivot'))
+
+        with connection.cursor() as cursor:
+            self.assertEqual(get_partitioning_strategy(cursor, self.table), 'l')
+            self.assertEqual(get_partition_names(cursor, self.table), set([
+                '%s_tenant_tenant_1' % self.table, '%s_tenant_tenant_2' % self.table, '%s_default' % self.table]))
+        self.assertEqual(self.count_pivots(self.tenant_1), 2)
+        self.assertEqual(self.count_pivots(self.tenant_2), 3)
+
+        queryset = TenantSpecificFieldCharPivot.objects.get_queryset(tenant=self.tenant_1)
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN %s' % queryset.query.sql_with_params()[0], queryset.query.sql_with_params()[1])
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertIn('%s_tenant_tenant_1' % self.table, plan)
+        self.assertNotIn('%s_tenant_tenant_2' % self.table, plan)
+
+    def test_new_tenants_get_a_partition(self):
+        self.partition(PartitionByTenant('tenantspecificfieldcharpivot'))
+
+        with mock.patch.object(TenantSpecificFieldCharPivot, 'tenant_partitioning', 'list'):
+            tenant_3 = create_tenant(name='tenant_3', slug='tenant_3', extra_data={})
+            mommy.make(TenantSpecificFieldCharPivot, tenant=tenant_3)
+
+            with connection.cursor() as cursor:
+                self.assertIn('%s_tenant_tenant_3' % self.table, get_partition_names(cursor, self.table))
+            self.assertEqual(create_tenant_partitions(), 0)
+
+    def test_rows_move_out_of_the_default_partition(self):
+        self.partition(PartitionByTenant('tenantspecificfieldcharpivot'))
+        tenant_3 = create_tenant(name='tenant_3', slug='tenant_3', extra_data={})
+        mommy.make(TenantSpecificFieldCharPivot, tenant=tenant_3, _quantity=2)
+
+        with mock.patch.object(TenantSpecificFieldCharPivot, 'tenant_partitioning', 'list'):
+            stdout = StringIO()
+            call_command('createtenantpartitions', stdout=stdout)
+        self.assertIn('1 partitions', stdout.getvalue())
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM %s' % connection.ops.quote_name('%s_tenant_tenant_3' % self.table))
+            self.assertEqual(cursor.fetchone()[0], 2)
+
+    def test_hash_partitioning(self):
+        self.partition(PartitionByTenant('tenantspecificfieldcharpivot', 'hash', 4))
+
+        with connection.cursor() as cursor:
+            self.assertEqual(get_partitioning_strategy(cursor, self.table), 'h')
+            self.assertEqual(len(get_partition_names(cursor, self.table)), 4)
+        self.assertEqual(self.count_pivots(self.tenant_1), 2)
+        self.assertEqual(self.count_pivots(self.tenant_2), 3)
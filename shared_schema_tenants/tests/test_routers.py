@@ -0,0 +1,172 @@
+import mock
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.six import StringIO
+from model_mommy import mommy
+from exampleproject.articles.models import Article, Tag
+from shared_schema_tenants.cache import pin_written_tenant
+from shared_schema_tenants.checks import check_tenant_databases
+from shared_schema_tenants.helpers.tenants import create_tenant, set_current_tenant, clear_current_tenant
+from shared_schema_tenants.models import Tenant
+from shared_schema_tenants.routers import TenantRouter
+
+
+@override_settings(SHARED_SCHEMA_TENANTS={'TENANT_DATABASES': {'tenant_2': 'shard'}})
+class TenantRouterTests(TestCase):
+
+    def setUp(self):
+        self.router = TenantRouter()
+        self.tenant_1 = create_tenant(name='tenant_1', slug='tenant_1', extra_data={})
+        self.tenant_2 = create_tenant(name='tenant_2', slug='tenant_2', extra_data={})
+
+    def test_routes_current_tenant(self):
+        self.addCleanup(clear_current_tenant, set_current_tenant(self.tenant_2.slug))
+        self.assertEqual(self.router.db_for_read(Article), 'shard')
+        self.assertEqual(self.router.db_for_write(Article), 'shard')
+
+        set_current_tenant(self.tenant_1.slug)
+        self.assertEqual(self.router.db_for_read(Article), None)
+
+        clear_current_tenant()
+        self.assertEqual(self.router.db_for_read(Article), None)
+
+    def test_routes_instance_tenant(self):
+        self.addCleanup(clear_current_tenant, set_current_tenant(self.tenant_1.slug))
+
+        self.assertEqual(self.router.db_for_write(Article, instance=Article(tenant=self.tenant_2)), 'shard')
+        self.assertEqual(self.router.db_for_read(Article, instance=self.tenant_2), 'shard')
+
+    def test_ignores_other_models(self):
+        self.addCleanup(clear_current_tenant, set_current_tenant(self.tenant_2.slug))
+
+        self.assertEqual(self.router.db_for_read(Tag), None)
+        self.assertEqual(self.router.db_for_read(Tenant), None)
+
+    def test_allows_tenant_relations_across_databases(self):
+        self.assertTrue(self.router.allow_relation(Article(tenant_id='tenant_2'), self.tenant_2))
+        self.assertEqual(self.router.allow_relation(Article(), Tag()), None)
+
+    def test_check_tenant_databases(self):
+        self.assertEqual(check_tenant_databases(), [])
+
+        with override_settings(SHARED_SCHEMA_TENANTS={'TENANT_DATABASES': {'tenant_2': 'unknown'}}):
+            self.assertEqual([error.id for error in check_tenant_databases()], ['shared_schema_tenants.E001'])
+
+
+@override_settings(SHARED_SCHEMA_TENANTS={
+    'TENANT_DATABASES': {'tenant_2': 'shard'},
+    'TENANT_READ_REPLICAS': {'default': ['replica'], 'shard': ['shard_replica']},
+})
+class TenantReplicaRouterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.router = TenantRouter()
+        caches['default'].clear()
+        self.addCleanup(clear_current_tenant, set_current_tenant('tenant_1'))
+
+    def test_reads_from_replicas(self):
+        self.assertEqual(self.router.db_for_read(Article), 'replica')
+        self.assertEqual(self.router.db_for_read(Article, instance=Article(tenant_id='tenant_2')), 'shard_replica')
+        self.assertEqual(self.router.db_for_write(Article, instance=Article(tenant_id='tenant_2')), 'shard')
+        self.assertEqual(self.router.db_for_read(Tag), None)
+
+    def test_reads_from_primary_after_write(self):
+        pin_written_tenant(Article, Article(tenant_id='tenant_1'))
+
+        self.assertEqual(self.router.db_for_read(Article), None)
+        self.assertEqual(self.router.db_for_read(Article, instance=Article(tenant_id='tenant_2')), 'shard_replica')
+
+    @mock.patch('shared_schema_tenants.cache.transaction.on_commit')
+    def test_pins_when_the_write_commits(self, on_commit):
+        self.assertEqual(self.router.db_for_write(Article), None)
+        pin_written_tenant(Article, Article(tenant_id='tenant_1'), using='default')
+        self.assertEqual(self.router.db_for_read(Article), 'replica')
+
+        on_commit.call_args[0][0]()
+        self.assertEqual(on_commit.call_args[1], {'using': 'default'})
+        self.assertEqual(self.router.db_for_read(Article), None)
+
+    @mock.patch('shared_schema_tenants.cache.time')
+    def test_pin_expires(self, time):
+        time.time.return_value = 100
+        with override_settings(SHARED_SCHEMA_TENANTS={
+                'TENANT_READ_REPLICAS': {'default': ['replica']},
+                'TENANT_CACHE_ALIAS': None, 'TENANT_PRIMARY_PIN_TIMEOUT': 10}):
+            pin_written_tenant(Article, Article(tenant_id='tenant_1'))
+            self.assertEqual(self.router.db_for_read(Article), None)
+
+            time.time.return_value = 111
+            self.assertEqual(self.router.db_for_read(Article), 'replica')
+
+    @mock.patch('shared_schema_tenants.routers.connections')
+    def test_reads_from_primary_in_transactions(self, connections):
+        connections.__getitem__.return_value.in_atomic_block = True
+
+        self.assertEqual(self.router.db_for_read(Article), None)
+
+    def test_reads_without_tenant_from_primary(self):
+        clear_current_tenant()
+        self.assertEqual(self.router.db_for_read(Article), None)
+
+
+@override_settings(DATABASE_ROUTERS=['shared_schema_tenants.routers.TenantRouter'])
+class MoveTenantTests(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.tenant_1 = create_tenant(name='tenant_1', slug='tenant_1', extra_data={})
+        self.tenant_2 = create_tenant(name='tenant_2', slug='tenant_2', extra_data={})
+        self.user = mommy.make('auth.User')
+        mommy.make(Article, tenant=self.tenant_1, author=self.user, _quantity=2)
+        self.articles = mommy.make(Article, tenant=self.tenant_2, author=self.user, _quantity=5)
+
+        self.addCleanup(clear_current_tenant, set_current_tenant(self.tenant_2))
+        self.tag = mommy.make(Tag)
+        self.articles[0].tags.add(self.tag)
+
+    def test_move_tenant(self):
+        stdout = StringIO()
+        call_command('movetenant', 'tenant_2', 'shard', batch_size=2, delete=True, stdout=stdout)
+
+        self.assertIn('Copied 5 articles.Article rows', stdout.getvalue())
+        self.assertTrue(Tenant.objects.using('shard').filter(pk='tenant_2').exists())
+        self.assertEqual(Article.original_manager.using('shard').count(), 5)
+        self.assertEqual(Article.original_manager.using('default').count(), 2)
+        self.assertEqual(list(Article.tags.through.objects.using('shard').values_list('article_id', 'tag_id')),
+                         [(self.articles[0].pk, self.tag.pk)])
+        self.assertEqual(list(Tag.tenants.through.objects.using('shard').values_list('tag_id', 'tenant_id')),
+                         [(self.tag.pk, 'tenant_2')])
+        self.assertTrue(Tag.original_manager.using('default').filter(pk=self.tag.pk).exists())
+        self.assertEqual(list(Article.original_manager.using('shard').get(pk=self.articles[0].pk).tags.all()),
+                         [self.tag])
+
+        with override_settings(SHARED_SCHEMA_TENANTS={'TENANT_DATABASES': {'tenant_2': 'shard'}}):
+            self.assertEqual(Article.objects.count(), 5)
+            self.assertEqual([article.tenant for article in Article.objects.all()], [self.tenant_2] * 5)
+            set_current_tenant('tenant_2')
+            self.assertEqual(set(article.tenant_id for article in Article.objects.all()), set(['tenant_2']))
+            set_current_tenant(self.tenant_2)
+            article = Article.objects.create(title='New', text='New', author_id=self.user.pk)
+            self.assertEqual(article._state.db, 'shard')
+
+            set_current_tenant(self.tenant_1)
+            self.assertEqual(Article.objects.count(), 2)
+
+    def test_shared_rows_are_copied_once(self):
+        shared_tag = mommy.make(Tag)
+        shared_tag.tenants.add(self.tenant_1)
+        set_current_tenant(self.tenant_1)
+        other_tag = mommy.make(Tag)
+        self.articles[1].tags.add(other_tag)
+
+        stderr = StringIO()
+        call_command('movetenant', 'tenant_2', 'shard', stdout=StringIO(), stderr=stderr)
+        call_command('movetenant', 'tenant_1', 'shard', stdout=StringIO(), stderr=StringIO())
+
+        self.assertIn('Skipped 1 articles.Article_tags links', stderr.getvalue())
+
+        self.assertEqual(sorted(Tag.original_manager.using('shard').values_list('pk', flat=True)),
+                         sorted([self.tag.pk, shared_tag.pk, other_tag.pk]))
+        self.assertEqual(set(Tag.tenants.through.objects.using('shard').filter(tag=shared_tag).values_list(
+            'tenant_id', flat=True)), set(['tenant_1', 'tenant_2']))
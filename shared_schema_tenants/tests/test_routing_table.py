@@ -0,0 +1,126 @@
+import mock
+import os
+import shutil
+import tempfile
+from django.core.management import call_command
+from django.test import TestCase, RequestFactory, override_settings
+from django.utils.six import StringIO
+from shared_schema_tenants.cache import clear_domain_cache
+from shared_schema_tenants.helpers.tenants import create_tenant
+from shared_schema_tenants.models import TenantSite
+from shared_schema_tenants.routing_table import (
+    RoutingTable, RoutingTableLoader, write_routing_table, get_routing_table)
+from shared_schema_tenants.tenant_retrievers import retrieve_by_domain
+
+
+class RoutingTableTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'routing')
+
+    def test_lookup(self):
+        write_routing_table(self.path, [
+            ('b.localhost', 'b'), ('a.localhost', 'a'), ('C.localhost:8000', 'c')])
+        routing_table = RoutingTable(self.path)
+
+        self.assertEqual(len(routing_table), 3)
+        self.assertEqual(routing_table.lookup('a.localhost'), 'a')
+        self.assertEqual(routing_table.lookup('b.localhost:8000'), 'b')
+        self.assertEqual(routing_table.lookup('c.localhost:8000'), 'c')
+        self.assertEqual(routing_table.lookup('c.localhost'), None)
+        self.assertEqual(routing_table.lookup('d.localhost'), None)
+
+    def test_empty_table(self):
+        write_routing_table(self.path, [])
+
+        self.assertEqual(RoutingTable(self.path).lookup('a.localhost'), None)
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as routing_file:
+            routing_file.write(b'0' * 64)
+
+        with self.assertRaises(ValueError):
+            RoutingTable(self.path)
+
+    @mock.patch('shared_schema_tenants.routing_table.time')
+    def test_loader_reloads_when_stamp_changes(self, time):
+        time.time.return_value = 100
+        write_routing_table(self.path, [('a.localhost', 'a')], stamp=1)
+        loader = RoutingTableLoader(self.path, check_interval=10)
+        self.assertEqual(loader.get().lookup('a.localhost'), 'a')
+
+        write_routing_table(self.path, [('a.localhost', 'other')], stamp=2)
+        self.assertEqual(loader.get().lookup('a.localhost'), 'a')
+
+        time.time.return_value = 110
+        self.assertEqual(loader.get().stamp, 2)
+        self.assertEqual(loader.get().lookup('a.localhost'), 'other')
+
+    @mock.patch('shared_schema_tenants.routing_table.time')
+    def test_loader_ignores_stale_tables(self, time):
+        time.time.return_value = 100
+        changed_stamp = mock.Mock(return_value=None)
+        write_routing_table(self.path, [('a.localhost', 'a')], stamp=1)
+        loader = RoutingTableLoader(self.path, check_interval=10, get_changed_stamp=changed_stamp)
+        self.assertEqual(loader.get().lookup('a.localhost'), 'a')
+
+        loader.mark_stale(2)
+        self.assertEqual(loader.get(), None)
+
+        write_routing_table(self.path, [('a.localhost', 'other')], stamp=3)
+        changed_stamp.return_value = 4
+        time.time.return_value = 110
+        self.assertEqual(loader.get(), None)
+
+        write_routing_table(self.path, [('a.localhost', 'other')], stamp=5)
+        time.time.return_value = 120
+        self.assertEqual(loader.get().lookup('a.localhost'), 'other')
+
+    def test_loader_without_file(self):
+        self.assertEqual(RoutingTableLoader(self.path).get(), None)
+
+
+class RoutingTableRetrieverTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'routing')
+        self.tenant = create_tenant(name='test', slug='test', extra_data={}, domains=['test.localhost:8000'])
+        clear_domain_cache()
+
+    def test_command_builds_table(self):
+        stdout = StringIO()
+        call_command('buildroutingtable', path=self.path, stdout=stdout)
+
+        self.assertEqual(RoutingTable(self.path).lookup('test.localhost:8000'), 'test')
+        self.assertIn('1 domains', stdout.getvalue())
+
+    def test_domain_retriever_uses_table(self):
+        call_command('buildroutingtable', path=self.path, stdout=StringIO())
+        request = RequestFactory().get('/', HTTP_HOST='test.localhost:8000')
+
+        with override_settings(SHARED_SCHEMA_TENANTS={'ROUTING_TABLE_PATH': self.path}):
+            self.assertIsNotNone(get_routing_table())
+            with self.assertNumQueries(1):
+                self.assertEqual(retrieve_by_domain(request), self.tenant)
+
+    def test_domain_changes_mark_the_table_stale(self):
+        call_command('buildroutingtable', path=self.path, stdout=StringIO())
+        other_tenant = create_tenant(name='other', slug='other', extra_data={})
+        request = RequestFactory().get('/', HTTP_HOST='test.localhost:8000')
+
+        with override_settings(SHARED_SCHEMA_TENANTS={'ROUTING_TABLE_PATH': self.path}):
+            self.assertEqual(retrieve_by_domain(request), self.tenant)
+
+            tenant_site = TenantSite.original_manager.get(tenant=self.tenant)
+            tenant_site.tenant = other_tenant
+            tenant_site.save()
+            self.assertEqual(get_routing_table(), None)
+            self.assertEqual(retrieve_by_domain(request), other_tenant)
+
+            call_command('buildroutingtable', path=self.path, stdout=StringIO())
+            with mock.patch('shared_schema_tenants.routing_table.time.time', return_value=10 ** 10):
+                self.assertEqual(get_routing_table().lookup('test.localhost:8000'), 'other')
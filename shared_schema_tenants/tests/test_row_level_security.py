@@ -0,0 +1,146 @@
+import mock
+from unittest import skipUnless
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.state import ProjectState
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
+from model_mommy import mommy
+from exampleproject.articles.models import Article
+from shared_schema_tenants.helpers.tenants import create_tenant, set_database_tenant
+from shared_schema_tenants.middleware import TenantMiddleware
+from shared_schema_tenants.operations import EnableTenantRowLevelSecurity
+
+
+class EnableTenantRowLevelSecurityTests(TestCase):
+
+    def test_describe_and_deconstruct(self):
+        operation = EnableTenantRowLevelSecurity('article')
+
+        self.assertEqual(operation.describe(), 'Enable tenant row level security on article')
+        self.assertEqual(operation.deconstruct(), ('EnableTenantRowLevelSecurity', [], {'model_name': 'article'}))
+        self.assertEqual(EnableTenantRowLevelSecurity('article', force=False).deconstruct()[2],
+                         {'model_name': 'article', 'force': False})
+
+    @skipUnless(connection.vendor != 'postgresql', 'Checks other databases')
+    def test_does_nothing_on_other_databases(self):
+        operation = EnableTenantRowLevelSecurity('article')
+        state = ProjectState.from_apps(Article._meta.apps)
+
+        with connection.schema_editor(collect_sql=True) as schema_editor:
+            operation.database_forwards('articles', schema_editor, state, state)
+            operation.database_backwards('articles', schema_editor, state, state)
+        self.assertEqual(schema_editor.collected_sql, [])
+
+        with CaptureQueriesContext(connection) as queries:
+            set_database_tenant('test')
+        self.assertEqual(len(queries), 0)
+
+    @mock.patch('shared_schema_tenants.helpers.tenants.connections')
+    def test_set_database_tenant_statements(self, connections):
+        connection = connections.__getitem__.return_value
+        connection.vendor = 'postgresql'
+        cursor = connection.cursor.return_value.__enter__.return_value
+
+        set_database_tenant('test', using='default')
+        cursor.execute.assert_called_once_with(
+            'SELECT set_config(%s, %s, false)', ['app.current_tenant', 'test'])
+
+        cursor.reset_mock()
+        set_database_tenant(None, using='default')
+        cursor.execute.assert_called_once_with('RESET app.current_tenant')
+
+    def test_command_dry_run(self):
+        stdout = StringIO()
+        call_command('maketenantrlsmigration', 'articles', dry_run=True, stdout=stdout)
+
+        self.assertIn("EnableTenantRowLevelSecurity(\n            model_name=", stdout.getvalue())
+        self.assertIn("'article'", stdout.getvalue())
+        self.assertNotIn("'tag'", stdout.getvalue())
+        self.assertIn("('articles', '0002_tag_tenant_slugs')", stdout.getvalue())
+
+
+class RowLevelSecurityMiddlewareTests(TestCase):
+
+    def setUp(self):
+        self.tenant = create_tenant(name='test', slug='test', extra_data={})
+        self.middleware = TenantMiddleware(lambda request: None)
+        self.request = RequestFactory().get('/', HTTP_TENANT_SLUG='test')
+
+    @mock.patch('shared_schema_tenants.helpers.tenants.set_database_tenant')
+    def test_sets_and_resets_database_tenant(self, set_database_tenant):
+        with override_settings(SHARED_SCHEMA_TENANTS={'ROW_LEVEL_SECURITY': True}):
+            self.middleware.process_request(self.request)
+            set_database_tenant.assert_called_once_with('test', using='default')
+
+            self.middleware.reset_tenant(self.request)
+            set_database_tenant.assert_called_with(None, using='default')
+
+    @mock.patch('shared_schema_tenants.helpers.tenants.set_database_tenant')
+    def test_sets_database_tenant_on_routed_databases(self, set_database_tenant):
+        with override_settings(SHARED_SCHEMA_TENANTS={
+                'ROW_LEVEL_SECURITY': True, 'TENANT_DATABASES': {'test': 'shard'},
+                'TENANT_READ_REPLICAS': {'shard': ['shard_replica']}}):
+            self.middleware.process_request(self.request)
+            self.assertEqual(set_database_tenant.call_args_list, [
+                mock.call('test', using='default'), mock.call('test', using='shard'),
+                mock.call('test', using='shard_replica')])
+
+            set_database_tenant.reset_mock()
+            self.middleware.reset_tenant(self.request)
+            self.assertEqual([call[1]['using'] for call in set_database_tenant.call_args_list],
+                             ['default', 'shard', 'shard_replica'])
+
+    @mock.patch('shared_schema_tenants.helpers.tenants.set_database_tenant')
+    def test_disabled_by_default(self, set_database_tenant):
+        self.middleware.process_request(self.request)
+        self.middleware.reset_tenant(self.request)
+
+        set_database_tenant.assert_not_called()
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Row level security requires PostgreSQL')
+class PostgresRowLevelSecurityTests(TransactionTestCase):
+
+    def setUp(self):
+        # superusers bypass even forced policies
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT rolsuper FROM pg_roles WHERE rolname = current_user')
+            if cursor.fetchone()[0]:
+                self.skipTest('Superusers bypass row level security, set POSTGRES_USER to another role')
+
+        self.tenant_1 = create_tenant(name='tenant_1', slug='tenant_1', extra_data={})
+        self.tenant_2 = create_tenant(name='tenant_2', slug='tenant_2', extra_data={})
+        mommy.make(Article, tenant=self.tenant_1, _quantity=2)
+        mommy.make(Article, tenant=self.tenant_2, _quantity=3)
+
+        # the test database user owns the table, so the policy has to be forced
+        self.operation = EnableTenantRowLevelSecurity('article')
+        self.state = ProjectState.from_apps(Article._meta.apps)
+        with connection.schema_editor() as schema_editor:
+            self.operation.database_forwards('articles', schema_editor, self.state, self.state)
+        self.addCleanup(self.disable_row_level_security)
+
+    def disable_row_level_security(self):
+        set_database_tenant(None)
+        with connection.schema_editor() as schema_editor:
+            self.operation.database_backwards('articles', schema_editor, self.state, self.state)
+
+    def count_articles(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM %s' % connection.ops.quote_name(Article._meta.db_table))
+            return cursor.fetchone()[0]
+
+    def test_raw_queries_only_see_current_tenant_rows(self):
+        set_database_tenant(self.tenant_1.pk)
+        self.assertEqual(self.count_articles(), 2)
+        self.assertEqual(Article.original_manager.count(), 2)
+
+        set_database_tenant(self.tenant_2.pk)
+        self.assertEqual(self.count_articles(), 3)
+
+    def test_reset_tenant_sees_every_row(self):
+        set_database_tenant(self.tenant_1.pk)
+        set_database_tenant(None)
+        self.assertEqual(self.count_articles(), 5)
@@ -0,0 +1,27 @@
+from django.test import TestCase, override_settings
+from shared_schema_tenants.settings import get_settings, get_setting
+
+
+class SettingsTests(TestCase):
+
+    def test_settings_are_built_once(self):
+        self.assertIs(get_settings(), get_settings())
+
+    def test_attribute_access(self):
+        self.assertEqual(get_settings().TENANT_HTTP_HEADER, 'Tenant-Slug')
+        self.assertEqual(get_settings().TENANT_HTTP_HEADER_META_KEY, 'HTTP_TENANT_SLUG')
+        self.assertEqual(get_settings().DEFAULT_TENANT_SETTINGS, {'notify_users_by_email': True})
+        self.assertEqual(get_setting('TENANT_HTTP_HEADER'), 'Tenant-Slug')
+        self.assertEqual(get_setting('UNEXISTENT'), None)
+
+    def test_settings_are_read_only(self):
+        with self.assertRaises(AttributeError):
+            get_settings().TENANT_HTTP_HEADER = 'Other'
+
+        self.assertIsInstance(get_settings().TENANT_RETRIEVERS, tuple)
+
+    def test_settings_are_rebuilt_when_changed(self):
+        with override_settings(SHARED_SCHEMA_TENANTS={'TENANT_HTTP_HEADER': 'X-Tenant'}):
+            self.assertEqual(get_settings().TENANT_HTTP_HEADER_META_KEY, 'HTTP_X_TENANT')
+
+        self.assertEqual(get_settings().TENANT_HTTP_HEADER_META_KEY, 'HTTP_TENANT_SLUG')
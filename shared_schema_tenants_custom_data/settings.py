@@ -1,7 +1,10 @@
 from django.conf import settings
+from django.core.signals import setting_changed
 
+from shared_schema_tenants.settings import FrozenSettings
 
-def get_setting(settings_name):
+
+def build_settings():
     app_settings = getattr(settings, 'SHARED_SCHEMA_TENANTS_CUSTOM_DATA', {})
     settings_dict = {
         'CUSTOMIZABLE_MODELS': app_settings.get('CUSTOMIZABLE_MODELS', []),
@@ -16,4 +19,27 @@ def get_setting(settings_name):
             app_settings.get('CUSTOMIZABLE_TABLES_LABEL_SEPARATOR', '__'),
     }
 
-    return settings_dict.get(settings_name)
+    return FrozenSettings(settings_dict)
+
+
+_settings = None
+
+
+def get_settings():
+    global _settings
+    if _settings is None:
+        _settings = build_settings()
+    return _settings
+
+
+def get_setting(settings_name):
+    return get_settings().get(settings_name)
+
+
+def reload_settings(setting, *args, **kwargs):
+    global _settings
+    if setting == 'SHARED_SCHEMA_TENANTS_CUSTOM_DATA':
+        _settings = None
+
+
+setting_changed.connect(reload_settings)